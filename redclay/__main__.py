@@ -5,6 +5,16 @@ init_logging()
 import sys
 from redclay.shell_command import run_from_argv
 
-SUBCOMMANDS = ["redclay.server.run_server"]
+SUBCOMMANDS = [
+    "redclay.server.run_server",
+    "redclay.benchmark.benchmark",
+    "redclay.benchmark.benchmark_broadcast",
+    "redclay.benchmark.benchmark_memory",
+    "redclay.benchmark.benchmark_access_list",
+    "redclay.loadtest.loadtest",
+    "redclay.simulation.simulate_login_failures",
+    "redclay.admin.admin",
+    "redclay.presence.presence_hub",
+]
 
 run_from_argv(SUBCOMMANDS, sys.argv[1:])
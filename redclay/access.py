@@ -0,0 +1,284 @@
+import asyncio
+import collections
+import heapq
+import ipaddress
+import logging
+import socket
+
+from redclay.metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+MATCHES = METRICS.counter(
+    "redclay_access_matches_total",
+    "New connections matching an access list rule, by action",
+    ["action"],
+)
+RULES = METRICS.gauge(
+    "redclay_access_rules", "Rules in the access list, by action", ["action"]
+)
+
+ACTIONS = {"ban", "allow"}
+
+
+class Rule(collections.namedtuple("Rule", ["action", "version", "prefix", "length"])):
+    # prefix is the network's first length bits, as an integer
+    @property
+    def network(self):
+        if self.version == 4:
+            return ipaddress.IPv4Network(
+                (self.prefix << (32 - self.length), self.length)
+            )
+        return ipaddress.IPv6Network((self.prefix << (128 - self.length), self.length))
+
+
+class AccessList:
+    # Which peer addresses may connect, from a file of rules like
+    #
+    #     # a noisy range, except for one friend in it
+    #     ban 192.0.2.0/24
+    #     allow 192.0.2.7
+    #     ban 2001:db8::/32
+    #
+    # The longest prefix that matches an address decides. Addresses that
+    # match no rule are allowed: to let in only some, ban 0.0.0.0/0 and ::/0
+    # and allow those.
+    #
+    # Reloading reads the file on a thread, and swaps the new rules in all
+    # at once if they're good. Connections already made aren't affected.
+    def __init__(self, path):
+        self.path = path
+        self.trie = PrefixTrie()
+        self.rules = []
+        # by rule, kept across reloads for rules that stay
+        self.matches = []
+        self.reloading = None
+        self.install(*self.read())
+
+    def __len__(self):
+        return len(self.rules)
+
+    def read(self):
+        # Off the loop, for a reload: it takes a while for a big list.
+        with open(self.path) as f:
+            # later rules for the same network win
+            rules = {
+                (rule.version, rule.prefix, rule.length): rule
+                for rule in parse_rules(f)
+            }
+        rules = list(rules.values())
+        trie = PrefixTrie()
+        for index, rule in enumerate(rules):
+            trie.insert(rule.version, rule.prefix, rule.length, index)
+        return rules, trie
+
+    def install(self, rules, trie):
+        old_matches = {
+            rule[1:]: matches for rule, matches in zip(self.rules, self.matches)
+        }
+        self.rules = rules
+        self.trie = trie
+        self.matches = [old_matches.get(rule[1:], 0) for rule in rules]
+        counts = collections.Counter(rule.action for rule in rules)
+        for action in ACTIONS:
+            RULES.set(counts[action], action)
+        logger.info(
+            "loaded access list",
+            extra={"path": self.path, "ban": counts["ban"], "allow": counts["allow"]},
+        )
+
+    async def reload(self):
+        loop = asyncio.get_event_loop()
+        self.install(*await loop.run_in_executor(None, self.read))
+
+    def start_reload(self):
+        # For a signal handler. If the file's gone bad, say so, and keep
+        # the rules we have.
+        self.reloading = asyncio.ensure_future(self.reload())
+        self.reloading.add_done_callback(self.reloaded)
+
+    def reloaded(self, reloading):
+        if not reloading.cancelled() and reloading.exception() is not None:
+            logger.error(
+                "could not reload access list",
+                exc_info=reloading.exception(),
+                extra={"path": self.path},
+            )
+
+    def match(self, host):
+        # The Rule that decides for host, or None.
+        key = address_key(host)
+        if key is None:
+            return None
+        index = self.trie.match(*key)
+        if index is None:
+            return None
+        rule = self.rules[index]
+        MATCHES.inc(rule.action)
+        self.matches[index] += 1
+        return rule
+
+    def banned(self, host):
+        rule = self.match(host)
+        return rule is not None and rule.action == "ban"
+
+    def top_matches(self, limit):
+        indexes = heapq.nlargest(
+            limit, range(len(self.rules)), key=self.matches.__getitem__
+        )
+        return [(self.rules[index], self.matches[index]) for index in indexes]
+
+
+def parse_rules(lines):
+    for number, line in enumerate(lines, 1):
+        words = line.partition("#")[0].split()
+        if not words:
+            continue
+        try:
+            action, prefix = words
+            if action not in ACTIONS:
+                raise ValueError(f"unknown action {action!r}")
+            version, prefix, length = parse_prefix(prefix)
+        except ValueError as e:
+            raise ValueError(f"line {number}: {line.strip()!r}: {e}") from None
+        yield Rule(action, version, prefix, length)
+
+
+def parse_prefix(text):
+    # (version, first length bits, length) for ADDRESS[/LENGTH]. Bits past
+    # the length are ignored, as in 10.1.2.3/8.
+    address, slash, length = text.partition("/")
+    key = parse_address(address)
+    if key is None:
+        raise ValueError(f"not an address: {address!r}")
+    version, value = key
+    bits = 32 if version == 4 else 128
+    if not slash:
+        return version, value, bits
+    if not length.isdigit() or int(length) > bits:
+        raise ValueError(f"bad prefix length: {length!r}")
+    length = int(length)
+    return version, value >> (bits - length), length
+
+
+class PrefixTrie:
+    # Values by network prefix, looked up by the longest prefix containing
+    # an address. For each address family, a table indexed by an address's
+    # first STRIDE bits leads to a path-compressed binary trie of the longer
+    # prefixes starting with those bits; shorter prefixes are copied into
+    # each slot they cover. A lookup is one index and a walk down a small
+    # trie, at most one node per bit where its prefixes branch.
+    STRIDE = 16
+
+    def __init__(self):
+        self.tables = {4: [None] * (1 << self.STRIDE), 6: [None] * (1 << self.STRIDE)}
+
+    def insert(self, version, prefix, length, value):
+        # prefix is the network's first length bits, as an integer
+        table = self.tables[version]
+
+        if length <= self.STRIDE:
+            # Fill in every slot this covers, unless something more
+            # specific got there first.
+            start = prefix << (self.STRIDE - length)
+            for index in range(start, start + (1 << (self.STRIDE - length))):
+                slot = table[index]
+                if slot is None:
+                    slot = table[index] = TrieNode(index, self.STRIDE)
+                if slot.cover_length <= length:
+                    slot.cover_length = length
+                    slot.cover = value
+            return
+
+        index = prefix >> (length - self.STRIDE)
+        node = table[index]
+        if node is None:
+            node = table[index] = TrieNode(index, self.STRIDE)
+        while True:
+            common = common_length(prefix, length, node.prefix, node.length)
+            if common < node.length:
+                # Split the node where we part ways with it.
+                node = node.split(common)
+            if length == node.length:
+                node.value = value
+                return
+            bit = (prefix >> (length - node.length - 1)) & 1
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = TrieNode(prefix, length, value)
+                return
+            node = child
+
+    def match(self, version, key):
+        # The value of the longest prefix containing the address whose
+        # integer value is key, or None.
+        bits = 32 if version == 4 else 128
+        node = self.tables[version][key >> (bits - self.STRIDE)]
+        if node is None:
+            return None
+        value = node.cover
+        while node is not None:
+            length = node.length
+            if key >> (bits - length) != node.prefix:
+                break
+            if node.value is not None:
+                value = node.value
+            if length == bits:
+                break
+            node = node.children[(key >> (bits - length - 1)) & 1]
+        return value
+
+
+class TrieNode:
+    __slots__ = ["prefix", "length", "value", "children", "cover", "cover_length"]
+
+    def __init__(self, prefix, length, value=None):
+        # the top length bits of the keys under here
+        self.prefix = prefix
+        self.length = length
+        self.value = value
+        self.children = [None, None]
+        # In a table slot, the longest prefix shorter than the stride
+        # covering it.
+        self.cover = None
+        self.cover_length = -1
+
+    def split(self, length):
+        # Move what's here into a new child, leaving this node with just
+        # the first length bits of its prefix, and nothing else. (In place,
+        # so whatever points here still does.)
+        child = TrieNode(self.prefix, self.length, self.value)
+        child.children = self.children
+        bit = (self.prefix >> (self.length - length - 1)) & 1
+        self.prefix >>= self.length - length
+        self.length = length
+        self.value = None
+        self.children = [None, None]
+        self.children[bit] = child
+        return self
+
+
+def common_length(a, a_length, b, b_length):
+    # How many leading bits two prefixes share.
+    length = min(a_length, b_length)
+    different = (a >> (a_length - length)) ^ (b >> (b_length - length))
+    return length - different.bit_length()
+
+
+def parse_address(text):
+    # (version, integer value) for an address, or None. Much quicker than
+    # ipaddress.ip_address().
+    version, family = (6, socket.AF_INET6) if ":" in text else (4, socket.AF_INET)
+    try:
+        return version, int.from_bytes(socket.inet_pton(family, text), "big")
+    except OSError:
+        # e.g. an IPv6 address with a scope, which we don't rule on
+        return None
+
+
+def address_key(host):
+    # A peer's address to look up. IPv4-mapped IPv6 addresses are IPv4's.
+    key = parse_address(host)
+    if key is not None and key[0] == 6 and key[1] >> 32 == 0xFFFF:
+        return 4, key[1] & 0xFFFFFFFF
+    return key
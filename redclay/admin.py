@@ -0,0 +1,269 @@
+import asyncio
+import inspect
+import io
+import logging
+import shlex
+import tracemalloc
+
+from redclay import memory
+from redclay.handoff import bind_private_unix_socket
+from redclay.metrics import METRICS, Histogram
+from redclay.shell_command import argument, subcommand
+
+logger = logging.getLogger(__name__)
+
+
+class AdminConsole:
+    # A line-oriented console for operators, on a unix socket in the same
+    # event loop as the game. Commands only look at what's in memory, and
+    # the long listings yield as they go, so a busy console doesn't hold up
+    # players.
+    PROMPT = "redclay> "
+    YIELD_EVERY = 500
+    BANNER = "redclay admin console. Type 'help' for commands.\n"
+
+    def __init__(self, conn_server):
+        self.conn_server = conn_server
+
+    async def handle_client(self, reader, writer):
+        logger.info("admin console connected")
+        try:
+            writer.write(self.BANNER.encode("utf-8"))
+            while True:
+                writer.write(self.PROMPT.encode("utf-8"))
+                await writer.drain()
+                line = await reader.readline()
+                if not line:
+                    break
+                output = await self.run_command(line.decode("utf-8", "replace"))
+                if output is None:
+                    break
+                writer.write(output.encode("utf-8"))
+        except ConnectionError:
+            pass
+        finally:
+            logger.info("admin console disconnected")
+            writer.close()
+
+    async def run_command(self, line):
+        # Returns the command's output, or None to hang up.
+        try:
+            words = shlex.split(line)
+        except ValueError as e:
+            return f"error: {e}\n"
+        if not words:
+            return ""
+
+        name, args = words[0], words[1:]
+        command = getattr(self, "command_" + name.replace("-", "_"), None)
+        if command is None:
+            return f"unknown command: {name}\n"
+        logger.info("admin command", extra={"command": words})
+        try:
+            inspect.signature(command).bind(*args)
+        except TypeError:
+            return f"usage: {command.__doc__ or name}\n"
+        try:
+            return await command(*args)
+        except Exception as e:
+            logger.exception("admin command failed")
+            return f"error: {e!r}\n"
+
+    def find_connection(self, conn_id):
+        # Connections are known by their terminal's id, as in the logs.
+        for conn in self.conn_server.connections:
+            if str(id(conn.term)) == conn_id:
+                return conn
+        raise LookupError(f"no connection {conn_id}")
+
+    # commands. Each docstring is its usage.
+
+    async def command_help(self):
+        "help"
+        names = sorted(name[8:] for name in dir(self) if name.startswith("command_"))
+        lines = [getattr(self, "command_" + name).__doc__ for name in names]
+        return "\n".join(lines) + "\n"
+
+    async def command_quit(self):
+        "quit"
+        return None
+
+    async def command_connections(self):
+        "connections"
+        rows = [("ID", "PEER", "HOST", "USER", "TAG", "IN", "OUT", "IDLE")]
+        for i, conn in enumerate(list(self.conn_server.connections)):
+            if i % self.YIELD_EVERY == 0:
+                # Let players have a turn while we list thousands of them.
+                await asyncio.sleep(0)
+            term = conn.term
+            peer = term.writer.get_extra_info("peername")
+            rows.append(
+                (
+                    str(id(term)),
+                    format_peer(peer),
+                    conn.host or "-",
+                    conn["username"] or "-",
+                    conn["tag"] or "-",
+                    str(term.input_backlog()),
+                    str(term.output_backlog()),
+                    f"{term.idle_time():.0f}s",
+                )
+            )
+        return format_table(rows) + f"{len(rows) - 1} connections\n"
+
+    async def command_tasks(self, limit="10"):
+        "tasks [STACK-LIMIT]"
+        out = io.StringIO()
+        tasks = asyncio.all_tasks()
+        for task in tasks:
+            task.print_stack(limit=int(limit), file=out)
+            out.write("\n")
+        out.write(f"{len(tasks)} tasks\n")
+        return out.getvalue()
+
+    async def command_metrics(self):
+        "metrics"
+        return METRICS.render()
+
+    async def command_latency(self):
+        "latency"
+        rows = [("METRIC", "LABELS", "COUNT", "P50", "P90", "P99")]
+        for name, metric in sorted(METRICS.metrics.items()):
+            if not isinstance(metric, Histogram):
+                continue
+            for label_values, series in sorted(metric.values.items()):
+                quantiles = (
+                    format_seconds(series.quantile(q, metric.buckets))
+                    for q in (0.5, 0.9, 0.99)
+                )
+                rows.append(
+                    (
+                        name,
+                        "/".join(filter(None, label_values)) or "-",
+                        str(series.count()),
+                        *quantiles,
+                    )
+                )
+        return format_table(rows)
+
+    async def command_memory(self, *args):
+        "memory [TOP | start [FRAMES] | stop]"
+        if args[:1] == ("start",):
+            tracemalloc.start(*map(int, args[1:2]))
+            return "tracing allocations from now on\n"
+        if args[:1] == ("stop",):
+            tracemalloc.stop()
+            return "stopped tracing allocations\n"
+        # Grouping a snapshot takes a while: do it on a thread and keep
+        # serving players meanwhile.
+        top = int(args[0]) if args else 20
+        loop = asyncio.get_event_loop()
+        lines = await loop.run_in_executor(
+            None, memory.report, top, len(self.conn_server.connections)
+        )
+        return "\n".join(lines) + "\n"
+
+    async def command_kick(self, conn_id, *message):
+        "kick ID [MESSAGE]"
+        from redclay.server import Kicked
+
+        conn = self.find_connection(conn_id)
+        conn.interrupt(Kicked(" ".join(message)))
+        return f"kicked {conn_id}\n"
+
+    async def command_message(self, conn_id, *message):
+        "message ID MESSAGE"
+        if not message:
+            return f"usage: {self.command_message.__doc__}\n"
+        conn = self.find_connection(conn_id)
+        text = "\n" + " ".join(message) + "\n"
+        sent = self.conn_server.connections.broadcast(text, recipients=[conn])
+        return f"sent to {sent} connections\n"
+
+    async def command_broadcast(self, *message):
+        "broadcast MESSAGE"
+        if not message:
+            return f"usage: {self.command_broadcast.__doc__}\n"
+        text = "\n" + " ".join(message) + "\n"
+        sent = self.conn_server.connections.broadcast(text)
+        return f"sent to {sent} connections\n"
+
+    async def command_access(self, *args):
+        "access [TOP | reload]"
+        access_list = self.conn_server.admission.access_list
+        if access_list is None:
+            return "no access list\n"
+        if args[:1] == ("reload",):
+            # Unlike SIGHUP, tell whoever asked what's wrong with the file.
+            await access_list.reload()
+            return f"loaded {len(access_list)} rules\n"
+        top = int(args[0]) if args else 20
+        rows = [("ACTION", "NETWORK", "MATCHES")]
+        for rule, count in access_list.top_matches(top):
+            rows.append((rule.action, str(rule.network), str(count)))
+        return format_table(rows) + f"{len(access_list)} rules\n"
+
+    async def command_loglevel(self, name="root", level=None):
+        "loglevel [LOGGER [LEVEL]]"
+        target = logging.getLogger(None if name == "root" else name)
+        if level is not None:
+            if not isinstance(logging.getLevelName(level.upper()), int):
+                return f"unknown level: {level}\n"
+            target.setLevel(level.upper())
+        level = logging.getLevelName(target.getEffectiveLevel())
+        return f"{target.name}: {level}\n"
+
+
+def format_peer(peer):
+    if isinstance(peer, tuple):
+        host, port = peer[:2]
+        return f"[{host}]:{port}" if ":" in host else f"{host}:{port}"
+    return str(peer or "-")
+
+
+def format_seconds(seconds):
+    if seconds == float("inf"):
+        return "+Inf"
+    return f"{seconds * 1000:g}ms"
+
+
+def format_table(rows):
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() + "\n"
+        for row in rows
+    )
+
+
+async def start_admin_console(path, conn_server):
+    # The console can kick players and read everything. Keep it to us.
+    server = await asyncio.start_unix_server(
+        AdminConsole(conn_server).handle_client, sock=bind_private_unix_socket(path)
+    )
+    logger.info("admin console listening", extra={"path": path})
+    return server
+
+
+# a client, for when socat isn't handy
+
+
+@subcommand(
+    argument("socket", help="the server's --admin-socket"),
+    argument("words", nargs="+", metavar="COMMAND", help="admin command to run"),
+)
+def admin(socket, words):
+    print(asyncio.run(run_admin_command(socket, words)), end="")
+
+
+async def run_admin_command(path, words):
+    prompt = AdminConsole.PROMPT.encode("utf-8")
+    reader, writer = await asyncio.open_unix_connection(path)
+    try:
+        await reader.readuntil(prompt)
+        line = " ".join(shlex.quote(word) for word in words)
+        writer.write(line.encode("utf-8") + b"\n")
+        output = await reader.readuntil(prompt)
+        writer.write(b"quit\n")
+        return output[: -len(prompt)].decode("utf-8")
+    finally:
+        writer.close()
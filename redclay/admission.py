@@ -0,0 +1,122 @@
+import collections
+import enum
+import ipaddress
+import logging
+
+from redclay.metrics import METRICS
+from redclay.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+REFUSALS = METRICS.counter(
+    "redclay_refusals_total", "Connections refused at accept time", ["reason"]
+)
+
+
+class Refusal(enum.Enum):
+    # Sent raw before we've built a Terminal, so they're pre-stuffed.
+    BANNED = b"Connections from your address are not allowed.\r\n"
+    RATE = b"The server is busy. Please try again in a moment.\r\n"
+    FULL = b"The server is full. Please try again later.\r\n"
+    HOST = b"Too many connections from your address.\r\n"
+    SUBNET = b"Too many connections from your network.\r\n"
+
+
+class AdmissionControl:
+    # Decide at accept time whether to take on a new connection, cheapest
+    # checks first, except that banned addresses don't get to spend the
+    # accept rate. Limits of None are unlimited. Subnet limits group
+    # addresses by IPv4 prefix_length, or IPv6 IPV6_PREFIX_LENGTH.
+    IPV6_PREFIX_LENGTH = 64
+
+    def __init__(
+        self,
+        max_connections=None,
+        per_host=None,
+        per_subnet=None,
+        prefix_length=24,
+        accepts_per_sec=None,
+        accepts_burst=None,
+        access_list=None,
+    ):
+        self.access_list = access_list
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.per_subnet = per_subnet
+        self.prefix_length = prefix_length
+        self.accept_bucket = None
+        if accepts_per_sec:
+            self.accept_bucket = TokenBucket(
+                accepts_per_sec, accepts_burst or accepts_per_sec
+            )
+
+        self.hosts = collections.Counter()
+        self.subnets = collections.Counter()
+
+    def admit(self, peername, live_connections):
+        # Returns a Refusal, or else None and counts the new connection.
+        refusal = self.check(peername, live_connections)
+        if refusal:
+            REFUSALS.inc(refusal.name.lower())
+            return refusal
+        self.add(peername)
+
+    def check(self, peername, live_connections):
+        host = peer_host(peername)
+        if (
+            self.access_list is not None
+            and host is not None
+            and self.access_list.banned(host)
+        ):
+            return Refusal.BANNED
+        if self.accept_bucket and not self.accept_bucket.try_consume():
+            return Refusal.RATE
+        if self.max_connections and live_connections >= self.max_connections:
+            return Refusal.FULL
+
+        if host is None:
+            return
+        if self.per_host and self.hosts[host] >= self.per_host:
+            return Refusal.HOST
+        if self.per_subnet and self.subnets[self.subnet(host)] >= self.per_subnet:
+            return Refusal.SUBNET
+
+    def add(self, peername):
+        host = peer_host(peername)
+        if host is None:
+            return
+        if self.per_host:
+            self.hosts[host] += 1
+        if self.per_subnet:
+            self.subnets[self.subnet(host)] += 1
+
+    def remove(self, peername):
+        host = peer_host(peername)
+        if host is None:
+            return
+        if self.per_host:
+            decrement(self.hosts, host)
+        if self.per_subnet:
+            decrement(self.subnets, self.subnet(host))
+
+    def subnet(self, host):
+        address = ipaddress.ip_address(host)
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        prefix_length = (
+            self.prefix_length if address.version == 4 else self.IPV6_PREFIX_LENGTH
+        )
+        return ipaddress.ip_network((address, prefix_length), strict=False)
+
+
+def peer_host(peername):
+    # (host, port) for IPv4, (host, port, flowinfo, scope) for IPv6, and
+    # something else entirely for unix sockets, which we don't limit.
+    if isinstance(peername, tuple):
+        return peername[0]
+
+
+def decrement(counter, key):
+    counter[key] -= 1
+    if counter[key] <= 0:
+        del counter[key]
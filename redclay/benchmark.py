@@ -0,0 +1,461 @@
+import asyncio
+import collections
+import gc
+import logging
+import multiprocessing
+import socket
+import time
+import tracemalloc
+
+from redclay import loops
+from redclay.shell_command import argument, subcommand
+
+logger = logging.getLogger(__name__)
+
+
+@subcommand(
+    loops.loop_argument(),
+    argument(
+        "--clients",
+        type=int,
+        default=100,
+        help="concurrent client sessions (default: %(default)s)",
+    ),
+    argument(
+        "--commands",
+        type=int,
+        default=20,
+        help="commands each client sends (default: %(default)s)",
+    ),
+)
+def benchmark(loop, clients, commands):
+    # Run a server in a child process on the requested loop, and hammer it
+    # with echo sessions from this one.
+    port = find_free_port()
+    server = multiprocessing.Process(
+        target=run_benchmark_server, args=(loop, port), daemon=True
+    )
+    server.start()
+    try:
+        stats = loops.run(run_echo_benchmark(port, clients, commands), loop)
+    finally:
+        server.terminate()
+        server.join()
+
+    print_report(loop, stats)
+
+
+def find_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_benchmark_server(loop, port):
+    # Per-write debug logging would swamp whatever we're trying to measure.
+    logging.getLogger().setLevel(logging.WARNING)
+
+    from redclay.server import ServerConfig, async_run_server
+
+    # Clients send as fast as they get answers. Throttling them would
+    # measure the input limits, not the server.
+    config = ServerConfig(
+        bind=[("127.0.0.1", port)], input_bytes_per_sec=0, input_lines_per_sec=0
+    )
+    loops.run(async_run_server(config), loop)
+
+
+async def run_echo_benchmark(port, clients, commands):
+    await wait_for_server(port)
+
+    stats = EchoStats(clients)
+    start = time.perf_counter()
+    sessions = [
+        echo_session(port, f"bench{i}", commands, stats) for i in range(clients)
+    ]
+    await asyncio.gather(*sessions)
+    stats.elapsed = time.perf_counter() - start
+    return stats
+
+
+async def wait_for_server(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+        else:
+            writer.close()
+            return
+
+
+async def echo_session(port, username, commands, stats):
+    user_prompt = f"{username}> ".encode("ascii")
+    try:
+        start = time.perf_counter()
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        await reader.readuntil(b"Username: ")
+        stats.setup_times.append(time.perf_counter() - start)
+
+        writer.write(username.encode("ascii") + b"\r\n")
+        await reader.readuntil(b"Password: ")
+        writer.write(b"pw" + username[-1:].encode("ascii") + b"\r\n")
+        await reader.readuntil(user_prompt)
+
+        for i in range(commands):
+            sent = time.perf_counter()
+            writer.write(f"command {i}\r\n".encode("ascii"))
+            await reader.readuntil(user_prompt)
+            stats.echo_times.append(time.perf_counter() - sent)
+
+        writer.write(b"quit\r\n")
+        await reader.readuntil(b"Goodbye!\r\n")
+        writer.close()
+    except (OSError, asyncio.IncompleteReadError) as e:
+        logger.debug("session failed", extra={"user": username, "error": e})
+        stats.errors += 1
+
+
+class EchoStats:
+    def __init__(self, clients):
+        self.clients = clients
+        self.setup_times = []
+        self.echo_times = []
+        self.errors = 0
+        self.elapsed = None
+
+    def connections_per_sec(self):
+        if not self.setup_times:
+            return 0
+        return len(self.setup_times) / max(self.setup_times)
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+    return ordered[index]
+
+
+def print_report(loop, stats):
+    def ms(seconds):
+        return f"{seconds * 1000:.2f}ms"
+
+    print(f"loop:             {loop}")
+    print(f"clients:          {stats.clients}")
+    print(f"errors:           {stats.errors}")
+    print(f"elapsed:          {stats.elapsed:.3f}s")
+    print(f"connections/sec:  {stats.connections_per_sec():.1f}")
+    print(
+        f"setup:            p50 {ms(percentile(stats.setup_times, 50))}"
+        f" p99 {ms(percentile(stats.setup_times, 99))}"
+    )
+    print(
+        f"input-to-echo:    p50 {ms(percentile(stats.echo_times, 50))}"
+        f" p99 {ms(percentile(stats.echo_times, 99))}"
+    )
+
+
+@subcommand(
+    argument(
+        "--connections",
+        type=int,
+        default=10000,
+        help="registered connections (default: %(default)s)",
+    ),
+    argument(
+        "--messages",
+        type=int,
+        default=100,
+        help="messages broadcast to all of them (default: %(default)s)",
+    ),
+)
+def benchmark_broadcast(connections, messages):
+    # Fan out to in-process terminals over null transports: there's no
+    # need for 10k sockets to measure what it costs us to get the bytes as
+    # far as the transport.
+    from redclay.registry import ConnectionRegistry
+    from redclay.server import Connection
+    from redclay.terminal import Terminal
+
+    logging.getLogger().setLevel(logging.WARNING)
+    registry = ConnectionRegistry()
+    writers = []
+    for i in range(connections):
+        writer = NullWriter()
+        writers.append(writer)
+        conn = Connection(Terminal(None, writer))
+        registry.add(conn)
+        conn._set_context(username=f"user{i}", tag="cmdloop")
+
+    text = 'Somebody shouts, "Is anybody out there?"\n'
+
+    start = time.perf_counter()
+    for _ in range(messages):
+        for conn in registry.by_tag("cmdloop"):
+            conn.term._write(text)
+    each_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(messages):
+        registry.broadcast(text, recipients=registry.by_tag("cmdloop"))
+    broadcast_elapsed = time.perf_counter() - start
+
+    def us(seconds):
+        return f"{seconds / messages * 1e6:.0f}us"
+
+    print(f"connections:      {connections}")
+    print(f"messages:         {messages}")
+    print(f"bytes written:    {sum(writer.written for writer in writers)}")
+    print(f"encode each:      {us(each_elapsed)} per message")
+    print(f"encode once:      {us(broadcast_elapsed)} per message")
+
+
+@subcommand(
+    argument(
+        "--prefixes",
+        type=int,
+        default=100000,
+        help="ban rules, a fifth of them IPv6 (default: %(default)s)",
+    ),
+    argument(
+        "--lookups",
+        type=int,
+        default=200000,
+        help="addresses to check, half of them in some rule (default: %(default)s)",
+    ),
+)
+def benchmark_access_list(prefixes, lookups):
+    # The check each new connection gets, against an access list about as
+    # big as anyone's. A linear scan, for comparison, only gets a sample.
+    import ipaddress
+    import random
+    import tempfile
+    from redclay.access import AccessList
+
+    logging.getLogger().setLevel(logging.WARNING)
+    rng = random.Random(0)
+    networks = []
+    for _ in range(prefixes):
+        if rng.random() < 0.8:
+            length = rng.randint(12, 32)
+            network = ipaddress.IPv4Network((rng.getrandbits(32), length), False)
+        else:
+            length = rng.randint(24, 64)
+            network = ipaddress.IPv6Network((rng.getrandbits(128), length), False)
+        networks.append(network)
+    hosts = []
+    for _ in range(lookups):
+        if rng.random() < 0.5:
+            network = rng.choice(networks)
+            address = network[rng.randrange(min(network.num_addresses, 2 ** 32))]
+        elif rng.random() < 0.8:
+            address = ipaddress.IPv4Address(rng.getrandbits(32))
+        else:
+            address = ipaddress.IPv6Address(rng.getrandbits(128))
+        hosts.append(str(address))
+
+    with tempfile.NamedTemporaryFile("w", suffix=".rules") as f:
+        f.writelines(f"ban {network}\n" for network in networks)
+        f.flush()
+        start = time.perf_counter()
+        access_list = AccessList(f.name)
+        load_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    banned = sum(access_list.banned(host) for host in hosts)
+    trie_elapsed = time.perf_counter() - start
+
+    sample = hosts[: max(1, lookups // 1000)]
+    start = time.perf_counter()
+    for host in sample:
+        address = ipaddress.ip_address(host)
+        any(address in network for network in networks)
+    linear_elapsed = time.perf_counter() - start
+
+    print(f"prefixes:         {len(access_list)}")
+    print(f"load:             {load_elapsed:.2f}s")
+    print(f"lookups:          {lookups} ({banned} banned)")
+    print(f"trie:             {lookups / trie_elapsed:.0f} lookups/sec")
+    print(f"linear scan:      {len(sample) / linear_elapsed:.1f} lookups/sec")
+
+
+class NullWriter:
+    def __init__(self):
+        self.transport = self
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def get_write_buffer_size(self):
+        return 0
+
+
+@subcommand(
+    argument(
+        "--connections",
+        type=int,
+        default=1000,
+        help="idle connections to open (default: %(default)s)",
+    ),
+    argument(
+        "--top",
+        type=int,
+        default=15,
+        help="allocation sites to list (default: %(default)s)",
+    ),
+    argument(
+        "--frames",
+        type=int,
+        default=25,
+        help="stack frames tracemalloc keeps per allocation (default: %(default)s)",
+    ),
+)
+def benchmark_memory(connections, top, frames):
+    # How much an idle player costs us: open connections over in-memory
+    # transports and weigh them, first waiting for a username and then
+    # logged in, waiting for a command.
+    logging.getLogger().setLevel(logging.WARNING)
+    stages = loops.run(run_memory_benchmark(connections, frames))
+
+    from redclay.memory import format_allocations
+
+    print(f"connections:      {connections}")
+    for stage in stages:
+        per = stage.total / connections
+        print(f"at {stage.prompt + ':':17s} {per:.0f} B per connection")
+    for stage in stages:
+        print()
+        print(f"per connection at {stage.prompt}, by code:")
+        print("\n".join(format_allocations(stage.by_code, top, per=connections)))
+        print(f"per connection at {stage.prompt}, by line:")
+        print("\n".join(format_allocations(stage.by_line, top, per=connections)))
+
+
+MemoryStage = collections.namedtuple(
+    "MemoryStage", ["prompt", "total", "by_code", "by_line"]
+)
+
+
+async def run_memory_benchmark(connections, frames):
+    from redclay.game import boot
+    from redclay.memory import SourceIndex, allocations_by
+    from redclay.server import ServerConfig
+
+    conn_server = ServerConfig().connection_server()
+    registry = conn_server.connections
+    index = SourceIndex()
+    stages = []
+
+    gc.collect()
+    tracemalloc.start(frames)
+    try:
+        baseline = tracemalloc.take_snapshot()
+        transports = []
+        tasks = []
+        for i in range(connections):
+            reader, writer = open_memory_connection(("10.0.0.1", i))
+            transports.append(writer.transport)
+            tasks.append(
+                asyncio.ensure_future(
+                    conn_server.handle_connection(boot, reader, writer)
+                )
+            )
+
+        async def weigh(prompt, tag):
+            while len(registry.by_tag(tag)) < connections:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.1)  # let the last of them settle at a read
+            gc.collect()
+            snapshot = tracemalloc.take_snapshot()
+            total = sum(
+                stat.size_diff for stat in snapshot.compare_to(baseline, "filename")
+            )
+            stages.append(
+                MemoryStage(
+                    prompt,
+                    total,
+                    allocations_by(snapshot, "code", baseline, index),
+                    allocations_by(snapshot, "line", baseline, index),
+                )
+            )
+
+        await weigh("UsernamePrompt", "auth")
+        for i, transport in enumerate(transports):
+            username = f"player{i}"
+            transport.feed(f"{username}\r\npw{username[-1]}\r\n".encode("ascii"))
+        await weigh("CommandPrompt", "cmdloop")
+    finally:
+        tracemalloc.stop()
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return stages
+
+
+def open_memory_connection(peername=None):
+    # A StreamReader and StreamWriter pair like asyncio.open_connection()'s,
+    # with nothing underneath: feed the transport what the peer sends.
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader(loop=loop)
+    protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+    transport = MemoryTransport(protocol, peername)
+    protocol.connection_made(transport)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
+
+class MemoryTransport(asyncio.Transport):
+    # Counts what's written rather than keeping it.
+    def __init__(self, protocol, peername=None):
+        super().__init__({"peername": peername, "socket": MemorySocket()})
+        self.protocol = protocol
+        self.written = 0
+        self.reading = True
+        self.closing = False
+
+    def feed(self, data):
+        self.protocol.data_received(data)
+
+    def write(self, data):
+        self.written += len(data)
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def get_write_buffer_limits(self):
+        return (0, 0)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+    def is_reading(self):
+        return self.reading
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            asyncio.get_event_loop().call_soon(self.protocol.connection_lost, None)
+
+
+class MemorySocket:
+    def fileno(self):
+        return -1
+
+    def setsockopt(self, level, option, value):
+        pass
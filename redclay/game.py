@@ -2,8 +2,13 @@ import logging
 import re
 import textwrap
 
+from redclay.metrics import METRICS
+from redclay.presence import PRESENCE
+
 logger = logging.getLogger(__name__)
 
+LOGINS = METRICS.counter("redclay_logins_total", "Login attempts", ["result"])
+
 BANNER = textwrap.dedent(
     """\
     Welcome to redclay, a Georgia MUD.
@@ -12,6 +17,14 @@ BANNER = textwrap.dedent(
 )
 MAX_TRIES = 3
 
+ZONES = {
+    "plaza": "The town plaza, where every road begins.",
+    "market": "Stalls and awnings crowd the market square.",
+    "harbor": "Gulls wheel over the creaking piers of the harbor.",
+    "woods": "Pines close in overhead. The town is out of sight.",
+}
+START_ZONE = "plaza"
+
 
 async def boot(conn):
     await conn.send_message(BANNER)
@@ -50,16 +63,31 @@ class PasswordPrompt:
         Welcome, {user}.
         """
     )
+    WELCOME_BACK = textwrap.dedent(
+        """\
+
+        Welcome back, {user}. You were linkdead.
+        """
+    )
 
     async def handle_input(self, conn, password):
         username = conn["username"]
         if password and username[-1] == password[-1]:
             logger.info("successful login", extra={"user": username})
+            LOGINS.inc("success")
             await conn.pop(username=username)
+            PRESENCE.arrive(conn)
+            if await conn.reattach():
+                logger.info("reattached linkdead session", extra={"user": username})
+                await conn.replay_scrollback()
+                await conn.send_message(self.WELCOME_BACK.format(user=username))
+                return
             await conn.send_message(self.WELCOME.format(user=username))
             await conn.push(tag="cmdloop", prompt=CommandPrompt())
+            await conn.enter_zone(START_ZONE)
         else:
             logger.info("failed login", extra={"user": username})
+            LOGINS.inc("failure")
             await conn.send_message("Login failed.\n\n")
             await fail_actions(conn)
 
@@ -71,12 +99,108 @@ class CommandPrompt:
         """
     )
 
+    COMMANDS = {"quit", "who", "shout", "tell", "look", "go", "say"}
+
     def prompt(self, conn):
         return f"{conn['username']}> "
 
+    def command_name(self, line):
+        # for metrics: anything that isn't a command is echoed
+        command = line.partition(" ")[0]
+        return command if command in self.COMMANDS else "echo"
+
     async def handle_input(self, conn, line):
-        if line == "quit":
+        command, _, rest = line.partition(" ")
+        if command == "quit":
+            PRESENCE.depart(conn)
             await conn.send_message(self.GOODBYE)
             await conn.stop()
+        elif command == "who":
+            await self.who(conn)
+        elif command == "shout" and rest.strip():
+            await self.shout(conn, rest.strip())
+        elif command == "tell":
+            await self.tell(conn, rest.strip())
+        elif command == "look":
+            await self.look(conn)
+        elif command == "go":
+            await self.go(conn, rest.strip())
+        elif command == "say" and rest.strip():
+            await self.say(conn, rest.strip())
         elif line:
             await conn.send_message(line + "\n")
+
+    async def who(self, conn):
+        # Everyone on every node.
+        usernames = await PRESENCE.online()
+        await conn.send_message(f"{len(usernames)} online: {', '.join(usernames)}\n")
+
+    async def shout(self, conn, message):
+        username = conn["username"]
+        text = f'\n{username} shouts, "{message}"\n'
+        await conn.send_message(f'You shout, "{message}"\n')
+        if conn.registry is not None:
+            conn.registry.broadcast(
+                text, recipients=conn.registry.by_tag("cmdloop"), exclude=conn
+            )
+        # Every zone hears it, wherever it's run.
+        PRESENCE.publish("shout", text=text)
+
+    async def tell(self, conn, rest):
+        target, _, message = rest.partition(" ")
+        message = message.strip()
+        if not message:
+            await conn.send_message("Tell whom what?\n")
+            return
+        if target not in await PRESENCE.online():
+            await conn.send_message(f"{target} isn't online.\n")
+            return
+        text = f'\n{conn["username"]} tells you, "{message}"\n'
+        if not hear_tell(conn.registry, target, text):
+            PRESENCE.send(target, "tell", user=target, text=text)
+        await conn.send_message(f'You tell {target}, "{message}"\n')
+
+    async def look(self, conn):
+        zone = conn["zone"] or START_ZONE
+        others = []
+        if conn.registry is not None:
+            others = sorted(
+                other["username"]
+                for other in conn.registry.by_zone(zone)
+                if other is not conn
+            )
+        here = f"Here: {', '.join(others)}.\n" if others else ""
+        await conn.send_message(f"{ZONES[zone]}\n{here}")
+
+    async def go(self, conn, zone):
+        if zone not in ZONES:
+            await conn.send_message(f"Go where? ({', '.join(ZONES)})\n")
+        elif zone == conn["zone"]:
+            await conn.send_message(f"You're already in the {zone}.\n")
+        else:
+            await conn.send_message(f"You head for the {zone}.\n")
+            await conn.enter_zone(zone)
+
+    async def say(self, conn, message):
+        # Everyone in a zone is on its shard.
+        username = conn["username"]
+        await conn.send_message(f'You say, "{message}"\n')
+        if conn.registry is not None:
+            conn.registry.broadcast(
+                f'\n{username} says, "{message}"\n',
+                recipients=conn.registry.by_zone(conn["zone"]),
+                exclude=conn,
+            )
+
+
+@PRESENCE.handler("shout")
+def hear_shout(registry, text):
+    registry.broadcast(text, recipients=registry.by_tag("cmdloop"))
+
+
+@PRESENCE.handler("tell")
+def hear_tell(registry, user, text):
+    if registry is None:
+        return 0
+    recipients = [conn for conn in registry.by_username(user) if conn.logged_in]
+    return registry.broadcast(text, recipients=recipients)
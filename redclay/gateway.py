@@ -0,0 +1,541 @@
+import asyncio
+import collections
+import enum
+import itertools
+import json
+import logging
+import struct
+import time
+
+from redclay.admission import AdmissionControl
+from redclay.handoff import bind_private_unix_socket
+from redclay.logging import logging_context
+from redclay.terminal import Terminal
+from redclay.textutil import Scrollback
+
+logger = logging.getLogger(__name__)
+
+# Splitting telnet from the game: gateway processes accept clients and do
+# all the telnet work, and game processes run every session's prompts. The
+# world's zones may be sharded over several game processes; each session is
+# on its zone's shard at any one time. Each gateway keeps a unix socket open
+# to each shard, carrying frames for all of its sessions there:
+#
+#   gateway -> game  OPEN     a client connected (peer and sock addresses)
+#   game -> gateway  INPUT    read a line, showing this prompt
+#   gateway -> game  LINE     the line read
+#   game -> gateway  TEXT     text for the client, to be stuffed and sent
+#   game -> gateway  RAW      bytes for the client, already stuffed
+#   either way       CLOSE    the session's over
+#   game -> gateway  MOVE     hand the session to another shard (shard, state)
+#   gateway -> game  RESUME   a session arriving from another shard (state)
+#
+# Frames written in the same trip round the loop go out in one write.
+# Shards talk to each other through the presence hub, not the gateways.
+
+
+class FrameType(enum.IntEnum):
+    OPEN = 1
+    INPUT = 2
+    LINE = 3
+    TEXT = 4
+    RAW = 5
+    CLOSE = 6
+    MOVE = 7
+    RESUME = 8
+
+
+Frame = collections.namedtuple("Frame", ["type", "session", "payload"])
+
+# type, session id, payload length
+FRAME_HEADER = struct.Struct("!BII")
+# INPUT payloads start with flags
+INPUT_SECRET = 0x01
+
+
+def encode_session(peername, sockname, state=None):
+    session = {"peer": peername, "sock": sockname}
+    if state is not None:
+        session["state"] = state
+    return json.dumps(session).encode("utf-8")
+
+
+def decode_session(payload):
+    session = json.loads(payload.decode("utf-8"))
+    # JSON turns address tuples into lists.
+    peer, sock = (
+        tuple(address) if address else None
+        for address in (session["peer"], session["sock"])
+    )
+    return peer, sock, session.get("state")
+
+
+class FrameWriter:
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending = []
+        self.flushing = None
+
+    def send(self, type, session, payload=b""):
+        self.pending.append(FRAME_HEADER.pack(type, session, len(payload)))
+        self.pending.append(payload)
+        if self.flushing is None:
+            self.flushing = asyncio.get_event_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.flushing = None
+        if self.writer.is_closing():
+            self.pending.clear()
+            return
+        data, self.pending = b"".join(self.pending), []
+        self.writer.write(data)
+
+    def backlog(self):
+        return self.writer.transport.get_write_buffer_size()
+
+    async def drain(self):
+        await self.writer.drain()
+
+
+class FrameDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        # Returns the frames data finishes, keeping any partial one for next
+        # time.
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            type, session, length = FRAME_HEADER.unpack_from(self.buffer, offset)
+            start = offset + FRAME_HEADER.size
+            end = start + length
+            if end > len(self.buffer):
+                break
+            frames.append(
+                Frame(FrameType(type), session, bytes(self.buffer[start:end]))
+            )
+            offset = end
+        del self.buffer[:offset]
+        return frames
+
+
+async def read_frames(reader, read_size):
+    # Yields batches of frames until the other end hangs up.
+    decoder = FrameDecoder()
+    while True:
+        data = await reader.read(read_size)
+        if not data:
+            return
+        yield decoder.feed(data)
+
+
+#
+# the gateway process
+#
+
+
+class Gateway:
+    # Terminates telnet for this process's clients, relaying their lines to
+    # the shard running their zone and its output back to them. links are
+    # (reader, writer) pairs, one per shard, in shard order. Admission is
+    # ours too: refused clients never cost a Terminal, or the game anything.
+    READ_SIZE = 2 ** 16
+    LOST_MESSAGE = "\nThe game server has gone away. Goodbye!\n"
+
+    def __init__(self, links, terminal_options=None, admission=None):
+        self.readers = [reader for reader, _ in links]
+        self.links = [FrameWriter(writer) for _, writer in links]
+        self.terminal_options = terminal_options or {}
+        self.admission = admission or AdmissionControl()
+        self.sessions = {}
+        self.session_ids = itertools.count(1)
+
+    async def handle_connection(self, reader, writer):
+        peername = writer.get_extra_info("peername")
+        refusal = self.admission.admit(peername, len(self.sessions))
+        if refusal:
+            logger.info(
+                "refusing connection",
+                extra={"peer": peername, "reason": refusal.name.lower()},
+            )
+            writer.write(refusal.value)
+            writer.close()
+            return
+        try:
+            await self.serve_connection(reader, writer)
+        finally:
+            self.admission.remove(peername)
+
+    async def serve_connection(self, reader, writer):
+        session = GatewaySession(next(self.session_ids))
+        # Log in on any shard; the game moves the player on from there.
+        session.shard = session.id % len(self.links)
+        async with Terminal(reader, writer, **self.terminal_options) as term:
+            with logging_context(term=id(term), session=session.id):
+                session.term = term
+                self.sessions[session.id] = session
+                addresses = encode_session(
+                    writer.get_extra_info("peername"), writer.get_extra_info("sockname")
+                )
+                self.links[session.shard].send(FrameType.OPEN, session.id, addresses)
+                try:
+                    await session.done
+                finally:
+                    del self.sessions[session.id]
+                    session.stop_reading()
+
+    async def serve(self):
+        # Relay the shards' frames until any of them hangs up, then hang up
+        # on everyone. Raises EOFError then.
+        relaying = [
+            asyncio.ensure_future(self.serve_link(shard, reader))
+            for shard, reader in enumerate(self.readers)
+        ]
+        try:
+            await asyncio.wait(relaying, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in relaying:
+                task.cancel()
+            await asyncio.wait(relaying)
+            for session in list(self.sessions.values()):
+                await session.term.write(self.LOST_MESSAGE, record=False)
+                session.finish()
+        raise EOFError("game server closed the connection")
+
+    async def serve_link(self, shard, reader):
+        async for frames in read_frames(reader, self.READ_SIZE):
+            for frame in frames:
+                session = self.sessions.get(frame.session)
+                if session is None or session.shard != shard:
+                    # e.g. output for a session whose peer just left
+                    continue
+                handle = getattr(self, "frame_" + frame.type.name)
+                await handle(session, frame.payload)
+
+    async def frame_INPUT(self, session, payload):
+        flags, prompt = payload[0], payload[1:].decode("utf-8")
+        session.stop_reading()
+        session.reading = asyncio.ensure_future(
+            self.read_line(session, prompt, flags & INPUT_SECRET)
+        )
+
+    async def frame_TEXT(self, session, payload):
+        await session.term.write(payload.decode("utf-8"), record=False)
+
+    async def frame_RAW(self, session, payload):
+        session.term.write_encoded(payload, record=False)
+
+    async def frame_CLOSE(self, session, payload):
+        session.finish()
+
+    async def frame_MOVE(self, session, payload):
+        # Anything the client sends from here on is for the new shard, once
+        # it asks.
+        session.stop_reading()
+        session.shard = payload[0]
+        self.links[session.shard].send(FrameType.RESUME, session.id, payload[1:])
+
+    async def read_line(self, session, prompt, secret):
+        term = session.term
+        get_input = term.input_secret if secret else term.input
+        with logging_context(term=id(term), session=session.id):
+            try:
+                line = await get_input(prompt)
+            except (EOFError, ConnectionError):
+                logger.info("connection closed by peer")
+                self.links[session.shard].send(FrameType.CLOSE, session.id)
+                session.finish()
+            else:
+                link = self.links[session.shard]
+                link.send(FrameType.LINE, session.id, line.encode("utf-8"))
+
+
+class GatewaySession:
+    def __init__(self, id):
+        self.id = id
+        self.shard = 0
+        self.term = None
+        self.reading = None
+        self.done = asyncio.get_event_loop().create_future()
+
+    def stop_reading(self):
+        if self.reading is not None:
+            self.reading.cancel()
+            self.reading = None
+
+    def finish(self):
+        if not self.done.done():
+            self.done.set_result(None)
+
+
+async def connect_to_game(path, timeout=10, interval=0.1):
+    # The game may still be starting up.
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return await asyncio.open_unix_connection(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.monotonic() >= deadline:
+                raise
+            await asyncio.sleep(interval)
+
+
+#
+# the game process
+#
+
+
+async def start_gateway_listener(path, conn_server, boot):
+    # An asyncio Server like start_server()'s, but for gateways, which
+    # bring their clients along. conn_server handles each client with a
+    # (reader, writer) stand-in, as it would a local one. Gateways speak
+    # for any player they like, so only ours get to connect.
+
+    async def serve_gateway(reader, writer):
+        logger.info("gateway connected")
+        await GatewayLink(reader, writer, conn_server, boot).serve()
+        logger.info("gateway disconnected")
+
+    return await asyncio.start_unix_server(
+        serve_gateway, sock=bind_private_unix_socket(path)
+    )
+
+
+class GatewayLink:
+    # The game's end of one gateway's socket.
+    READ_SIZE = 2 ** 16
+
+    def __init__(self, reader, writer, conn_server, boot):
+        self.reader = reader
+        self.frames = FrameWriter(writer)
+        self.conn_server = conn_server
+        self.boot = boot
+        self.sessions = {}
+
+    async def serve(self):
+        try:
+            async for frames in read_frames(self.reader, self.READ_SIZE):
+                for frame in frames:
+                    handle = getattr(self, "frame_" + frame.type.name)
+                    handle(frame.session, frame.payload)
+        finally:
+            # Everyone on this gateway is gone.
+            for session in list(self.sessions.values()):
+                session.lost()
+
+    def add_session(self, session_id, peer, sock, serve):
+        session = RemoteSession(self, session_id, peer, sock)
+        self.sessions[session_id] = session
+        task = asyncio.ensure_future(serve(session))
+        task.add_done_callback(lambda _: self.sessions.pop(session_id, None))
+
+    def frame_OPEN(self, session_id, payload):
+        peer, sock, _ = decode_session(payload)
+
+        def serve(session):
+            return self.conn_server.handle_connection(self.boot, session, session)
+
+        self.add_session(session_id, peer, sock, serve)
+
+    def frame_RESUME(self, session_id, payload):
+        peer, sock, state = decode_session(payload)
+
+        def serve(session):
+            return self.conn_server.resume_session(state, session, session)
+
+        self.add_session(session_id, peer, sock, serve)
+
+    def frame_LINE(self, session_id, payload):
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.receive_line(payload.decode("utf-8"))
+
+    def frame_CLOSE(self, session_id, payload):
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.lost()
+
+
+class RemoteSession:
+    # A gateway's client, as seen from the game. It stands in for the
+    # reader and writer of a local connection.
+    def __init__(self, link, id, peername, sockname):
+        self.link = link
+        self.id = id
+        self.extra = {"peername": peername, "sockname": sockname}
+        self.lines = collections.deque()
+        self.waiter = None
+        self.closed = False
+        self.line_arrived_at = None
+
+    def get_extra_info(self, name, default=None):
+        return self.extra.get(name, default)
+
+    def send(self, type, payload=b""):
+        if not self.closed:
+            self.link.frames.send(type, self.id, payload)
+
+    # from the gateway
+
+    def receive_line(self, line):
+        self.line_arrived_at = time.perf_counter()
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(line)
+        else:
+            self.lines.append(line)
+
+    def lost(self):
+        self.closed = True
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_exception(EOFError())
+
+    async def read_line(self, prompt, secret=False):
+        if self.lines:
+            return self.lines.popleft()
+        if self.closed:
+            raise EOFError()
+        flags = INPUT_SECRET if secret else 0
+        self.send(FrameType.INPUT, bytes([flags]) + prompt.encode("utf-8"))
+        self.waiter = asyncio.get_event_loop().create_future()
+        try:
+            return await self.waiter
+        finally:
+            self.waiter = None
+
+    # as a writer
+
+    def write(self, data):
+        self.send(FrameType.RAW, data)
+
+    def close(self):
+        self.send(FrameType.CLOSE)
+        self.closed = True
+
+    def move(self, shard, state):
+        # Over to the gateway, to pass on. We're done with the client.
+        payload = encode_session(self.extra["peername"], self.extra["sockname"], state)
+        self.send(FrameType.MOVE, bytes([shard]) + payload)
+        self.closed = True
+
+
+class TextEncoder:
+    # What the game sends gateways is just text. Broadcasts still encode it
+    # once for every recipient.
+    def stuff(self, update):
+        return update.data.encode("utf-8")
+
+
+class RemoteTerminal:
+    # Stands in for a Terminal in the game process, for a client on the far
+    # side of a gateway. Telnet options (read size, input limits, line
+    # length) are the gateway's business.
+    def __init__(self, reader, writer, scrollback_size=4096, **telnet_options):
+        self.session = writer
+        self.writer = writer
+        self.encoder = TextEncoder()
+        self.scrollback = Scrollback(scrollback_size)
+        self.connected_at = time.perf_counter()
+        self.last_read_at = None
+        self.detached = False
+        self.trace = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        # Detached, it's been handed off to another shard, and that shard's
+        # to say when the client's done.
+        if not self.detached:
+            self.session.close()
+
+    async def sleep(self, secs, timers=None):
+        await self.session.link.frames.drain()
+        if timers is None:
+            await asyncio.sleep(secs)
+        else:
+            await timers.sleep(secs)
+
+    async def write(self, texts, drain=False, record=True):
+        if texts is None:
+            texts = []
+        if not isinstance(texts, list):
+            texts = [texts]
+
+        for text in texts:
+            self.write_encoded(text.encode("utf-8"), record)
+        if drain:
+            await self.session.link.frames.drain()
+
+    def write_encoded(self, data, record=True):
+        if self.detached:
+            return
+        self.session.send(FrameType.TEXT, data)
+        if record:
+            self.scrollback.append(data)
+
+    def wire_format(self):
+        return type(self.encoder)
+
+    def output_backlog(self):
+        # All of this gateway's clients share the one socket.
+        return self.session.link.frames.backlog()
+
+    def input_backlog(self):
+        return sum(len(line) for line in self.session.lines)
+
+    def idle_time(self):
+        last_active = self.last_read_at or self.connected_at
+        return time.perf_counter() - last_active
+
+    async def flush(self):
+        await self.session.link.frames.drain()
+
+    async def flush_response(self):
+        trace = self.trace
+        start = trace and time.perf_counter()
+        await self.session.link.frames.drain()
+        if trace:
+            trace.add("drain", start)
+        arrived, self.session.line_arrived_at = self.session.line_arrived_at, None
+        if arrived is not None:
+            return time.perf_counter() - arrived
+
+    def detach(self):
+        self.detached = True
+
+    async def take_unread(self):
+        # The gateway's Terminal keeps unread input, and sends lines one at
+        # a time as they're asked for.
+        pass
+
+    async def move(self, shard, state, sock=None):
+        # As Migrating's send(), to hand off to another shard.
+        self.session.move(shard, state)
+
+    def dump_state(self):
+        return {"scrollback": self.scrollback.getvalue().decode("latin-1")}
+
+    def load_state(self, state):
+        self.scrollback.append(state["scrollback"].encode("latin-1"))
+
+    def scrollback_text(self):
+        data = self.scrollback.getvalue()
+        if self.scrollback.full:
+            data = data[data.find(b"\n") + 1 :]
+        return data.decode("utf-8", errors="replace")
+
+    async def input(self, prompt):
+        return await self._input_line(prompt)
+
+    async def input_secret(self, prompt):
+        return await self._input_line(prompt, secret=True)
+
+    async def _input_line(self, prompt, secret=False):
+        line = await self.session.read_line(prompt, secret)
+        self.last_read_at = time.perf_counter()
+        return line
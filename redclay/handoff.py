@@ -0,0 +1,204 @@
+import array
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+
+logger = logging.getLogger(__name__)
+
+# A restart hands everything over from the old server process to the new
+# one across a unix socket:
+#
+#   new -> old  takeover
+#   old -> new  listeners (+ listening socket fds)
+#   old -> new  connection (+ client socket fd), once per live connection
+#   old -> new  done
+#
+# The old process stops accepting as soon as it's sent its listeners, and
+# exits once its connections have all been handed over or have finished on
+# their own.
+
+MAX_FDS = 32
+
+
+class Channel:
+    # Length-prefixed JSON messages, each optionally carrying file
+    # descriptors as SCM_RIGHTS ancillary data. The socket is blocking, so
+    # all I/O happens in the default executor, one message at a time.
+    HEADER = struct.Struct("!I")
+
+    def __init__(self, sock):
+        sock.setblocking(True)
+        self.sock = sock
+        self.lock = asyncio.Lock()
+
+    def close(self):
+        self.sock.close()
+
+    async def send(self, message, fds=()):
+        loop = asyncio.get_event_loop()
+        async with self.lock:
+            await loop.run_in_executor(None, self.send_sync, message, fds)
+
+    async def receive(self):
+        loop = asyncio.get_event_loop()
+        async with self.lock:
+            return await loop.run_in_executor(None, self.receive_sync)
+
+    def send_sync(self, message, fds=()):
+        body = json.dumps(message).encode("utf-8")
+        data = self.HEADER.pack(len(body)) + body
+        ancdata = []
+        if fds:
+            ancdata.append(
+                (socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))
+            )
+        sent = self.sock.sendmsg([data], ancdata)
+        self.sock.sendall(data[sent:])
+
+    def receive_sync(self):
+        # Ancillary data arrives with the first bytes of the message it was
+        # sent with, i.e. with the header.
+        fd_size = array.array("i").itemsize
+        header, ancdata, flags, _ = self.sock.recvmsg(
+            self.HEADER.size, socket.CMSG_SPACE(MAX_FDS * fd_size)
+        )
+        if not header:
+            raise EOFError()
+
+        fds = array.array("i")
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[: len(data) - (len(data) % fd_size)])
+
+        header += self.receive_exactly(self.HEADER.size - len(header))
+        (length,) = self.HEADER.unpack(header)
+        body = self.receive_exactly(length)
+        return json.loads(body.decode("utf-8")), list(fds)
+
+    def receive_exactly(self, count):
+        chunks = []
+        while count:
+            chunk = self.sock.recv(count)
+            if not chunk:
+                raise EOFError()
+            chunks.append(chunk)
+            count -= len(chunk)
+        return b"".join(chunks)
+
+
+class HandoffListener:
+    # Runs in the old process, waiting for a new one to take over.
+    def __init__(self, path, conn_server, io_servers):
+        self.path = path
+        self.conn_server = conn_server
+        self.io_servers = io_servers
+
+    async def serve(self):
+        loop = asyncio.get_event_loop()
+        listener = bind_unix_socket(self.path)
+        logger.info("waiting for takeover", extra={"path": self.path})
+        try:
+            sock, _ = await loop.sock_accept(listener)
+        finally:
+            listener.close()
+            remove_stale_socket(self.path)
+
+        channel = Channel(sock)
+        try:
+            await self.hand_off(channel)
+        finally:
+            channel.close()
+
+    async def hand_off(self, channel):
+        request, _ = await channel.receive()
+        if request.get("type") != "takeover":
+            logger.warning("unexpected handoff request", extra={"request": request})
+            return
+
+        listeners = [sock for server in self.io_servers for sock in server.sockets]
+        await channel.send(
+            {"type": "listeners", "addresses": [s.getsockname() for s in listeners]},
+            [sock.fileno() for sock in listeners],
+        )
+        logger.info("handed off listeners, no longer accepting")
+        self.conn_server.draining = True
+        for server in self.io_servers:
+            server.close()
+
+        migrated = await self.conn_server.migrate_all(
+            lambda state, sock: self.send_connection(channel, state, sock)
+        )
+        parked = self.conn_server.dump_linkdead()
+        for session in parked:
+            await channel.send({"type": "linkdead", "session": session})
+        await channel.send({"type": "done"})
+        logger.info(
+            "handoff complete", extra={"migrated": migrated, "linkdead": len(parked)}
+        )
+
+    async def send_connection(self, channel, state, sock):
+        await channel.send({"type": "connection", "state": state}, [sock.fileno()])
+
+
+async def take_over(path):
+    # Runs in the new process. Returns the channel, which will deliver the
+    # old process's connections, and the listening sockets.
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    channel = Channel(sock)
+
+    await channel.send({"type": "takeover"})
+    message, fds = await channel.receive()
+    if message.get("type") != "listeners":
+        raise RuntimeError(f"unexpected handoff message: {message!r}")
+
+    listeners = [socket.socket(fileno=fd) for fd in fds]
+    logger.info("took over listeners", extra={"addresses": message["addresses"]})
+    return channel, listeners
+
+
+async def receive_connections(channel, conn_server):
+    try:
+        while True:
+            message, fds = await channel.receive()
+            if message.get("type") == "done":
+                break
+            if message.get("type") == "linkdead":
+                conn_server.load_linkdead(message["session"])
+                continue
+            sock = socket.socket(fileno=fds[0])
+            asyncio.ensure_future(conn_server.resume_connection(message["state"], sock))
+    finally:
+        channel.close()
+
+
+def bind_unix_socket(path):
+    # Whoever connects gets every socket we have.
+    listener = bind_private_unix_socket(path)
+    listener.listen(1)
+    listener.setblocking(False)
+    return listener
+
+
+def bind_private_unix_socket(path):
+    # For a socket that lets whoever connects run things. It's bound under
+    # a umask that keeps it to our user from the start: chmod()ing it after
+    # would leave a moment when anyone could connect.
+    remove_stale_socket(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+    return sock
+
+
+def remove_stale_socket(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,268 @@
+import asyncio
+import collections
+import itertools
+import logging
+import time
+
+from redclay import loops
+from redclay.game import ZONES
+from redclay.benchmark import percentile
+from redclay.shell_command import address, argument, subcommand
+from redclay.telnet import OPTIONS, StreamParser, StreamStuffer, Tokenizer
+
+logger = logging.getLogger(__name__)
+
+# What each scripted player types once they're logged in, round robin.
+# Nothing that fans out to other players: that would make the load grow
+# with the square of the number of clients.
+SCRIPT = ["look", "who", "hello there", "inventory"]
+
+
+@subcommand(
+    loops.loop_argument(),
+    argument(
+        "--server",
+        type=address,
+        default=("127.0.0.1", 6666),
+        metavar="[HOST]:PORT",
+        help="server to load (default: 127.0.0.1:6666)",
+    ),
+    argument(
+        "--clients",
+        type=int,
+        default=100,
+        help="concurrent client sessions (default: %(default)s)",
+    ),
+    argument(
+        "--ramp",
+        type=float,
+        default=50,
+        help="new sessions started per second (default: %(default)s)",
+    ),
+    argument(
+        "--commands",
+        type=int,
+        default=20,
+        help="commands each session sends before quitting (default: %(default)s)",
+    ),
+    argument(
+        "--think-time",
+        type=float,
+        default=0,
+        help="seconds each session waits between commands (default: %(default)s)",
+    ),
+    argument(
+        "--timeout",
+        type=float,
+        default=30,
+        help="seconds to wait for any one response (default: %(default)s)",
+    ),
+    argument(
+        "--spread",
+        action="store_true",
+        help=(
+            "send sessions round the zones once they've logged in, so they "
+            "load every shard (default: all in the starting zone)"
+        ),
+    ),
+)
+def loadtest(loop, server, clients, ramp, commands, think_time, timeout, spread):
+    host, port = server
+    stats = loops.run(
+        run_load(host, port, clients, ramp, commands, think_time, timeout, spread),
+        loop,
+    )
+    print_report(stats)
+
+
+async def run_load(
+    host, port, clients, ramp, commands, think_time, timeout, spread=False
+):
+    stats = LoadStats(clients)
+    start = time.perf_counter()
+    zones = itertools.cycle(ZONES)
+
+    sessions = []
+    for i in range(clients):
+        zone = next(zones) if spread else None
+        session = ScriptedSession(host, port, f"load{i}", commands, think_time, zone)
+        sessions.append(asyncio.ensure_future(session.run(stats, timeout)))
+        if ramp:
+            await asyncio.sleep(1 / ramp)
+    await asyncio.gather(*sessions)
+
+    stats.elapsed = time.perf_counter() - start
+    return stats
+
+
+class TelnetClient:
+    # The client end of a telnet session, speaking just enough of the
+    # protocol to keep a redclay server happy: let it echo (or not) when
+    # it asks, answer timing marks, and refuse everything else.
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.tokenizer = Tokenizer()
+        self.parser = StreamParser()
+        self.stuffer = StreamStuffer()
+        self.text = ""
+        self.peer_options = set()
+
+    async def read_until(self, marker):
+        while marker not in self.text:
+            data = await self.reader.read(4096)
+            if not data:
+                raise EOFError(self.text)
+            updates = self.parser.stream_updates(self.tokenizer.tokens(data))
+            for update in updates:
+                self.handle_update(update)
+
+        before, _, self.text = self.text.partition(marker)
+        return before + marker
+
+    def send_line(self, line):
+        data = self.stuffer.stuff(StreamParser.UserData(line + "\n"))
+        self.writer.write(data)
+
+    def send_negotiation(self, negotiation):
+        self.writer.write(self.stuffer.stuff(negotiation))
+
+    def handle_update(self, update):
+        handler = getattr(self, "update_" + update.__class__.__name__, None)
+        if handler:
+            handler(update)
+
+    def update_UserData(self, update):
+        self.text += update.data
+
+    def update_OptionNegotiation(self, negotiation):
+        handler = getattr(self, "negotiate_" + negotiation.host.name)
+        handler(negotiation)
+
+    def negotiate_PEER(self, negotiation):
+        # The server offering to do (or stop doing) something itself.
+        option = negotiation.option
+        if option == OPTIONS.ECHO:
+            if negotiation.state != (option in self.peer_options):
+                self.peer_options.symmetric_difference_update({option})
+                self.send_negotiation(negotiation.accept())
+        elif negotiation.state:
+            self.send_negotiation(negotiation.refuse())
+
+    def negotiate_LOCAL(self, negotiation):
+        # The server asking us to do (or stop doing) something.
+        if negotiation.option == OPTIONS.TM and negotiation.state:
+            self.send_negotiation(negotiation.accept())
+        elif negotiation.state:
+            self.send_negotiation(negotiation.refuse())
+
+
+class ScriptedSession:
+    def __init__(self, host, port, username, commands, think_time, zone=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.commands = commands
+        self.think_time = think_time
+        self.zone = zone
+
+    async def run(self, stats, timeout):
+        stage = "connect"
+        writer = None
+        try:
+            start = time.perf_counter()
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), timeout
+            )
+            stats.connected()
+            client = TelnetClient(reader, writer)
+
+            async def expect(marker):
+                return await asyncio.wait_for(client.read_until(marker), timeout)
+
+            stage = "banner"
+            await expect("Username: ")
+            stats.setup_times.append(time.perf_counter() - start)
+
+            stage = "login"
+            client.send_line(self.username)
+            await expect("Password: ")
+            client.send_line("pw" + self.username[-1])
+            prompt = f"{self.username}> "
+            await expect(prompt)
+            stats.login_times.append(time.perf_counter() - start)
+
+            if self.zone:
+                stage = "move"
+                client.send_line(f"go {self.zone}")
+                await expect(prompt)
+
+            stage = "command"
+            script = itertools.cycle(SCRIPT)
+            for _ in range(self.commands):
+                if self.think_time:
+                    await asyncio.sleep(self.think_time)
+                sent = time.perf_counter()
+                client.send_line(next(script))
+                await expect(prompt)
+                stats.command_times.append(time.perf_counter() - sent)
+
+            stage = "quit"
+            client.send_line("quit")
+            await expect("Goodbye!\n")
+            stats.completed += 1
+        except asyncio.TimeoutError:
+            stats.errors[f"{stage} timeout"] += 1
+        except EOFError as e:
+            # Closed before we saw a prompt, most likely refused at the door.
+            kind = "refused" if stage == "banner" else f"{stage} closed"
+            stats.errors[kind] += 1
+            logger.debug("session closed", extra={"user": self.username, "text": e})
+        except OSError as e:
+            stats.errors[f"{stage} {e.__class__.__name__}"] += 1
+        finally:
+            if writer:
+                stats.disconnected()
+                writer.close()
+
+
+class LoadStats:
+    def __init__(self, clients):
+        self.clients = clients
+        self.setup_times = []
+        self.login_times = []
+        self.command_times = []
+        self.errors = collections.Counter()
+        self.completed = 0
+        self.concurrent = 0
+        self.peak_concurrent = 0
+        self.elapsed = None
+
+    def connected(self):
+        self.concurrent += 1
+        self.peak_concurrent = max(self.peak_concurrent, self.concurrent)
+
+    def disconnected(self):
+        self.concurrent -= 1
+
+
+def print_report(stats):
+    def ms(seconds):
+        return f"{seconds * 1000:.2f}ms"
+
+    def distribution(values):
+        return " ".join(
+            f"p{pct} {ms(percentile(values, pct))}" for pct in (50, 90, 99)
+        ) + (f" max {ms(max(values))}" if values else "")
+
+    print(f"clients:          {stats.clients}")
+    print(f"completed:        {stats.completed}")
+    print(f"peak concurrent:  {stats.peak_concurrent}")
+    print(f"elapsed:          {stats.elapsed:.3f}s")
+    print(f"commands/sec:     {len(stats.command_times) / stats.elapsed:.1f}")
+    print(f"setup:            {distribution(stats.setup_times)}")
+    print(f"login:            {distribution(stats.login_times)}")
+    print(f"command rtt:      {distribution(stats.command_times)}")
+    print(f"errors:           {sum(stats.errors.values())}")
+    for kind, count in sorted(stats.errors.items()):
+        print(f"  {kind}: {count}")
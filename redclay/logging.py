@@ -4,8 +4,12 @@ import logging
 import re
 import time
 import traceback
+import weakref
 
 LOGGING_CONTEXT = contextvars.ContextVar(__name__ + ".LOGGING_CONTEXT")
+# Each task's innermost logging context, for other threads (i.e. the
+# watchdog) that can't see the loop thread's context variables.
+TASK_CONTEXTS = weakref.WeakKeyDictionary()
 
 
 def init_logging():
@@ -53,6 +57,8 @@ class Formatter(logging.Formatter):
         exc_text = (
             "\n" + self.format_exception(record.exc_info) if record.exc_info else ""
         )
+        if record.stack_info:
+            exc_text += "\n" + record.stack_info
         return base + (" | " + context if context else "") + exc_text
 
     def format_exception(self, exc_info):
@@ -70,10 +76,20 @@ def logging_context(**kwargs):
     new_cx.update(kwargs)
 
     token = LOGGING_CONTEXT.set(new_cx)
+    task = current_task()
+    if task is not None:
+        task_cx = TASK_CONTEXTS.get(task)
+        TASK_CONTEXTS[task] = new_cx
     try:
         yield
     finally:
         LOGGING_CONTEXT.reset(token)
+        if task is None:
+            pass
+        elif task_cx is None:
+            TASK_CONTEXTS.pop(task, None)
+        else:
+            TASK_CONTEXTS[task] = task_cx
 
 
 def get_logging_context():
@@ -81,3 +97,14 @@ def get_logging_context():
         return LOGGING_CONTEXT.get()
     except LookupError:
         return {}
+
+
+def current_task():
+    # Imported late: loggers made before init_logging(), like asyncio's
+    # would be, don't put our context in their records.
+    import asyncio
+
+    try:
+        return asyncio.current_task()
+    except RuntimeError:  # no running loop
+        return None
@@ -0,0 +1,53 @@
+import asyncio
+import importlib
+
+from redclay.shell_command import argument
+
+LOOP_BACKENDS = ["asyncio", "uvloop"]
+
+
+def loop_argument():
+    return argument(
+        "--loop",
+        choices=LOOP_BACKENDS,
+        default="asyncio",
+        help="event loop implementation (default: %(default)s)",
+    )
+
+
+def run(main, backend="asyncio"):
+    install_loop_policy(backend)
+    return asyncio.run(main)
+
+
+def install_loop_policy(backend):
+    installer = globals()["install_" + backend]
+    installer()
+
+
+def install_asyncio():
+    asyncio.set_event_loop_policy(None)
+
+
+def install_uvloop():
+    # uvloop is an optional extra, so only import it if it's asked for.
+    try:
+        uvloop = importlib.import_module("uvloop")
+    except ImportError as e:
+        raise ImportError(
+            "the uvloop event loop requires the uvloop package "
+            "(pipenv run pip install uvloop)"
+        ) from e
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def install_virtual():
+    # Not one of LOOP_BACKENDS: it's for simulations and tests, not servers.
+    from redclay.virtualtime import VirtualTimeLoopPolicy
+
+    asyncio.set_event_loop_policy(VirtualTimeLoopPolicy())
+
+
+def loop_name(loop=None):
+    loop = loop or asyncio.get_event_loop()
+    return type(loop).__module__.partition(".")[0]
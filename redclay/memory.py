@@ -0,0 +1,128 @@
+import collections
+import functools
+import inspect
+import linecache
+import os
+import sys
+import tracemalloc
+
+# Attributing tracemalloc's numbers to our own code. Each allocation is
+# charged to the innermost of its frames that's in redclay, and from there
+# to the function or class around that line: allocations inside asyncio on
+# behalf of a Terminal still count against the Terminal.
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+Allocation = collections.namedtuple("Allocation", ["where", "size", "count"])
+
+
+def allocations_by(snapshot, key, baseline=None, index=None):
+    # Totals keyed by "line" (file:line) or "code" (qualified name), largest
+    # first. With a baseline, just what's grown since.
+    index = index or SourceIndex()
+    if baseline is None:
+        stats = (
+            (stat.traceback, stat.size, stat.count)
+            for stat in snapshot.statistics("traceback")
+        )
+    else:
+        stats = (
+            (stat.traceback, stat.size_diff, stat.count_diff)
+            for stat in snapshot.compare_to(baseline, "traceback")
+        )
+
+    sizes = collections.Counter()
+    counts = collections.Counter()
+    for traceback, size, count in stats:
+        frame = innermost_own_frame(traceback)
+        if frame is None:
+            where = "(elsewhere)"
+        elif key == "line":
+            source = linecache.getline(frame.filename, frame.lineno).strip()
+            module = os.path.relpath(os.path.abspath(frame.filename), PACKAGE_DIR)
+            where = f"{module}:{frame.lineno}  {source}"
+        else:
+            where = index.owner(os.path.abspath(frame.filename), frame.lineno)
+        sizes[where] += size
+        counts[where] += count
+    return [
+        Allocation(where, size, counts[where]) for where, size in sizes.most_common()
+    ]
+
+
+def innermost_own_frame(traceback):
+    # tracemalloc tracebacks are most recent call last.
+    for frame in reversed(traceback):
+        if is_own_file(frame.filename):
+            return frame
+
+
+@functools.lru_cache(maxsize=None)
+def is_own_file(filename):
+    return os.path.abspath(filename).startswith(PACKAGE_DIR + os.sep)
+
+
+class SourceIndex:
+    # Maps source lines in loaded redclay modules to the innermost function
+    # or class defined around them.
+    def __init__(self):
+        self.ranges = collections.defaultdict(list)
+        for name, module in list(sys.modules.items()):
+            if name == "redclay" or name.startswith("redclay."):
+                self.add_members(module, module.__name__, "")
+
+    def add_members(self, namespace, module_name, prefix):
+        for name, obj in list(vars(namespace).items()):
+            obj = getattr(obj, "__func__", obj)  # static and class methods
+            if not (inspect.isfunction(obj) or inspect.isclass(obj)):
+                continue
+            if obj.__module__ != module_name:
+                continue
+            try:
+                lines, start = inspect.getsourcelines(obj)
+                filename = os.path.abspath(inspect.getsourcefile(obj))
+            except (OSError, TypeError):
+                continue
+            qualname = prefix + name
+            self.ranges[filename].append((start, start + len(lines) - 1, qualname))
+            if inspect.isclass(obj):
+                self.add_members(obj, module_name, qualname + ".")
+
+    def owner(self, filename, lineno):
+        candidates = [
+            (end - start, qualname)
+            for start, end, qualname in self.ranges.get(filename, [])
+            if start <= lineno <= end
+        ]
+        if candidates:
+            return min(candidates)[1]
+        module = os.path.relpath(filename, PACKAGE_DIR)
+        return f"{module} (module)"
+
+
+def format_allocations(allocations, limit, per=1):
+    lines = []
+    for allocation in allocations[:limit]:
+        lines.append(f"{allocation.size / per:>10.0f} B  {allocation.where}")
+    return lines
+
+
+def report(limit=20, connections=None):
+    # A snapshot of the live process. Slow, so off the loop if you can.
+    if not tracemalloc.is_tracing():
+        return ["tracemalloc is not tracing; try 'memory start'"]
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"traced:           {current} B (peak {peak} B)"]
+    if connections:
+        lines.append(f"per connection:   {current / connections:.0f} B (upper bound)")
+    index = SourceIndex()
+    lines.append("by code:")
+    lines.extend(
+        format_allocations(allocations_by(snapshot, "code", index=index), limit)
+    )
+    lines.append("by line:")
+    lines.extend(
+        format_allocations(allocations_by(snapshot, "line", index=index), limit)
+    )
+    return lines
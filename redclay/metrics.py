@@ -0,0 +1,245 @@
+import array
+import asyncio
+import bisect
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Process-wide metrics in the Prometheus text format. Everything runs on
+# the event loop thread, so updates are plain dict arithmetic: no locks.
+
+
+class Metric:
+    TYPE = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = collections.defaultdict(int)
+        if not labels:
+            self.values[()] = 0
+
+    def samples(self):
+        return list(self.values.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        for label_values, value in sorted(self.samples(), key=sample_key):
+            lines.append(
+                f"{self.name}{format_labels(self.labels, label_values)} {value}"
+            )
+        return lines
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] += amount
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] += amount
+
+    def dec(self, *label_values, amount=1):
+        self.values[label_values] -= amount
+
+
+class CallbackGauge(Gauge):
+    # A gauge computed when scraped, for things we can count more cheaply
+    # on demand than keep up to date. function returns {label_values: value}.
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return []
+        return list(self.function().items())
+
+
+# upper bounds, in seconds
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+
+class Histogram(Metric):
+    # Fixed buckets. Each label set gets its counts allocated once, the
+    # first time it's seen, and observations just bump numbers in place.
+    TYPE = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = HistogramSeries(len(self.buckets))
+        series.counts[bisect.bisect_left(self.buckets, value)] += 1
+        series.total[0] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        for label_values, series in sorted(self.samples(), key=sample_key):
+            cumulative = 0
+            for bound, count in zip(bounds, series.counts):
+                cumulative += count
+                labels = format_labels(self.labels + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {series.total[0]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def quantile(self, q, *label_values):
+        # Estimated as the upper bound of the bucket the quantile falls in.
+        series = self.values.get(label_values)
+        if series is None:
+            return None
+        return series.quantile(q, self.buckets)
+
+
+class HistogramSeries:
+    __slots__ = ["counts", "total"]
+
+    def __init__(self, size):
+        # one count per bucket, plus one for everything over the top
+        self.counts = array.array("Q", bytes(8 * (size + 1)))
+        self.total = array.array("d", [0.0])
+
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q, buckets):
+        target = q * self.count()
+        seen = 0
+        for bound, count in zip(buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        # Registering a name again replaces it, e.g. for a callback bound to
+        # a new server.
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def callback_gauge(self, name, help, labels=(), function=None):
+        return self.register(CallbackGauge(name, help, labels, function))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+
+def sample_key(sample):
+    label_values, _ = sample
+    return tuple(str(value) for value in label_values)
+
+
+def format_labels(labels, label_values):
+    if not labels:
+        return ""
+    pairs = (
+        f'{label}="{escape_label(value)}"' for label, value in zip(labels, label_values)
+    )
+    return "{" + ",".join(pairs) + "}"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+METRICS = MetricsRegistry()
+
+
+# serving
+
+
+class MetricsServer:
+    # Just enough HTTP to be scraped: read a request, ignore its headers,
+    # send the metrics, hang up.
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+    REQUEST_TIMEOUT = 5
+
+    def __init__(self, registry=METRICS):
+        self.registry = registry
+
+    async def handle_request(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(
+                reader.readuntil(b"\r\n\r\n"), self.REQUEST_TIMEOUT
+            )
+            method, path, _ = request.split(b" ", 2)
+            if method != b"GET":
+                self.respond(writer, "405 Method Not Allowed", "")
+            elif path.split(b"?")[0] not in (b"/", b"/metrics"):
+                self.respond(writer, "404 Not Found", "")
+            else:
+                self.respond(writer, "200 OK", self.registry.render())
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            logger.debug("bad metrics request", exc_info=True)
+        finally:
+            writer.close()
+
+    def respond(self, writer, status, body):
+        body = body.encode("utf-8")
+        headers = (
+            f"HTTP/1.0 {status}\r\n"
+            f"Content-Type: {self.CONTENT_TYPE}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "\r\n"
+        )
+        writer.write(headers.encode("ascii") + body)
+
+
+async def start_metrics_server(host, port, registry=METRICS, reuse_port=None):
+    server = await asyncio.start_server(
+        MetricsServer(registry).handle_request, host, port, reuse_port=reuse_port
+    )
+    logger.info("serving metrics", extra={"host": host, "port": port})
+    return server
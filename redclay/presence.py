@@ -0,0 +1,427 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import socket
+import time
+
+from redclay.handoff import bind_private_unix_socket
+from redclay.metrics import METRICS
+from redclay.shell_command import argument, subcommand
+
+logger = logging.getLogger(__name__)
+
+# The longest line either end of a hub connection will read. A directory
+# is one line, at a few dozen bytes a user.
+LINE_LIMIT = 2 ** 24
+
+BATCHES = METRICS.counter(
+    "redclay_presence_batches_total", "Batches of messages sent to the presence hub"
+)
+MESSAGES = METRICS.counter(
+    "redclay_presence_messages_total",
+    "Messages sent to the presence hub, by kind",
+    ["kind"],
+)
+DIRECTORY_READS = METRICS.counter(
+    "redclay_presence_directory_reads_total",
+    "Reads of the presence directory, by whether the local copy was fresh",
+    ["cache"],
+)
+
+
+class Presence:
+    # Who's online on every node (each game process is one), and messages
+    # between nodes, through a backend: a PresenceHub in this process, or
+    # one on a unix socket.
+    #
+    # What we send goes out in batches, at most one per FLUSH_INTERVAL.
+    # Reads of the directory come from a local copy, dropped whenever
+    # another node announces anything, and fetched again when next needed.
+    FLUSH_INTERVAL = 0.05
+
+    def __init__(self):
+        self.node = None
+        self.backend = None
+        self.registry = None
+        # the usernames we've announced as here
+        self.here = set()
+        self.pending = []
+        self.flush_handle = None
+        self.directory = None
+        self.handlers = {}
+
+    async def configure(self, registry, backend=None, node=None):
+        # Not before: worker processes are forked from their supervisor.
+        self.node = node or f"{socket.gethostname()}:{os.getpid()}"
+        self.registry = registry
+        self.backend = backend or LocalBackend()
+        self.directory = None
+        await self.backend.connect(self.node, self.receive, self.rejoin)
+        if self.here:
+            # e.g. players who arrived before we had a backend
+            self.backend.send(self.announcements())
+
+    async def close(self):
+        self.flush()
+        backend, self.backend = self.backend, None
+        self.registry = None
+        if backend is not None:
+            await backend.close()
+
+    # presence
+
+    def arrive(self, conn):
+        if conn.registry is not None:
+            self.refresh(conn["username"], conn.registry)
+
+    def depart(self, conn):
+        # Before conn leaves the registry, or on its way out of the game.
+        if conn.registry is not None and conn["username"]:
+            self.refresh(conn["username"], conn.registry, leaving=conn)
+
+    def refresh(self, username, registry, leaving=None):
+        # Announce whether username is here, if that's changed. Players
+        # who are linkdead are still here until their session expires.
+        here = username in registry.linkdead or any(
+            conn.logged_in
+            for conn in registry.by_username(username)
+            if conn is not leaving
+        )
+        if here == (username in self.here):
+            return
+        if here:
+            self.here.add(username)
+        else:
+            self.here.discard(username)
+        if self.directory is not None:
+            nodes = set(self.directory.get(username, ()))
+            if here:
+                nodes.add(self.node)
+            else:
+                nodes.discard(self.node)
+            if nodes:
+                self.directory[username] = sorted(nodes)
+            else:
+                self.directory.pop(username, None)
+        self.queue(
+            {"kind": "presence", "user": username, "node": self.node, "here": here}
+        )
+
+    async def online(self):
+        if self.backend is None:
+            return sorted(self.here)
+        if self.directory is None:
+            DIRECTORY_READS.inc("miss")
+            # The hub has to hear our own news before we ask it.
+            self.flush()
+            try:
+                self.directory = await self.backend.read_directory()
+            except EOFError:
+                # Lost the hub: until it's back, we only know who's here.
+                return sorted(self.here)
+        else:
+            DIRECTORY_READS.inc("hit")
+        return sorted(self.directory)
+
+    def announcements(self):
+        return [
+            {"kind": "presence", "user": username, "node": self.node, "here": True}
+            for username in sorted(self.here)
+        ]
+
+    def rejoin(self):
+        # The backend had to reconnect to its hub, which may have forgotten
+        # us. Everything we knew about anyone else is suspect too.
+        self.directory = None
+        return self.announcements()
+
+    # messages
+
+    def handler(self, kind):
+        def register(handle):
+            self.handlers[kind] = handle
+            return handle
+
+        return register
+
+    def publish(self, kind, **message):
+        # To every other node.
+        self.queue(dict(message, kind=kind))
+
+    def send(self, username, kind, **message):
+        # To whichever other nodes username is on.
+        self.queue(dict(message, kind=kind, to=username))
+
+    def queue(self, message):
+        if self.backend is None:
+            return
+        MESSAGES.inc(message["kind"])
+        self.pending.append(message)
+        if self.flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self.flush_handle = loop.call_later(self.FLUSH_INTERVAL, self.flush)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.pending and self.backend is not None:
+            BATCHES.inc()
+            self.backend.send(self.pending)
+        self.pending = []
+
+    def receive(self, batch):
+        for message in batch:
+            kind = message["kind"]
+            if kind == "presence":
+                self.directory = None
+                continue
+            handle = self.handlers.get(kind)
+            if handle is None:
+                logger.warning("unhandled presence message", extra={"kind": kind})
+                continue
+            arguments = {
+                key: value
+                for key, value in message.items()
+                if key not in ("kind", "to")
+            }
+            handle(self.registry, **arguments)
+
+
+class PresenceHub:
+    # The directory itself: the nodes each username is on. Nodes send the
+    # hub batches of messages. It keeps the directory up to date from them,
+    # and passes each message on to the nodes it's for, a batch at a time.
+    def __init__(self):
+        self.nodes = {}
+        self.directory = collections.defaultdict(set)
+
+    def join(self, node, deliver):
+        if node in self.nodes:
+            self.leave(node)
+        self.nodes[node] = deliver
+
+    def leave(self, node):
+        # Everyone who was there is gone.
+        if self.nodes.pop(node, None) is None:
+            return
+        departures = [
+            {"kind": "presence", "user": username, "node": node, "here": False}
+            for username, nodes in list(self.directory.items())
+            if node in nodes
+        ]
+        self.receive(node, departures)
+
+    def receive(self, node, batch):
+        outgoing = collections.defaultdict(list)
+        for message in batch:
+            if message["kind"] == "presence":
+                self.update(message)
+            if "to" in message:
+                recipients = self.directory.get(message["to"], ())
+            else:
+                recipients = self.nodes
+            for recipient in recipients:
+                if recipient != node:
+                    outgoing[recipient].append(message)
+        for recipient, messages in outgoing.items():
+            deliver = self.nodes.get(recipient)
+            if deliver is not None:
+                deliver(messages)
+
+    def update(self, message):
+        username, node = message["user"], message["node"]
+        if message["here"]:
+            self.directory[username].add(node)
+            return
+        nodes = self.directory.get(username)
+        if nodes is not None:
+            nodes.discard(node)
+            if not nodes:
+                del self.directory[username]
+
+    def snapshot(self):
+        return {username: sorted(nodes) for username, nodes in self.directory.items()}
+
+
+# backends
+
+
+class LocalBackend:
+    # A hub in this process. Alone, it's a directory of one node; shared,
+    # it stands in for a real hub, e.g. in tests.
+    def __init__(self, hub=None):
+        self.hub = hub or PresenceHub()
+        self.node = None
+
+    async def connect(self, node, deliver, rejoin):
+        # Delivered later, as they would be from anywhere else.
+        loop = asyncio.get_event_loop()
+        self.node = node
+        self.hub.join(node, lambda batch: loop.call_soon(deliver, batch))
+
+    def send(self, batch):
+        self.hub.receive(self.node, batch)
+
+    async def read_directory(self):
+        return self.hub.snapshot()
+
+    async def close(self):
+        self.hub.leave(self.node)
+
+
+class UnixSocketBackend:
+    # A hub in another process: see start_presence_hub(). Each line is a
+    # JSON message: a list is a batch, an object is the directory, or asks
+    # for it. If we lose the hub, we keep trying to get it back, and tell
+    # it again who's here when we do. A hub that's too slow with the
+    # directory counts as lost, for that read.
+    RECONNECT_INTERVAL = 1
+    DIRECTORY_TIMEOUT = 5
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+        self.reading = None
+        self.directory_reads = collections.deque()
+
+    async def connect(self, node, deliver, rejoin):
+        reader = await self.open(node)
+        self.reading = asyncio.ensure_future(self.read(reader, node, deliver, rejoin))
+
+    async def open(self, node, timeout=10):
+        reader, self.writer = await connect_to_hub(self.path, timeout)
+        self.write({"node": node})
+        return reader
+
+    async def read(self, reader, node, deliver, rejoin):
+        while True:
+            await self.read_hub(reader, deliver)
+            logger.warning("lost the presence hub", extra={"path": self.path})
+            self.writer.close()
+            self.writer = None
+            while self.directory_reads:
+                read = self.directory_reads.popleft()
+                if not read.done():
+                    read.set_exception(EOFError())
+            reader = await self.reopen(node)
+            self.send(rejoin())
+            logger.info("rejoined the presence hub", extra={"path": self.path})
+
+    async def read_hub(self, reader, deliver):
+        try:
+            async for line in reader:
+                message = json.loads(line.decode("utf-8"))
+                if isinstance(message, list):
+                    deliver(message)
+                else:
+                    read = self.directory_reads.popleft()
+                    # unless the reader gave up on it
+                    if not read.done():
+                        read.set_result(message["directory"])
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except ValueError:
+            # e.g. past LINE_LIMIT: we can't find our place again without
+            # starting over.
+            logger.exception("bad line from the presence hub")
+
+    async def reopen(self, node):
+        while True:
+            await asyncio.sleep(self.RECONNECT_INTERVAL)
+            try:
+                return await self.open(node, timeout=0)
+            except OSError:
+                pass
+
+    def send(self, batch):
+        if self.writer is not None and batch:
+            self.write(batch)
+
+    async def read_directory(self):
+        if self.writer is None:
+            raise EOFError("no presence hub")
+        read = asyncio.get_event_loop().create_future()
+        self.directory_reads.append(read)
+        self.write({"directory": None})
+        try:
+            return await asyncio.wait_for(read, self.DIRECTORY_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise EOFError("presence hub timed out") from None
+
+    def write(self, message):
+        self.writer.write(json.dumps(message).encode("utf-8") + b"\n")
+
+    async def close(self):
+        if self.reading is not None:
+            self.reading.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def connect_to_hub(path, timeout=10, interval=0.1):
+    # The hub may still be starting up.
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return await asyncio.open_unix_connection(path, limit=LINE_LIMIT)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.monotonic() >= deadline:
+                raise
+            await asyncio.sleep(interval)
+
+
+async def start_presence_hub(path, hub=None):
+    hub = hub or PresenceHub()
+
+    async def handle(reader, writer):
+        def deliver(batch):
+            writer.write(json.dumps(batch).encode("utf-8") + b"\n")
+
+        hello = json.loads((await reader.readline()).decode("utf-8"))
+        node = hello["node"]
+        hub.join(node, deliver)
+        logger.info("node joined", extra={"node": node})
+        try:
+            async for line in reader:
+                message = json.loads(line.decode("utf-8"))
+                if isinstance(message, list):
+                    hub.receive(node, message)
+                else:
+                    reply = {"directory": hub.snapshot()}
+                    writer.write(json.dumps(reply).encode("utf-8") + b"\n")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except ValueError:
+            # Past LINE_LIMIT. The node will reconnect and start over.
+            logger.exception("bad line from node", extra={"node": node})
+        finally:
+            # unless it's already rejoined
+            if hub.nodes.get(node) is deliver:
+                hub.leave(node)
+            logger.info("node left", extra={"node": node})
+            writer.close()
+
+    server = await asyncio.start_unix_server(
+        handle, sock=bind_private_unix_socket(path), limit=LINE_LIMIT
+    )
+    logger.info("presence hub listening", extra={"path": path})
+    return server
+
+
+@subcommand(argument("socket", help="unix socket for nodes' --presence-socket"))
+def presence_hub(socket):
+    # For nodes started separately. With --workers or --shards, the first
+    # process serves one for the rest.
+    asyncio.run(run_presence_hub(socket))
+
+
+async def run_presence_hub(path):
+    server = await start_presence_hub(path)
+    async with server:
+        await server.serve_forever()
+
+
+PRESENCE = Presence()
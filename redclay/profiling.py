@@ -0,0 +1,149 @@
+import asyncio
+import cProfile
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+from redclay.logging import TASK_CONTEXTS
+
+logger = logging.getLogger(__name__)
+
+
+class Profiling:
+    # Profiles on demand, for a window or until stopped, on the loop it was
+    # started from. Each profile goes to a file of its own in directory.
+    def __init__(self, profiler="sampling", directory=".", window=30):
+        self.profiler_type = PROFILERS[profiler]
+        self.directory = directory
+        self.window = window
+        self.running = None
+        self.timer = None
+        self.writing = set()
+
+    def install(self, signum=signal.SIGUSR2):
+        asyncio.get_event_loop().add_signal_handler(signum, self.start, self.window)
+
+    def uninstall(self, signum=signal.SIGUSR2):
+        asyncio.get_event_loop().remove_signal_handler(signum)
+
+    def start(self, window=None):
+        if self.running is not None:
+            logger.info("already profiling")
+            return
+        self.running = self.profiler_type()
+        self.running.start()
+        if window:
+            loop = asyncio.get_event_loop()
+            self.timer = loop.call_later(window, self.stop)
+        logger.info(
+            "profiling", extra={"profiler": self.profiler_type.NAME, "window": window}
+        )
+
+    def stop(self):
+        if self.running is None:
+            return
+        profiler, self.running = self.running, None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        profiler.stop()
+
+        stamp = time.strftime("%Y%m%dT%H%M%S")
+        filename = f"redclay-{os.getpid()}-{stamp}{profiler.EXTENSION}"
+        path = os.path.join(self.directory, filename)
+        writing = asyncio.get_event_loop().run_in_executor(None, profiler.write, path)
+        self.writing.add(writing)
+        writing.add_done_callback(self.writing.discard)
+        logger.info("writing profile", extra={"path": path})
+        return writing
+
+    async def close(self):
+        self.stop()
+        if self.writing:
+            await asyncio.wait(self.writing)
+
+
+class DeterministicProfiler:
+    # cProfile, for pstats and the tools that read it (snakeviz, gprof2dot).
+    # Every call on the loop thread pays for it while it runs.
+    NAME = "cprofile"
+    EXTENSION = ".pstats"
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, path):
+        self.profile.dump_stats(path)
+
+
+class SamplingProfiler:
+    # A helper thread looks at what the loop thread is running every
+    # interval. Cheap enough to leave on, and it knows which connection's
+    # task it caught running, which cProfile can't tell us. Writes
+    # collapsed stacks, one "root;caller;...;callee count" per line, for
+    # flamegraph.pl or speedscope. Each stack's root is the connection's
+    # terminal id (as in the logs), or "loop" outside any connection.
+    NAME = "sampling"
+    EXTENSION = ".folded"
+    INTERVAL = 0.005
+
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.loop = None
+        self.loop_thread = None
+        self.samples = collections.Counter()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        # Call from the loop thread.
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread = threading.get_ident()
+        self.thread = threading.Thread(
+            target=self.run, name="redclay-profiler", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.loop_thread)
+        if frame is None:
+            return
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+            frame = frame.f_back
+
+        task = asyncio.current_task(self.loop)
+        context = TASK_CONTEXTS.get(task, {}) if task is not None else {}
+        term = context.get("term")
+        stack.append(f"conn-{term}" if term is not None else "loop")
+        self.samples[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f"{stack} {count}\n")
+
+
+PROFILERS = {
+    profiler.NAME: profiler for profiler in [SamplingProfiler, DeterministicProfiler]
+}
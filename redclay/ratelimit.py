@@ -0,0 +1,63 @@
+import asyncio
+import collections
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, clock=None):
+        self.rate = rate
+        self.burst = burst
+        # Keep time with the event loop, virtual or not: the one we're
+        # created on, not whichever is current when we're next used.
+        self.clock = clock or asyncio.get_event_loop().time
+
+        self.tokens = burst
+        self.updated = self.clock()
+
+    def refill(self):
+        now = self.clock()
+        elapsed = now - self.updated
+        self.updated = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+
+    def consume(self, amount):
+        # Take amount tokens from the bucket, returning how many seconds the
+        # caller should wait before the bucket is back out of debt. We allow
+        # the bucket to go negative so that a single large read is charged
+        # in full rather than being refused outright.
+        self.refill()
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def try_consume(self, amount=1):
+        # Take amount tokens only if they're there, without going into debt.
+        self.refill()
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+
+class InputLimits(
+    collections.namedtuple(
+        "_InputLimits", ["bytes_per_sec", "bytes_burst", "lines_per_sec", "lines_burst"]
+    )
+):
+    # Defaults are generous enough that no human typist (or reasonable paste)
+    # will notice them. They're here to keep a single flooding peer from
+    # monopolizing the event loop.
+    def __new__(
+        cls, bytes_per_sec=16384, bytes_burst=65536, lines_per_sec=20, lines_burst=100
+    ):
+        return super().__new__(
+            cls, bytes_per_sec, bytes_burst, lines_per_sec, lines_burst
+        )
+
+    def byte_bucket(self):
+        if self.bytes_per_sec:
+            return TokenBucket(self.bytes_per_sec, self.bytes_burst)
+
+    def line_bucket(self):
+        if self.lines_per_sec:
+            return TokenBucket(self.lines_per_sec, self.lines_burst)
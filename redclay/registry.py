@@ -0,0 +1,175 @@
+import asyncio
+import collections
+import logging
+
+from redclay.metrics import METRICS
+from redclay.presence import PRESENCE
+from redclay.telnet import StreamParser
+
+logger = logging.getLogger(__name__)
+
+SKIPPED_BROADCASTS = METRICS.counter(
+    "redclay_broadcasts_skipped_total",
+    "Broadcast messages not sent to a connection with too much output backlog",
+)
+
+
+LinkdeadSession = collections.namedtuple(
+    "LinkdeadSession", ["context_stack", "scrollback", "timer", "expires"]
+)
+
+
+class ConnectionRegistry:
+    # Every live Connection, indexed by username, by the tag of its current
+    # context, and by the zone it's in. Connections keep their own entries
+    # up to date as their context changes.
+    #
+    # Also the sessions of players whose link dropped, for a while, in case
+    # they come back. We keep just enough to pick up where they left off:
+    # their context stack and the scrollback they'd last seen.
+    INDEXES = ["username", "tag", "zone"]
+    # Don't pile broadcasts onto a peer that isn't reading what it's
+    # already been sent.
+    BROADCAST_WATERMARK = 64 * 1024
+
+    def __init__(self, timers=None, linkdead_grace=0):
+        self.timers = timers
+        self.linkdead_grace = linkdead_grace
+        self.linkdead = {}
+        self.connections = set()
+        self.keys = {}
+        self.indexes = {name: collections.defaultdict(set) for name in self.INDEXES}
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __iter__(self):
+        return iter(self.connections)
+
+    def __contains__(self, conn):
+        return conn in self.connections
+
+    def add(self, conn):
+        self.connections.add(conn)
+        conn.registry = self
+        self.reindex(conn)
+
+    def discard(self, conn):
+        if conn not in self.connections:
+            return
+        self.connections.remove(conn)
+        conn.registry = None
+        for name, value in zip(self.INDEXES, self.keys.pop(conn)):
+            self.unindex(name, value, conn)
+
+    def reindex(self, conn):
+        old_keys = self.keys.get(conn, (None,) * len(self.INDEXES))
+        new_keys = self.keys[conn] = tuple(conn[name] for name in self.INDEXES)
+        for name, old, new in zip(self.INDEXES, old_keys, new_keys):
+            if old != new:
+                self.unindex(name, old, conn)
+                if new is not None:
+                    self.indexes[name][new].add(conn)
+
+    def unindex(self, name, value, conn):
+        index = self.indexes[name]
+        entries = index.get(value)
+        if entries is None:
+            return
+        entries.discard(conn)
+        if not entries:
+            del index[value]
+
+    # lookups
+
+    def by_username(self, username):
+        return set(self.indexes["username"].get(username, ()))
+
+    def by_tag(self, tag):
+        return set(self.indexes["tag"].get(tag, ()))
+
+    def by_zone(self, zone):
+        return set(self.indexes["zone"].get(zone, ()))
+
+    def usernames(self):
+        return sorted(self.indexes["username"])
+
+    def tag_counts(self):
+        counts = {(tag,): len(conns) for tag, conns in self.indexes["tag"].items()}
+        untagged = len(self.connections) - sum(counts.values())
+        if untagged:
+            counts[("",)] = untagged
+        return counts
+
+    # linkdead sessions
+
+    def park(self, conn):
+        if not (self.linkdead_grace and self.timers is not None and conn.logged_in):
+            return False
+
+        username = conn["username"]
+        self.hold(
+            username,
+            conn.context_stack,
+            conn.term.scrollback.getvalue(),
+            self.linkdead_grace,
+        )
+        logger.info("parked linkdead session", extra={"user": username})
+        return True
+
+    def adopt(self, username, context_stack, scrollback, grace):
+        # A session parked by another process, handed off to us with what's
+        # left of its grace.
+        self.hold(username, context_stack, scrollback, grace)
+        logger.info("adopted linkdead session", extra={"user": username})
+        PRESENCE.refresh(username, self)
+
+    def hold(self, username, context_stack, scrollback, grace):
+        self.unpark(username)
+        timer = self.timers.schedule(grace, self.expire_linkdead, username)
+        expires = asyncio.get_event_loop().time() + grace
+        self.linkdead[username] = LinkdeadSession(
+            context_stack, scrollback, timer, expires
+        )
+
+    def unpark(self, username):
+        session = self.linkdead.pop(username, None)
+        if session:
+            session.timer.cancel()
+        return session
+
+    def expire_linkdead(self, username):
+        if self.linkdead.pop(username, None):
+            logger.info("linkdead session expired", extra={"user": username})
+            PRESENCE.refresh(username, self)
+
+    # fan-out
+
+    def broadcast(self, text, recipients=None, exclude=None, watermark=None):
+        # Stuff and encode text once for each distinct wire format among the
+        # recipients, and hand the same bytes to all of them. Returns how
+        # many were sent the message.
+        if recipients is None:
+            recipients = self.connections
+        if watermark is None:
+            watermark = self.BROADCAST_WATERMARK
+        user_data = StreamParser.UserData(text)
+
+        encoded = {}
+        sent = 0
+        for conn in recipients:
+            if conn is exclude:
+                continue
+            term = conn.term
+            if term.output_backlog() > watermark:
+                SKIPPED_BROADCASTS.inc()
+                logger.debug("skipping broadcast to backlogged connection")
+                continue
+
+            wire_format = term.wire_format()
+            data = encoded.get(wire_format)
+            if data is None:
+                data = encoded[wire_format] = term.encoder.stuff(user_data)
+            term.write_encoded(data)
+            sent += 1
+        return sent
@@ -0,0 +1,100 @@
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import logging
+import socket
+
+from redclay.metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+LOOKUPS = METRICS.counter(
+    "redclay_reverse_dns_lookups_total",
+    "Reverse DNS lookups of peer addresses, by result",
+    ["result"],
+)
+
+
+class Resolver:
+    # Reverse DNS for peer addresses. getnameinfo() blocks, so it runs on a
+    # few threads of our own, where a slow nameserver can't hold up the
+    # loop or anything else using the default executor.
+    #
+    # Answers are cached for TTL seconds, and the lack of one for
+    # NEGATIVE_TTL, least recently used first out once there are
+    # cache_size of them. Nobody waits on a lookup for more than timeout
+    # seconds; the thread finishes in its own time, and its answer is
+    # still cached for next time. Lookups of the same address share a
+    # thread.
+    TTL = 3600
+    NEGATIVE_TTL = 300
+    # past this many lookups in flight, don't queue any more
+    MAX_PENDING = 1000
+
+    def __init__(self, threads=4, timeout=2, cache_size=10000, clock=None, lookup=None):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            threads, thread_name_prefix="redclay-dns"
+        )
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.clock = clock or asyncio.get_event_loop().time
+        self.lookup = lookup or reverse_lookup
+        # address -> (expiry, hostname or None), oldest use first
+        self.cache = collections.OrderedDict()
+        self.pending = {}
+
+    async def resolve(self, address):
+        # The hostname, or None if there isn't one or it's taking too long.
+        entry = self.cache.get(address)
+        if entry is not None:
+            expiry, hostname = entry
+            if expiry > self.clock():
+                LOOKUPS.inc("hit")
+                self.cache.move_to_end(address)
+                return hostname
+            del self.cache[address]
+
+        lookup = self.pending.get(address)
+        if lookup is None:
+            if len(self.pending) >= self.MAX_PENDING:
+                LOOKUPS.inc("overloaded")
+                return None
+            loop = asyncio.get_event_loop()
+            lookup = loop.run_in_executor(self.executor, self.lookup, address)
+            lookup.add_done_callback(functools.partial(self.finish, address))
+            self.pending[address] = lookup
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(lookup), self.timeout)
+        except asyncio.TimeoutError:
+            LOOKUPS.inc("timeout")
+            return None
+
+    def finish(self, address, lookup):
+        del self.pending[address]
+        if lookup.cancelled():
+            return
+        hostname = lookup.result()
+        LOOKUPS.inc("resolved" if hostname else "failed")
+        self.remember(address, hostname)
+
+    def remember(self, address, hostname):
+        ttl = self.TTL if hostname else self.NEGATIVE_TTL
+        self.cache[address] = (self.clock() + ttl, hostname)
+        self.cache.move_to_end(address)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def close(self):
+        # Don't wait on lookups nobody's waiting for.
+        self.executor.shutdown(wait=False)
+
+
+def reverse_lookup(address):
+    # On an executor thread.
+    try:
+        hostname, _ = socket.getnameinfo((address, 0), socket.NI_NAMEREQD)
+    except (OSError, UnicodeError):
+        return None
+    return hostname
@@ -1,22 +1,154 @@
 import asyncio
+import collections
 import contextlib
 import functools
+import importlib
 import logging
+import os
+import signal
+import socket
+import tempfile
+import time
+import types
 
 from redclay.game import boot
+from redclay import gateway, handoff, loops, presence
+from redclay.admin import start_admin_console
+from redclay.access import AccessList
+from redclay.admission import AdmissionControl
 from redclay.logging import logging_context
-from redclay.shell_command import subcommand
+from redclay.metrics import METRICS, start_metrics_server
+from redclay.profiling import PROFILERS, Profiling
+from redclay.presence import PRESENCE
+from redclay.ratelimit import InputLimits
+from redclay.resolver import Resolver
+from redclay.registry import ConnectionRegistry
+from redclay.shards import SHARDS
+from redclay.shell_command import BooleanFlag, address, argument, size, subcommand
 from redclay.terminal import Terminal
+from redclay.textutil import LineBuffer
+from redclay.timers import TimingWheel
+from redclay.tracing import TRACER
+from redclay.watchdog import Watchdog
+from redclay.workers import WorkerPool
 
 logger = logging.getLogger(__name__)
 
+ACCEPTS = METRICS.counter("redclay_accepts_total", "Connections admitted")
+CLOSES = METRICS.counter("redclay_closes_total", "Connections closed", ["reason"])
+CONNECTIONS = METRICS.callback_gauge(
+    "redclay_connections", "Live connections by prompt tag", ["tag"]
+)
+HANDLE_TIME = METRICS.histogram(
+    "redclay_input_handling_seconds",
+    "Time spent handling a line of input",
+    ["prompt", "command"],
+)
+RESPONSE_TIME = METRICS.histogram(
+    "redclay_response_seconds",
+    "Time from a line of input arriving to its response being flushed",
+    ["prompt", "command"],
+)
+
+
+class IdleTimeout(Exception):
+    pass
+
+
+class Kicked(Exception):
+    # Raised in a connection's task to disconnect it, with an optional
+    # message for the player.
+    pass
+
+
+class Migrating(Exception):
+    # Raised in a connection's task to hand it off to another process. send
+    # is a coroutine function taking the connection's state and socket.
+    def __init__(self, send):
+        super().__init__()
+        self.send = send
+        self.done = asyncio.get_event_loop().create_future()
+
 
 class ConnectionServer:
+    IDLE_MESSAGE = "\nIdle timeout. Goodbye!\n"
+    SHUTDOWN_MESSAGE = "\nThe server is shutting down. Goodbye!\n"
+    KICK_MESSAGE = "\nYou have been disconnected by an administrator.\n"
+
+    def __init__(
+        self,
+        terminal_options=None,
+        pre_login_idle=300,
+        post_login_idle=3600,
+        socket_options=None,
+        admission=None,
+        drain_timeout=30,
+        linkdead_grace=300,
+        connection_gauge=None,
+        terminal_class=None,
+        resolver=None,
+    ):
+        self.terminal_class = terminal_class or Terminal
+        self.terminal_options = terminal_options or {}
+        self.pre_login_idle = pre_login_idle
+        self.post_login_idle = post_login_idle
+        self.socket_options = socket_options or []
+        self.admission = admission or AdmissionControl()
+        self.drain_timeout = drain_timeout
+        self.timers = TimingWheel()
+        self.connections = ConnectionRegistry(self.timers, linkdead_grace)
+        self.draining = False
+        self.drained = None
+        # Anything with a mutable int .value, e.g. a multiprocessing.Value
+        # shared with a supervisor.
+        if connection_gauge is None:
+            connection_gauge = types.SimpleNamespace(value=0)
+        self.live_connections = connection_gauge
+        self.resolver = resolver
+
     async def handle_connection(self, boot, reader, writer):
-        async with Terminal(reader, writer) as term:
+        peername = writer.get_extra_info("peername")
+        refusal = self.admission.admit(peername, self.live_connections.value)
+        if refusal:
+            self.refuse_connection(writer, refusal)
+            return
+        ACCEPTS.inc()
+        await self.serve_connection(boot, reader, writer)
+
+    async def serve_connection(self, boot, reader, writer):
+        # For a connection we've already admitted.
+        self.live_connections.value += 1
+        try:
+            self.configure_socket(writer.get_extra_info("socket"))
+            await self._handle_connection(boot, reader, writer)
+        finally:
+            self.live_connections.value -= 1
+            self.admission.remove(writer.get_extra_info("peername"))
+
+    def refuse_connection(self, writer, refusal):
+        logger.info(
+            "refusing connection",
+            extra={
+                "peer": writer.get_extra_info("peername"),
+                "reason": refusal.name.lower(),
+            },
+        )
+        writer.write(refusal.value)
+        writer.close()
+
+    def configure_socket(self, sock):
+        configure_socket(sock, self.socket_options)
+
+    async def _handle_connection(self, boot, reader, writer):
+        async with self.terminal_class(reader, writer, **self.terminal_options) as term:
             with logging_context(term=id(term)):
+                conn = Connection(term, timers=self.timers)
+                self.connections.add(conn)
+                close_reason = "error"
                 try:
-                    fileno = writer.get_extra_info("socket").fileno()
+                    # Clients of a gateway have no socket here.
+                    sock = writer.get_extra_info("socket")
+                    fileno = sock.fileno() if sock is not None else None
                     peername = writer.get_extra_info("peername")
                     sockname = writer.get_extra_info("sockname")
 
@@ -24,26 +156,189 @@ class ConnectionServer:
                         "new connection",
                         extra={"peer": peername, "sock": sockname, "fd": fileno},
                     )
-                    conn = Connection(term)
+                    if self.resolver is not None and peername:
+                        self.look_up_host(conn, peername[0])
                     await self.run_conn(conn, boot)
                     logger.debug("shell exited normally")
-                except EOFError:
+                except Migrating as migration:
+                    close_reason = "migrated"
+                    await self.migrate(conn, writer, migration)
+                except (EOFError, ConnectionError):
+                    close_reason = "peer"
                     logger.info("connection closed by peer")
+                    self.connections.park(conn)
+                except IdleTimeout:
+                    close_reason = "idle"
+                    logger.info("closing idle connection")
+                    await term.write(self.IDLE_MESSAGE)
+                except Kicked as kick:
+                    close_reason = "kicked"
+                    logger.info("connection kicked", extra={"reason": str(kick)})
+                    messages = [self.KICK_MESSAGE]
+                    if str(kick):
+                        messages.append(f"{kick}\n")
+                    await term.write(messages)
+                except asyncio.CancelledError:
+                    close_reason = "shutdown"
+                    logger.info("connection cancelled by server shutdown")
+                    raise
                 except:
                     logger.exception("connection closing from unhandled exception")
                 else:
+                    close_reason = "normal"
                     logger.info("connection closing normally")
+                finally:
+                    CLOSES.inc(close_reason)
+                    PRESENCE.depart(conn)
+                    self.connections.discard(conn)
+                    if self.drained and not self.connections:
+                        self.drained.set_result(None)
+
+    def look_up_host(self, conn, address):
+        # In the background: the banner doesn't wait for DNS.
+        lookup = asyncio.ensure_future(self.resolver.resolve(address))
+
+        def resolved(lookup):
+            if lookup.cancelled():
+                return
+            if lookup.exception() is not None:
+                logger.warning(
+                    "could not resolve peer",
+                    extra={"address": address},
+                    exc_info=lookup.exception(),
+                )
+                return
+            host = lookup.result()
+            if host:
+                conn.host = host
+                logger.info("resolved peer", extra={"address": address, "host": host})
+
+        lookup.add_done_callback(resolved)
+
+    async def resume_connection(self, state, sock):
+        reader, writer = await asyncio.open_connection(
+            sock=sock, limit=Terminal.READER_LIMIT
+        )
+        await self.resume_session(state, reader, writer)
+
+    async def resume_session(self, state, reader, writer):
+        # Pick up a connection handed off from another process. It's already
+        # been admitted, so it's not subject to limits.
+        self.admission.add(writer.get_extra_info("peername"))
+        resume = functools.partial(Connection.load_state, state=state)
+        await self.serve_connection(resume, reader, writer)
+
+    async def migrate(self, conn, writer, migration):
+        try:
+            await conn.term.flush()
+            await conn.term.take_unread()
+            state = conn.dump_state()
+            await migration.send(state, writer.get_extra_info("socket"))
+        except Exception:
+            logger.exception("could not hand off connection")
+            migration.done.set_result(False)
+        else:
+            logger.info("handed off connection")
+            migration.done.set_result(True)
+
+    async def migrate_all(self, send):
+        # Interrupt every connection at its next wait for input and hand it
+        # off. Returns how many made it.
+        migrations = []
+        for conn in list(self.connections):
+            migration = Migrating(send)
+            conn.interrupt(migration)
+            migrations.append(migration.done)
+        if not migrations:
+            return 0
+
+        done, _ = await asyncio.wait(migrations, timeout=self.drain_timeout)
+        return sum(future.result() for future in done)
+
+    def dump_linkdead(self):
+        # Parked sessions, for a handoff, with what's left of their grace.
+        now = asyncio.get_event_loop().time()
+        return [
+            {
+                "username": username,
+                "context_stack": encode_context_value(session.context_stack),
+                "scrollback": session.scrollback.decode("latin-1"),
+                "grace": max(0, session.expires - now),
+            }
+            for username, session in self.connections.linkdead.items()
+        ]
+
+    def load_linkdead(self, state):
+        self.connections.adopt(
+            state["username"],
+            decode_context_value(state["context_stack"]),
+            state["scrollback"].encode("latin-1"),
+            state["grace"],
+        )
+
+    async def wait_drained(self):
+        # Once we've stopped accepting, give connections that didn't migrate
+        # a chance to finish on their own.
+        if not self.connections:
+            return
+        self.drained = asyncio.get_event_loop().create_future()
+        try:
+            await asyncio.wait_for(self.drained, self.drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                "drain timed out", extra={"connections": len(self.connections)}
+            )
+
+    def announce_shutdown(self):
+        sent = self.connections.broadcast(self.SHUTDOWN_MESSAGE)
+        logger.info("announced shutdown", extra={"connections": sent})
 
     async def run_conn(self, conn, boot):
         await boot(conn)
         while conn.running:
-            await self.run_prompt_once(conn)
+            with logging_context(**conn.logging_fields()):
+                await self.run_prompt_once(conn)
 
     async def run_prompt_once(self, conn):
+        trace = conn.term.trace = TRACER.trace(id(conn.term))
         prompt = conn["prompt"]
-        raw_user_input = await self.get_user_input(conn)
+        start = trace and time.perf_counter()
+        with self.idle_timeout(conn), conn.waiting_for_input():
+            raw_user_input = await self.get_user_input(conn)
+        if trace:
+            trace.add("input", start)
         processed_input = raw_user_input.strip()
+
+        prompt_name = prompt.__class__.__name__
+        command_name = getattr(prompt, "command_name", None)
+        command = command_name(processed_input) if command_name else ""
+        start = time.perf_counter()
         await prompt.handle_input(conn, processed_input)
+        end = time.perf_counter()
+        HANDLE_TIME.observe(end - start, prompt_name, command)
+        if trace:
+            args = {"prompt": prompt_name, "command": command}
+            trace.add("handle_input", start, end=end, args=args)
+
+        latency = await conn.term.flush_response()
+        if latency is not None:
+            RESPONSE_TIME.observe(latency, prompt_name, command)
+        if trace:
+            conn.term.trace = None
+            trace.finish()
+
+    @contextlib.contextmanager
+    def idle_timeout(self, conn):
+        limit = self.post_login_idle if conn.logged_in else self.pre_login_idle
+        if not limit:
+            yield
+            return
+
+        timer = self.timers.schedule(limit, conn.interrupt, IdleTimeout())
+        try:
+            yield
+        finally:
+            timer.cancel()
 
     async def get_user_input(self, conn):
         prompt = conn["prompt"]
@@ -57,10 +352,24 @@ class ConnectionServer:
 
 
 class Connection:
-    def __init__(self, term):
+    def __init__(self, term, timers=None):
         self.term = term
+        self.timers = timers
         self.context_stack = [{}]
         self.running = True
+        self.input_task = None
+        self.interruption = None
+        # set by the ConnectionRegistry while we're in it
+        self.registry = None
+        # the peer's hostname, once (and if) we know it
+        self.host = None
+
+    def logging_fields(self):
+        # For whatever's logged while handling its input, from the first
+        # prompt after we know them.
+        if self.host is None:
+            return {}
+        return {"host": self.host}
 
     # context management
 
@@ -70,16 +379,35 @@ class Connection:
     def __getitem__(self, key):
         return self.context().get(key, None)
 
+    @property
+    def logged_in(self):
+        # Login pops the auth frame and records the username in the frame
+        # beneath it, so a username at the bottom of the stack means we're
+        # past authentication.
+        return bool(self.context_stack[0].get("username"))
+
     # connection actions
 
     async def send_message(self, message):
         return await self.term.write(message)
 
+    def scrollback(self):
+        return self.term.scrollback_text()
+
+    async def replay_scrollback(self, target=None):
+        # Replay what this connection recently saw, either back to itself
+        # or to some other connection (e.g. an admin looking over a
+        # player's shoulder). Replayed text isn't recorded again.
+        target = target or self
+        await target.term.write(self.scrollback(), drain=True, record=False)
+
     async def sleep(self, seconds):
-        return await self.term.sleep(seconds)
+        return await self.term.sleep(seconds, timers=self.timers)
 
     def _set_context(self, **kwargs):
         self.context().update(**kwargs)
+        if self.registry is not None:
+            self.registry.reindex(self)
 
     async def set_context(self, **kwargs):
         self._set_context(**kwargs)
@@ -96,15 +424,792 @@ class Connection:
     async def stop(self):
         self.running = False
 
+    async def enter_zone(self, zone):
+        # Returns whether the zone's here. If it's another shard's, we go
+        # there as soon as the current input's been handled.
+        self._set_context(zone=zone)
+        owner = SHARDS.owner(zone)
+        if owner == SHARDS.index:
+            return True
+        logger.debug("moving to shard", extra={"zone": zone, "shard": owner})
+        self.interrupt(Migrating(functools.partial(self.term.move, owner)))
+        return False
+
+    async def reattach(self):
+        # Pick up this user's linkdead session, if there is one, in place of
+        # the fresh one we've just logged in to.
+        if self.registry is None:
+            return False
+        session = self.registry.unpark(self["username"])
+        if session is None:
+            return False
+
+        self.context_stack = session.context_stack
+        self.registry.reindex(self)
+        # They've already seen this session's login. Pick up their old
+        # scrollback instead.
+        self.term.scrollback.clear()
+        self.term.scrollback.append(session.scrollback)
+        return True
+
+    # interrupting
+
+    def interrupt(self, exc):
+        # Raise exc in the connection's task: right away if it's waiting for
+        # input, or else as soon as it starts to.
+        self.interruption = exc
+        if isinstance(exc, Migrating):
+            # Once we've decided to hand off, the peer belongs to the new
+            # process. Don't let unwinding code write anything else.
+            self.term.detach()
+        if self.input_task:
+            self.input_task.cancel()
+
+    @contextlib.contextmanager
+    def waiting_for_input(self):
+        self.raise_interruption()
+        self.input_task = asyncio.current_task()
+        try:
+            yield
+        except asyncio.CancelledError:
+            self.raise_interruption()
+            raise
+        finally:
+            self.input_task = None
+
+    def raise_interruption(self):
+        exc, self.interruption = self.interruption, None
+        if exc is not None:
+            raise exc
+
+    # handoff
+
+    def dump_state(self):
+        return {
+            "context_stack": encode_context_value(self.context_stack),
+            "term": self.term.dump_state(),
+        }
+
+    async def load_state(self, state):
+        self.context_stack = decode_context_value(state["context_stack"])
+        if self.registry is not None:
+            self.registry.reindex(self)
+        if self.logged_in:
+            PRESENCE.arrive(self)
+        self.term.load_state(state["term"])
+
+
+# Context values are plain data, including lists and dicts of it, plus
+# prompt objects. Encode those by class, with their attributes, in a dict
+# tagged with "__class__".
 
-@subcommand()
-def run_server():
-    asyncio.run(async_run_server())
 
+def encode_context_value(value):
+    if isinstance(value, (str, int, float, bool, type(None))):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [encode_context_value(v) for v in value]
+    if isinstance(value, dict):
+        if "__class__" in value:
+            raise ValueError(f"can't encode a dict with a __class__ key: {value!r}")
+        return {key: encode_context_value(v) for key, v in value.items()}
+    cls = value.__class__
+    return {
+        "__class__": f"{cls.__module__}.{cls.__qualname__}",
+        "attrs": {key: encode_context_value(v) for key, v in vars(value).items()},
+    }
 
-async def async_run_server():
-    conn_server = ConnectionServer()
+
+def decode_context_value(value):
+    if isinstance(value, list):
+        return [decode_context_value(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if "__class__" not in value:
+        return {key: decode_context_value(v) for key, v in value.items()}
+    module_name, _, class_name = value["__class__"].rpartition(".")
+    cls = getattr(importlib.import_module(module_name), class_name)
+    obj = cls.__new__(cls)
+    for key, attr in value["attrs"].items():
+        setattr(obj, key, decode_context_value(attr))
+    return obj
+
+
+# Every option, with its default. Keyed, so that a new option can go
+# anywhere without shifting the defaults after it.
+SERVER_DEFAULTS = {
+    "bind": [("0.0.0.0", 6666)],
+    "backlog": 100,
+    "read_size": Terminal.READ_SIZE,
+    "tcp_nodelay": True,
+    "keepalive": False,
+    "send_buffer": None,
+    "receive_buffer": None,
+    "max_connections": None,
+    "max_connections_per_host": None,
+    "max_connections_per_subnet": None,
+    "subnet_prefix_length": 24,
+    "accepts_per_sec": None,
+    "accepts_burst": None,
+    "pre_login_idle": 300,
+    "post_login_idle": 3600,
+    "max_line_length": 1024,
+    "line_overflow": "truncate",
+    "scrollback_size": 4096,
+    "input_bytes_per_sec": InputLimits().bytes_per_sec,
+    "input_lines_per_sec": InputLimits().lines_per_sec,
+    "input_bytes_burst": InputLimits().bytes_burst,
+    "input_lines_burst": InputLimits().lines_burst,
+    "handoff_socket": None,
+    "takeover": None,
+    "drain_timeout": 30,
+    "linkdead_grace": 300,
+    "metrics_bind": None,
+    "admin_socket": None,
+    "watchdog_threshold": 0.5,
+    "trace_file": None,
+    "trace_sample": 1.0,
+    "trace_format": "chrome",
+    "profile": False,
+    "profiler": "sampling",
+    "profile_dir": ".",
+    "profile_window": 30,
+    "gateway_socket": None,
+    "shards": 1,
+    "shard": 0,
+    "presence_socket": None,
+    "presence_hub": False,
+    "reverse_dns": False,
+    "dns_timeout": 2.0,
+    "dns_threads": 4,
+    "dns_cache_size": 10000,
+    "access_list": None,
+}
+
+
+class ServerConfig(
+    collections.namedtuple(
+        "_ServerConfig", SERVER_DEFAULTS, defaults=SERVER_DEFAULTS.values()
+    )
+):
+    def terminal_options(self):
+        return {
+            "read_size": self.read_size,
+            "max_line_length": self.max_line_length,
+            "line_overflow": LineBuffer.Overflow[self.line_overflow.upper()],
+            "scrollback_size": self.scrollback_size,
+            "input_limits": InputLimits(
+                bytes_per_sec=self.input_bytes_per_sec,
+                bytes_burst=self.input_bytes_burst,
+                lines_per_sec=self.input_lines_per_sec,
+                lines_burst=self.input_lines_burst,
+            ),
+        }
+
+    def socket_options(self):
+        # Options for accepted client sockets
+        return [
+            (socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.tcp_nodelay)),
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(self.keepalive)),
+        ]
+
+    def listener_options(self):
+        # Options for listening sockets. Accepted sockets inherit buffer
+        # sizes from their listener, and the receive buffer needs to be set
+        # before the handshake to affect the TCP window scale.
+        options = []
+        if self.send_buffer:
+            options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer))
+        if self.receive_buffer:
+            options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer))
+        return options
+
+    def admission(self):
+        return AdmissionControl(
+            max_connections=self.max_connections,
+            per_host=self.max_connections_per_host,
+            per_subnet=self.max_connections_per_subnet,
+            prefix_length=self.subnet_prefix_length,
+            accepts_per_sec=self.accepts_per_sec,
+            accepts_burst=self.accepts_burst,
+            access_list=AccessList(self.access_list) if self.access_list else None,
+        )
+
+    def shard_sockets(self):
+        # Where each shard's game process listens for gateways.
+        if self.shards == 1:
+            return [self.gateway_socket]
+        return [f"{self.gateway_socket}.{shard}" for shard in range(self.shards)]
+
+    def resolver(self):
+        if not self.reverse_dns:
+            return None
+        return Resolver(
+            threads=self.dns_threads,
+            timeout=self.dns_timeout,
+            cache_size=self.dns_cache_size,
+        )
+
+    def connection_server(self, connection_gauge=None):
+        # With gateways, the client sockets and telnet are theirs.
+        split = bool(self.gateway_socket)
+        return ConnectionServer(
+            terminal_options=self.terminal_options(),
+            pre_login_idle=self.pre_login_idle,
+            post_login_idle=self.post_login_idle,
+            socket_options=[] if split else self.socket_options(),
+            # and so is admission: their clients have been let in already
+            admission=None if split else self.admission(),
+            drain_timeout=self.drain_timeout,
+            linkdead_grace=self.linkdead_grace,
+            connection_gauge=connection_gauge,
+            terminal_class=gateway.RemoteTerminal if split else None,
+            resolver=self.resolver(),
+        )
+
+
+@subcommand(
+    argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of server processes sharing the port (default: %(default)s)",
+    ),
+    argument(
+        "--gateways",
+        type=int,
+        default=0,
+        help=(
+            "telnet gateway processes sharing the port, relaying lines to "
+            "and from a single game process; 0 to do it all in one process "
+            "(default: %(default)s)"
+        ),
+    ),
+    argument(
+        "--shards",
+        type=int,
+        help=(
+            "game processes sharing out the world's zones, with --gateways "
+            "(default: 1)"
+        ),
+    ),
+    loops.loop_argument(),
+    argument(
+        "--bind",
+        type=address,
+        action="append",
+        metavar="[HOST]:PORT",
+        help="address to listen on; may be repeated (default: 0.0.0.0:6666)",
+    ),
+    argument("--backlog", type=int, help="listen backlog (default: 100)"),
+    argument(
+        "--read-size",
+        type=size,
+        help=f"bytes per socket read (default: {Terminal.READ_SIZE})",
+    ),
+    argument(
+        "--tcp-nodelay",
+        action=BooleanFlag,
+        help="disable Nagle's algorithm on client sockets (default: on)",
+    ),
+    argument(
+        "--keepalive",
+        action=BooleanFlag,
+        help="enable TCP keepalive on client sockets (default: off)",
+    ),
+    argument("--send-buffer", type=size, help="SO_SNDBUF size (default: OS default)"),
+    argument(
+        "--receive-buffer", type=size, help="SO_RCVBUF size (default: OS default)"
+    ),
+    argument(
+        "--max-connections",
+        type=int,
+        help="concurrent connections per process (default: unlimited)",
+    ),
+    argument(
+        "--max-connections-per-host",
+        type=int,
+        help=(
+            "concurrent connections per process from any one address "
+            "(default: unlimited)"
+        ),
+    ),
+    argument(
+        "--max-connections-per-subnet",
+        type=int,
+        help=(
+            "concurrent connections per process from any one subnet "
+            "(default: unlimited)"
+        ),
+    ),
+    argument(
+        "--subnet-prefix-length",
+        type=int,
+        help=(
+            "IPv4 prefix length grouping addresses into subnets; IPv6 "
+            "subnets are always /64 (default: 24)"
+        ),
+    ),
+    argument(
+        "--accepts-per-sec",
+        type=float,
+        help="new connections accepted per second per process (default: unlimited)",
+    ),
+    argument(
+        "--accepts-burst",
+        type=int,
+        help=(
+            "new connections accepted in a burst above --accepts-per-sec "
+            "(default: same as the rate)"
+        ),
+    ),
+    argument(
+        "--pre-login-idle",
+        type=float,
+        help=(
+            "seconds before an idle unauthenticated connection is closed; "
+            "0 to disable (default: 300)"
+        ),
+    ),
+    argument(
+        "--post-login-idle",
+        type=float,
+        help=(
+            "seconds before an idle player is disconnected; "
+            "0 to disable (default: 3600)"
+        ),
+    ),
+    argument(
+        "--max-line-length",
+        type=size,
+        help="longest input line accepted (default: 1024)",
+    ),
+    argument(
+        "--line-overflow",
+        choices=[overflow.name.lower() for overflow in LineBuffer.Overflow],
+        help=(
+            "what to do with lines past --max-line-length: truncate them, "
+            "split them into several lines, or discard them (default: truncate)"
+        ),
+    ),
+    argument(
+        "--scrollback-size",
+        type=size,
+        help="bytes of recent output kept per connection (default: 4096)",
+    ),
+    argument(
+        "--input-bytes-per-sec",
+        type=size,
+        help="sustained input rate per connection; 0 to disable (default: 16k)",
+    ),
+    argument(
+        "--input-lines-per-sec",
+        type=float,
+        help="sustained input lines per connection; 0 to disable (default: 20)",
+    ),
+    argument(
+        "--input-bytes-burst",
+        type=size,
+        help="input accepted in a burst above --input-bytes-per-sec (default: 64k)",
+    ),
+    argument(
+        "--input-lines-burst",
+        type=int,
+        help=(
+            "input lines accepted in a burst above --input-lines-per-sec "
+            "(default: 100)"
+        ),
+    ),
+    argument(
+        "--handoff-socket",
+        metavar="PATH",
+        help="unix socket where a new server can take over from this one",
+    ),
+    argument(
+        "--takeover",
+        metavar="PATH",
+        help=(
+            "take over listeners and connections from the server "
+            "at this handoff socket instead of binding"
+        ),
+    ),
+    argument(
+        "--drain-timeout",
+        type=float,
+        help="seconds to let connections finish after a handoff (default: 30)",
+    ),
+    argument(
+        "--linkdead-grace",
+        type=float,
+        help=(
+            "seconds to keep a dropped player's session for them to log "
+            "back in to; 0 to disable (default: 300)"
+        ),
+    ),
+    argument(
+        "--metrics-bind",
+        type=address,
+        metavar="[HOST]:PORT",
+        help=(
+            "serve Prometheus text-format metrics here, e.g. 127.0.0.1:9100; "
+            "with --workers or --shards, each process serves on the next port up "
+            "(default: off)"
+        ),
+    ),
+    argument(
+        "--admin-socket",
+        metavar="PATH",
+        help=(
+            "unix socket for the admin console; with --workers or --shards, "
+            "each process listens at PATH.N (default: off)"
+        ),
+    ),
+    argument(
+        "--watchdog-threshold",
+        type=float,
+        help=(
+            "seconds the event loop can be blocked before its stack is "
+            "logged; 0 to disable (default: 0.5)"
+        ),
+    ),
+    argument(
+        "--trace-file",
+        metavar="PATH",
+        help=(
+            "write tracing spans for each line of input here; with "
+            "--workers or --shards, each process writes PATH.N (default: off)"
+        ),
+    ),
+    argument(
+        "--trace-sample",
+        type=float,
+        help="fraction of lines of input to trace (default: 1)",
+    ),
+    argument(
+        "--trace-format",
+        choices=["chrome", "jsonl"],
+        help=(
+            "chrome (a JSON array for chrome://tracing or Perfetto) or "
+            "jsonl (the same events, one per line) (default: chrome)"
+        ),
+    ),
+    argument(
+        "--profile",
+        action=BooleanFlag,
+        help=(
+            "profile the whole run, writing the profile at shutdown; "
+            "without it, SIGUSR2 profiles for --profile-window (default: off)"
+        ),
+    ),
+    argument(
+        "--profiler",
+        choices=sorted(PROFILERS),
+        help=(
+            "sampling (collapsed stacks for flame graphs, by connection) or "
+            "cprofile (pstats) (default: sampling)"
+        ),
+    ),
+    argument(
+        "--profile-dir", metavar="DIR", help="where profiles are written (default: .)",
+    ),
+    argument(
+        "--profile-window",
+        type=float,
+        help="seconds a SIGUSR2 profile runs (default: 30)",
+    ),
+    argument(
+        "--gateway-socket",
+        metavar="PATH",
+        help=(
+            "unix socket between the game process and its gateways "
+            "(default: a temporary path)"
+        ),
+    ),
+    argument(
+        "--presence-socket",
+        metavar="PATH",
+        help=(
+            "unix socket of a presence hub (see presence_hub), so players "
+            "here can see and message those on other nodes (default: with "
+            "--workers or --shards, the first process serves one for the rest; "
+            "otherwise, just this process)"
+        ),
+    ),
+    argument(
+        "--reverse-dns",
+        action=BooleanFlag,
+        help="look up peers' hostnames, for logs and the admin console (default: off)",
+    ),
+    argument(
+        "--dns-timeout",
+        type=float,
+        help="seconds to wait on a reverse lookup before going without (default: 2)",
+    ),
+    argument(
+        "--dns-threads", type=int, help="threads doing reverse lookups (default: 4)",
+    ),
+    argument(
+        "--dns-cache-size",
+        type=int,
+        help="reverse lookups to remember, hostname or not (default: 10000)",
+    ),
+    argument(
+        "--access-list",
+        metavar="PATH",
+        help=(
+            "file of 'ban CIDR' and 'allow CIDR' lines, the most specific "
+            "matching a new connection deciding; SIGHUP reloads it (default: off)"
+        ),
+    ),
+)
+def run_server(workers, loop, gateways=0, **options):
+    # Unspecified options come through as None. Let the config fill those in.
+    config = ServerConfig(
+        **{name: value for name, value in options.items() if value is not None}
+    )
+    if workers > 1 and (config.handoff_socket or config.takeover):
+        # Each worker would need its own handoff socket, and the pool would
+        # need to hand over its supervision. Not yet.
+        raise ValueError("handoff requires a single server process")
+    if gateways and (workers > 1 or config.handoff_socket or config.takeover):
+        # There's just the one game process, and handoff would have to pass
+        # the gateways along too.
+        raise ValueError("gateways require a single game process without handoff")
+    if config.shards > 1 and not gateways:
+        raise ValueError("shards need gateways to move players between them")
+    logger.info(
+        "starting server",
+        extra={
+            "workers": workers,
+            "gateways": gateways,
+            "loop": loop,
+            "bind": config.bind,
+        },
+    )
+    if (workers > 1 or config.shards > 1) and not config.presence_socket:
+        path = os.path.join(
+            tempfile.gettempdir(), f"redclay-{os.getpid()}-presence.sock"
+        )
+        config = config._replace(presence_socket=path, presence_hub=True)
+    if gateways:
+        if not config.gateway_socket:
+            path = os.path.join(tempfile.gettempdir(), f"redclay-{os.getpid()}.sock")
+            config = config._replace(gateway_socket=path)
+        # The first workers are the game's shards, the rest are gateways.
+        WorkerPool(
+            config.shards + gateways, functools.partial(run_split_worker, loop, config)
+        ).run()
+    elif workers > 1:
+        WorkerPool(workers, functools.partial(run_worker, loop, config)).run()
+    else:
+        loops.run(async_run_server(config), loop)
+
+
+def run_worker(loop, config, index, connection_gauge):
+    if config.metrics_bind:
+        host, port = config.metrics_bind
+        config = config._replace(metrics_bind=(host, port + index))
+    if config.admin_socket:
+        config = config._replace(admin_socket=f"{config.admin_socket}.{index}")
+    if config.trace_file:
+        config = config._replace(trace_file=f"{config.trace_file}.{index}")
+    config = config._replace(presence_hub=config.presence_hub and index == 0)
+    loops.run(
+        async_run_server(config, reuse_port=True, connection_gauge=connection_gauge),
+        loop,
+    )
+
+
+def run_split_worker(loop, config, index, connection_gauge):
+    if index >= config.shards:
+        loops.run(async_run_gateway(config), loop)
+    elif config.shards > 1:
+        run_worker(loop, config._replace(shard=index), index, connection_gauge)
+    else:
+        loops.run(async_run_server(config, connection_gauge=connection_gauge), loop)
+
+
+async def async_run_gateway(config):
+    links = [await gateway.connect_to_game(path) for path in config.shard_sockets()]
+    relay = gateway.Gateway(links, config.terminal_options(), config.admission())
+    socket_options = config.socket_options()
+
+    async def handle(reader, writer):
+        configure_socket(writer.get_extra_info("socket"), socket_options)
+        await relay.handle_connection(reader, writer)
+
+    async with contextlib.AsyncExitStack() as stack:
+        io_servers = await start_servers(config, handle, reuse_port=True)
+        for io_server in io_servers:
+            await stack.enter_async_context(io_server)
+
+        serving = asyncio.gather(
+            relay.serve(), *(server.serve_forever() for server in io_servers)
+        )
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGTERM, serving.cancel)
+        access_list = relay.admission.access_list
+        if access_list is not None:
+            loop.add_signal_handler(signal.SIGHUP, access_list.start_reload)
+            stack.callback(loop.remove_signal_handler, signal.SIGHUP)
+        try:
+            await serving
+        except asyncio.CancelledError:
+            logger.info("gateway shutting down")
+        except EOFError:
+            logger.warning("lost the game server")
+        finally:
+            loop.remove_signal_handler(signal.SIGTERM)
+
+
+async def async_run_server(config=None, reuse_port=None, connection_gauge=None):
+    config = config or ServerConfig()
+    conn_server = config.connection_server(connection_gauge)
     handle = functools.partial(conn_server.handle_connection, boot)
-    io_server = await asyncio.start_server(handle, "0.0.0.0", 6666)
-    async with io_server:
-        await io_server.serve_forever()
+
+    async with contextlib.AsyncExitStack() as stack:
+        if config.takeover:
+            io_servers = await take_over_servers(config.takeover, conn_server, handle)
+        elif config.gateway_socket:
+            path = config.shard_sockets()[config.shard]
+            io_servers = [await gateway.start_gateway_listener(path, conn_server, boot)]
+            logger.info(
+                "waiting for gateways", extra={"path": path, "shard": config.shard}
+            )
+        else:
+            io_servers = await start_servers(config, handle, reuse_port)
+        if config.gateway_socket:
+            stack.callback(remove_gateway_socket, config, conn_server)
+        for io_server in io_servers:
+            await stack.enter_async_context(io_server)
+
+        CONNECTIONS.function = conn_server.connections.tag_counts
+        if conn_server.resolver is not None:
+            stack.callback(conn_server.resolver.close)
+        SHARDS.configure(config.shard, config.shards)
+        if config.presence_hub:
+            hub = presence.PresenceHub()
+            hub_server = await presence.start_presence_hub(config.presence_socket, hub)
+            stack.callback(handoff.remove_stale_socket, config.presence_socket)
+            await stack.enter_async_context(hub_server)
+            backend = presence.LocalBackend(hub)
+        elif config.presence_socket:
+            backend = presence.UnixSocketBackend(config.presence_socket)
+        else:
+            backend = None
+        await PRESENCE.configure(conn_server.connections, backend)
+        stack.push_async_callback(PRESENCE.close)
+        watchdog = Watchdog(config.watchdog_threshold)
+        watchdog.start()
+        stack.callback(watchdog.stop)
+        profiling = Profiling(
+            config.profiler, config.profile_dir, config.profile_window
+        )
+        profiling.install()
+        stack.callback(profiling.uninstall)
+        stack.push_async_callback(profiling.close)
+        if config.profile:
+            profiling.start()
+        if config.trace_file:
+            TRACER.start(config.trace_file, config.trace_sample, config.trace_format)
+            stack.callback(TRACER.stop)
+            stack.callback(asyncio.ensure_future(TRACER.flush_periodically()).cancel)
+        if config.metrics_bind:
+            # A restarted server takes over while we still hold the port.
+            handing_off = bool(config.handoff_socket or config.takeover)
+            metrics_server = await start_metrics_server(
+                *config.metrics_bind, reuse_port=handing_off or None
+            )
+            await stack.enter_async_context(metrics_server)
+        if config.admin_socket:
+            # Left in place on the way out: after a handoff, the path is
+            # the new server's.
+            admin_server = await start_admin_console(config.admin_socket, conn_server)
+            await stack.enter_async_context(admin_server)
+
+        serving = asyncio.gather(*(server.serve_forever() for server in io_servers))
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGTERM, serving.cancel)
+        access_list = conn_server.admission.access_list
+        if access_list is not None:
+            loop.add_signal_handler(signal.SIGHUP, access_list.start_reload)
+            stack.callback(loop.remove_signal_handler, signal.SIGHUP)
+        if config.handoff_socket:
+            listener = handoff.HandoffListener(
+                config.handoff_socket, conn_server, io_servers
+            )
+            handing_off = asyncio.ensure_future(listener.serve())
+        try:
+            await serving
+        except asyncio.CancelledError:
+            logger.info("server shutting down")
+            if not conn_server.draining:
+                conn_server.announce_shutdown()
+        finally:
+            loop.remove_signal_handler(signal.SIGTERM)
+
+        if conn_server.draining:
+            # Closing the listeners for a handoff is what stopped us serving.
+            # Finish handing off, then let stragglers finish.
+            await handing_off
+            await conn_server.wait_drained()
+        elif config.handoff_socket:
+            handing_off.cancel()
+
+
+def remove_gateway_socket(config, conn_server):
+    # Once we've stopped listening, unless the path is now the server's we
+    # handed off to.
+    if not conn_server.draining:
+        handoff.remove_stale_socket(config.shard_sockets()[config.shard])
+
+
+async def start_servers(config, handle, reuse_port=None):
+    io_servers = []
+    for host, port in config.bind:
+        io_server = await asyncio.start_server(
+            handle,
+            host,
+            port,
+            backlog=config.backlog,
+            reuse_port=reuse_port,
+            limit=Terminal.READER_LIMIT,
+        )
+        configure_listener(io_server, config.listener_options())
+        logger.info(
+            "listening", extra={"host": host, "port": port, "loop": loops.loop_name()}
+        )
+        io_servers.append(io_server)
+    return io_servers
+
+
+async def take_over_servers(path, conn_server, handle):
+    # The listeners arrive already bound, configured and listening.
+    channel, listeners = await handoff.take_over(path)
+    io_servers = [
+        await asyncio.start_server(handle, sock=sock, limit=Terminal.READER_LIMIT)
+        for sock in listeners
+    ]
+    logger.info("listening on inherited sockets", extra={"loop": loops.loop_name()})
+    asyncio.ensure_future(handoff.receive_connections(channel, conn_server))
+    return io_servers
+
+
+def configure_socket(sock, options):
+    for level, option, value in options:
+        try:
+            sock.setsockopt(level, option, value)
+        except OSError:
+            logger.debug(
+                "could not set socket option",
+                extra={"level": level, "option": option},
+                exc_info=True,
+            )
+
+
+def configure_listener(io_server, options):
+    if not options:
+        return
+    for sock in io_server.sockets:
+        for level, option, value in options:
+            sock.setsockopt(level, option, value)
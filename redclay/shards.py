@@ -0,0 +1,25 @@
+import zlib
+
+
+class Shards:
+    # The world's zones split among game processes ("shards"), and this
+    # process's place among them. A zone always belongs to the same shard,
+    # by a hash of its name that every process agrees on. Players in a zone
+    # are on its shard; the gateways move them when they go somewhere else.
+    # Anything else between shards goes through PRESENCE.
+    def __init__(self):
+        self.index = 0
+        self.count = 1
+
+    def configure(self, index, count):
+        self.index = index
+        self.count = count
+
+    def owner(self, zone):
+        return zlib.crc32(zone.encode("utf-8")) % self.count
+
+    def is_local(self, zone):
+        return self.owner(zone) == self.index
+
+
+SHARDS = Shards()
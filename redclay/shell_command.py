@@ -1,5 +1,7 @@
 import argparse
+import collections
 import importlib
+import re
 
 
 class ArgumentParser(argparse.ArgumentParser):
@@ -19,6 +21,7 @@ class ArgumentParser(argparse.ArgumentParser):
         )
         subparser = self.subparsers.add_parser(subcommand.get_name())
         subparser.set_defaults(subcommand=subcommand)
+        subcommand.add_arguments(subparser)
 
     def load_subcommand(self, import_path):
         module_name, _, runner_name = import_path.rpartition(".")
@@ -28,15 +31,85 @@ class ArgumentParser(argparse.ArgumentParser):
 
 
 class Subcommand:
-    def __init__(self, run):
+    def __init__(self, run, *arguments):
         self.run = run
+        self.arguments = arguments
+        self.dests = []
 
     def get_name(self):
         return self.run.__name__
 
+    def add_arguments(self, parser):
+        actions = [
+            parser.add_argument(*argument.args, **argument.kwargs)
+            for argument in self.arguments
+        ]
+        self.dests = [action.dest for action in actions]
+
     def run_with_args(self, args):
-        # For the moment, ignore the args
-        self.run()
+        kwargs = {dest: getattr(args, dest) for dest in self.dests}
+        self.run(**kwargs)
+
+
+Argument = collections.namedtuple("Argument", ["args", "kwargs"])
+
+
+def argument(*args, **kwargs):
+    # Declare an argument for a subcommand. Takes the same arguments as
+    # ArgumentParser.add_argument(). The parsed value is passed to the
+    # subcommand's runner as a keyword argument named by its dest.
+    return Argument(args, kwargs)
+
+
+# argument types
+
+
+SIZE_RE = re.compile(r"^(\d+)([kmg]?)b?$", re.IGNORECASE)
+SIZE_UNITS = {"": 1, "k": 2 ** 10, "m": 2 ** 20, "g": 2 ** 30}
+
+
+def size(text):
+    # A byte count, optionally with a binary unit suffix: 4096, 4k, 1M
+    match = SIZE_RE.match(text.strip())
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid size: {text!r}")
+    count, unit = match.groups()
+    return int(count) * SIZE_UNITS[unit.lower()]
+
+
+def address(text):
+    # A listening address: host:port, [v6host]:port, or just :port or port
+    # for all interfaces.
+    if text.startswith("["):
+        host, bracket, port = text[1:].partition("]:")
+        if not bracket:
+            raise argparse.ArgumentTypeError(f"invalid address: {text!r}")
+    else:
+        host, _, port = text.rpartition(":")
+        if ":" in host:
+            raise argparse.ArgumentTypeError(
+                f"IPv6 addresses need brackets, as in [::1]:6666: {text!r}"
+            )
+    host = host or "0.0.0.0"
+    try:
+        port = int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid address: {text!r}")
+    if not 0 <= port < 2 ** 16:
+        raise argparse.ArgumentTypeError(f"invalid port: {text!r}")
+    return (host, port)
+
+
+class BooleanFlag(argparse.Action):
+    # --flag sets True, --no-flag sets False.
+    def __init__(self, option_strings, dest, default=None, **kwargs):
+        negated = ["--no-" + opt[2:] for opt in option_strings if opt.startswith("--")]
+        super().__init__(
+            option_strings + negated, dest, nargs=0, default=default, **kwargs
+        )
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        setattr(namespace, self.dest, not option_string.startswith("--no-"))
 
 
 def subcommand(*args, **kwargs):
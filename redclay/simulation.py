@@ -0,0 +1,79 @@
+import asyncio
+import hashlib
+import logging
+import time
+
+from redclay import loops
+from redclay.benchmark import open_memory_connection
+from redclay.shell_command import argument, subcommand
+
+logger = logging.getLogger(__name__)
+
+
+@subcommand(
+    argument(
+        "--sessions",
+        type=int,
+        default=10000,
+        help="sessions that fail to log in (default: %(default)s)",
+    ),
+    argument(
+        "--rate",
+        type=float,
+        default=100,
+        help="sessions arriving per (virtual) second (default: %(default)s)",
+    ),
+)
+def simulate_login_failures(sessions, rate):
+    # Every session gets its password wrong until the server gives up on
+    # it, sitting out the server's delay after each failure. On a virtual
+    # clock, those delays cost nothing but the bookkeeping.
+    logging.getLogger().setLevel(logging.WARNING)
+    start = time.perf_counter()
+    result = loops.run(run_login_failures(sessions, rate), "virtual")
+    elapsed = time.perf_counter() - start
+
+    print(f"sessions:         {result.sessions}")
+    print(f"login failures:   {result.failures}")
+    print(f"virtual time:     {result.virtual_elapsed:.3f}s")
+    print(f"real time:        {elapsed:.3f}s")
+    print(f"transcript:       {result.transcript}")
+
+
+class SimulationResult:
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.failures = 0
+        self.virtual_elapsed = None
+        self.transcript = None
+
+
+async def run_login_failures(sessions, rate):
+    from redclay.game import LOGINS, MAX_TRIES, boot
+    from redclay.server import ServerConfig
+
+    loop = asyncio.get_event_loop()
+    conn_server = ServerConfig().connection_server()
+    result = SimulationResult(sessions)
+    failures_before = LOGINS.values[("failure",)]
+    # When each session ended, and what the server sent it. The same
+    # inputs should give the same transcript, run after run.
+    transcript = hashlib.sha256()
+
+    start = loop.time()
+
+    async def session(i):
+        await asyncio.sleep(i / rate)
+        reader, writer = open_memory_connection(("10.0.0.1", i))
+        username = f"player{i}"
+        writer.transport.feed(f"{username}\r\nnope\r\n".encode("ascii") * MAX_TRIES)
+        await conn_server.handle_connection(boot, reader, writer)
+        transcript.update(
+            f"{loop.time() - start:.6f} {i} {writer.transport.written}\n".encode()
+        )
+
+    await asyncio.gather(*(session(i) for i in range(sessions)))
+    result.virtual_elapsed = loop.time() - start
+    result.failures = LOGINS.values[("failure",)] - failures_before
+    result.transcript = transcript.hexdigest()
+    return result
@@ -3,28 +3,86 @@ import collections
 import contextlib
 import enum
 import logging
+import time
 
-from redclay.telnet import OPTIONS, StreamStuffer, Tokenizer, StreamParser
-from redclay.textutil import LineBuffer
+from redclay.metrics import METRICS
+from redclay.ratelimit import InputLimits
+from redclay.telnet import (
+    OPTIONS,
+    CrlfTransformer,
+    StreamStuffer,
+    Tokenizer,
+    StreamParser,
+)
+from redclay.textutil import LineBuffer, Scrollback
 
 
 logger = logging.getLogger(__name__)
 
+BYTES_IN = METRICS.counter("redclay_bytes_in_total", "Bytes read from clients")
+BYTES_OUT = METRICS.counter("redclay_bytes_out_total", "Bytes written to clients")
+TELNET_UPDATES = METRICS.counter(
+    "redclay_telnet_updates_total", "Telnet stream updates parsed", ["type"]
+)
+THROTTLED_CONNECTIONS = METRICS.counter(
+    "redclay_throttled_connections_total",
+    "Connections whose input was throttled at least once",
+)
+THROTTLE_DELAY = METRICS.histogram(
+    "redclay_input_throttle_seconds",
+    "How long input was held back each time it was throttled, by limit",
+    ["kind"],
+)
+OPTION_NEGOTIATIONS = METRICS.counter(
+    "redclay_option_negotiations_total",
+    "Telnet option negotiations received",
+    ["option", "host", "state"],
+)
+
 
 class Terminal:
     READ_SIZE = 2 ** 12  # arbitrary pleasant number?
-
-    def __init__(self, reader, writer):
+    # How much a connection's StreamReader holds before it stops reading
+    # from the socket (at twice this).
+    READER_LIMIT = 2 ** 14
+
+    def __init__(
+        self,
+        reader,
+        writer,
+        read_size=None,
+        input_limits=None,
+        scrollback_size=4096,
+        max_line_length=1024,
+        line_overflow=LineBuffer.Overflow.TRUNCATE,
+    ):
         self.reader = reader
         self.writer = writer
+        self.read_size = read_size or self.READ_SIZE
+
+        input_limits = input_limits or InputLimits()
+        self.byte_bucket = input_limits.byte_bucket()
+        self.line_bucket = input_limits.line_bucket()
+        self.throttled = False
+        self.connected_at = time.perf_counter()
+        # when we read the data that finished the last line we returned
+        self.last_read_at = None
+        self.line_arrived_at = None
 
         self.encoder = StreamStuffer()
         self.tokenizer = Tokenizer()
         self.parser = StreamParser()
-        self.line_buffer = LineBuffer()
+        self.line_buffer = LineBuffer(max_line_length, line_overflow)
         self.update_buffer = []
+        # bytes taken from the reader but not parsed, when handing off
+        self.unread = b""
+        self.scrollback = Scrollback(scrollback_size)
         self.prompt_mgr = None
+        self.resumed_prompt_state = None
         self.echo_state = EchoOptionState()
+        self.detached = False
+        # the current interaction's Trace, if it's being traced
+        self.trace = None
 
     async def __aenter__(self):
         return self
@@ -37,36 +95,162 @@ class Terminal:
         self.writer.close()
         await self.writer.wait_closed()
 
-    async def sleep(self, secs):
+    async def sleep(self, secs, timers=None):
         await self.writer.drain()
-        await asyncio.sleep(secs)
+        if timers is None:
+            await asyncio.sleep(secs)
+        else:
+            await timers.sleep(secs)
 
-    async def write(self, texts, drain=False):
+    async def write(self, texts, drain=False, record=True):
         if texts is None:
             texts = []
         if not isinstance(texts, list):
             texts = [texts]
 
         for text in texts:
-            self._write(text)
+            self._write(text, record)
         if drain:
             await self.writer.drain()
 
-    def _write(self, text):
+    def _write(self, text, record=True):
+        if self.detached:
+            logger.debug("dropping write to detached terminal", extra={"text": text})
+            return
         if isinstance(text, str):
             text = StreamParser.UserData(text)
 
+        trace = self.trace
+        start = trace and time.perf_counter()
         out_data = self.encoder.stuff(text)
-        logger.debug("writing", extra={"data": out_data})
-        self.writer.write(out_data)
+        self.write_encoded(out_data, record and isinstance(text, StreamParser.UserData))
+        if trace:
+            trace.add("write", start)
+
+    def write_encoded(self, data, record=True):
+        # Write user data that's already been stuffed for this terminal's
+        # wire_format(), e.g. once for many terminals by a broadcast.
+        if self.detached:
+            return
+        logger.debug("writing", extra={"data": data})
+        self.writer.write(data)
+        BYTES_OUT.inc(amount=len(data))
+        if record:
+            # Keep the stuffed bytes: that's what we already have in hand,
+            # and the rare replay can pay to unstuff them.
+            self.scrollback.append(data)
+
+    def wire_format(self):
+        # Terminals with the same wire format stuff the same text to the
+        # same bytes.
+        return type(self.encoder)
+
+    def output_backlog(self):
+        return self.writer.transport.get_write_buffer_size()
+
+    def input_backlog(self):
+        # Input we've read but not handled yet: parsed user data, plus
+        # characters of lines, finished or not, not yet returned.
+        pending = sum(
+            len(update.data)
+            for update in self.update_buffer
+            if isinstance(update, StreamParser.UserData)
+        )
+        lines = sum(len(line) for _, line in self.line_buffer.lines)
+        return len(self.unread) + pending + lines + self.line_buffer.length
+
+    def idle_time(self):
+        last_active = self.last_read_at or self.connected_at
+        return time.perf_counter() - last_active
+
+    async def flush(self):
+        # Wait for everything we've written to reach the socket, not just
+        # for the buffer to drop below the high-water mark.
+        transport = self.writer.transport
+        low, high = transport.get_write_buffer_limits()
+        transport.set_write_buffer_limits(high=0)
+        try:
+            await self.writer.drain()
+        finally:
+            transport.set_write_buffer_limits(high=high, low=low)
+
+    async def flush_response(self):
+        # Flush the response to the last line of input, returning how long
+        # it's been since that line arrived.
+        trace = self.trace
+        start = trace and time.perf_counter()
+        await self.writer.drain()
+        if trace:
+            trace.add("drain", start)
+        arrived, self.line_arrived_at = self.line_arrived_at, None
+        if arrived is not None:
+            return time.perf_counter() - arrived
+
+    def detach(self):
+        # Someone else owns the peer now. Stop reading, so anything more the
+        # peer sends stays in the socket for them, and drop anything else
+        # we're asked to write.
+        self.detached = True
+        self.writer.transport.pause_reading()
+
+    async def take_unread(self):
+        # Once detached, take what the reader's still holding, for whoever
+        # has the peer next. Reading's paused, so nothing more is coming.
+        self.reader.feed_eof()
+        self.unread += await self.reader.read()
+
+    def dump_state(self):
+        # Unread input and negotiated state, enough for another process to
+        # carry on where we left off. Pending updates other than user data
+        # (i.e. mid-negotiation telnet commands) are lost.
+        pending = [
+            update.data
+            for update in self.update_buffer
+            if isinstance(update, StreamParser.UserData)
+        ]
+        lines = [line for _, line in self.line_buffer.lines]
+        prompt_state = self.prompt_mgr.state.name if self.prompt_mgr else None
+        return {
+            "input": "".join(lines + self.line_buffer.chunks + pending),
+            "unread": self.unread.decode("latin-1"),
+            "echo": self.echo_state.state.name,
+            "prompt": prompt_state,
+            "scrollback": self.scrollback.getvalue().decode("latin-1"),
+        }
+
+    def load_state(self, state):
+        self.line_buffer.append(state["input"])
+        unread = state["unread"].encode("latin-1")
+        if unread:
+            self.update_buffer = self.parser.stream_updates(
+                self.tokenizer.tokens(unread)
+            )
+        self.echo_state.state = EchoOptionState.State[state["echo"]]
+        if state["prompt"]:
+            self.resumed_prompt_state = Prompt.PromptState[state["prompt"]]
+        self.scrollback.append(state["scrollback"].encode("latin-1"))
+
+    def scrollback_text(self):
+        data = CrlfTransformer().unstuff(self.scrollback.getvalue())
+        if self.scrollback.full:
+            # The oldest line has probably been partly overwritten. Drop it
+            # rather than replay a fragment.
+            data = data[data.find(b"\n") + 1 :]
+        return data.decode("ascii")
 
     @contextlib.contextmanager
     def prompt(self, prompt):
         self.prompt_mgr = Prompt(prompt)
+        if self.resumed_prompt_state:
+            # The peer already has this prompt from before a handoff.
+            self.prompt_mgr.state = self.resumed_prompt_state
+            self.resumed_prompt_state = None
         try:
             yield
         finally:
-            self.prompt_mgr = None
+            # Leave a detached terminal's prompt for dump_state().
+            if not self.detached:
+                self.prompt_mgr = None
 
     async def input(self, prompt):
         with self.prompt(prompt):
@@ -84,6 +268,8 @@ class Terminal:
         while True:
             line = await self._handle_input_once()
             if line:
+                self.line_arrived_at = self.last_read_at
+                await self.throttle_input("lines", self.line_bucket, 1)
                 return line
 
     async def _handle_input_once(self):
@@ -101,7 +287,12 @@ class Terminal:
         while not self.line_buffer.has_line():
             await self.require_update_buffer()
             update = self.update_buffer.pop(0)
-            await self.write(self.handle_update(update), drain=True)
+            trace = self.trace
+            start = trace and time.perf_counter()
+            response = self.handle_update(update)
+            if trace:
+                trace.add("assemble", start)
+            await self.write(response, drain=True)
 
     async def require_update_buffer(self):
         while not self.update_buffer:
@@ -109,13 +300,58 @@ class Terminal:
             self.update_buffer = await self.fetch_updates()
 
     async def fetch_updates(self):
-        data = await self.reader.read(self.READ_SIZE)
+        trace = self.trace
+        start = trace and time.perf_counter()
+        data = await self.reader.read(self.read_size)
+        self.last_read_at = time.perf_counter()
+        if trace:
+            trace.add("read", start, end=self.last_read_at)
         logger.debug("read", extra={"data": data})
         if not data:
             raise EOFError()
+        BYTES_IN.inc(amount=len(data))
+        await self.throttle_input("bytes", self.byte_bucket, len(data))
 
+        start = trace and time.perf_counter()
         toks = self.tokenizer.tokens(data)
-        return self.parser.stream_updates(toks)
+        if trace:
+            start = trace.add("tokenize", start)
+        updates = self.parser.stream_updates(toks)
+        if trace:
+            trace.add("parse", start)
+        return updates
+
+    async def throttle_input(self, kind, bucket, amount):
+        if bucket is None:
+            return
+        delay = bucket.consume(amount)
+        if not delay:
+            return
+
+        THROTTLE_DELAY.observe(delay, kind)
+        if not self.throttled:
+            self.throttled = True
+            THROTTLED_CONNECTIONS.inc()
+            logger.info("throttling input", extra={"kind": kind, "delay": delay})
+
+        # Stop pulling from the socket entirely while we're in debt so that
+        # the flood backs up into the peer's TCP window instead of our
+        # memory. If the StreamReader has already paused it for being full,
+        # that's its pause to lift, not ours.
+        transport = self.writer.transport
+        pausing = transport.is_reading()
+        if pausing:
+            transport.pause_reading()
+        trace = self.trace
+        start = trace and time.perf_counter()
+        try:
+            await asyncio.sleep(delay)
+            if trace:
+                trace.add("throttle", start)
+        finally:
+            # Detached, it's paused for good.
+            if pausing and not self.detached:
+                transport.resume_reading()
 
     async def annotation_TimingMark(self, annotation):
         await self.write(annotation.option.accept(), drain=True)
@@ -139,6 +375,7 @@ class Terminal:
     #
 
     def handle_update(self, update):
+        TELNET_UPDATES.inc(update.__class__.__name__)
         handle = getattr(self, "update_" + update.__class__.__name__, None)
         if not handle:
             logger.info("unhandled update", extra={"update": update})
@@ -155,6 +392,10 @@ class Terminal:
     #
 
     def update_OptionNegotiation(self, request):
+        option = request.option.name if request.option else str(request.value)
+        OPTION_NEGOTIATIONS.inc(
+            option, request.host.name.lower(), "on" if request.state else "off"
+        )
         handler = self.get_option_handler(request)
         return handler(request)
 
@@ -1,33 +1,108 @@
+import collections
+import enum
+
+from redclay.metrics import METRICS
+
+LINE_OVERFLOWS = METRICS.counter(
+    "redclay_line_overflows_total",
+    "Input lines over the maximum length, by what was done with them",
+    ["overflow"],
+)
+
+
 class LineBuffer:
-    def __init__(self):
-        self.lines = []
-        self.chars = ""
+    class Overflow(enum.Enum):
+        # keep the start of the line and drop the rest
+        TRUNCATE = enum.auto()
+        # break the line into max-length pieces
+        SPLIT = enum.auto()
+        # drop the whole line
+        DISCARD = enum.auto()
+
+    def __init__(self, max_length=None, overflow=Overflow.TRUNCATE):
+        self.max_length = max_length
+        self.overflow = overflow
+
+        self.lines = collections.deque()
+        self.chunks = []
+        self.length = 0
+        self.dropping = False
+        self.discarded = False
+        # whether the line being read, up to the next newline, has
+        # overflowed (even if SPLIT has pushed pieces of it since)
+        self.overflowed = False
         self.annotations = []
 
     def has_line(self):
         return bool(self.lines)
 
     def push(self):
-        self.lines.append((self.annotations, self.chars))
-        self.chars = ""
+        line = "" if self.discarded else "".join(self.chunks)
+        self.lines.append((self.annotations, line))
+        self.chunks = []
+        self.length = 0
+        self.dropping = False
+        self.discarded = False
         self.annotations = []
 
     def pop(self):
         if not self.lines:
             return ([], None)
-        annotations, line = self.lines.pop(0)
+        annotations, line = self.lines.popleft()
         return annotations, line
 
     def append(self, text):
-        while text:
-            nl = text.find("\n")
+        # Slice each line out of text exactly once and collect the pieces of
+        # the current line in a list, so appending is linear in the length
+        # of the input no matter how it's split up.
+        start = 0
+        while True:
+            nl = text.find("\n", start)
             if nl == -1:
-                self.chars += text
-                text = ""
-            else:
-                line, text = text[: nl + 1], text[nl + 1 :]
-                self.chars += line
-                self.push()
+                self.extend(text[start:] if start else text)
+                return
+            self.extend(text[start:nl])
+            self.chunks.append("\n")
+            self.push()
+            self.overflowed = False
+            start = nl + 1
+
+    def extend(self, chars):
+        if not chars or self.dropping:
+            return
+
+        if self.max_length:
+            room = self.max_length - self.length
+            if len(chars) > room:
+                if not self.overflowed:
+                    # Once a line, however many reads it comes in.
+                    self.overflowed = True
+                    LINE_OVERFLOWS.inc(self.overflow.name.lower())
+                handler = getattr(self, "overflow_" + self.overflow.name)
+                return handler(chars, room)
+
+        self.chunks.append(chars)
+        self.length += len(chars)
+
+    def overflow_TRUNCATE(self, chars, room):
+        self.chunks.append(chars[:room])
+        self.length += room
+        self.dropping = True
+
+    def overflow_SPLIT(self, chars, room):
+        while len(chars) > room:
+            self.chunks.append(chars[:room])
+            self.push()
+            chars, room = chars[room:], self.max_length
+        if chars:
+            self.chunks.append(chars)
+            self.length += len(chars)
+
+    def overflow_DISCARD(self, chars, room):
+        self.chunks = []
+        self.length = 0
+        self.dropping = True
+        self.discarded = True
 
     def annotate(self, annotation):
         self.annotations.append(annotation)
@@ -40,9 +115,57 @@ class LineBuffer:
         # case, if our current line is empty and get an annotation, push
         # that annotation without any line so that the caller can get it as
         # quickly as possible.
-        if not self.chars:
+        if not self.chunks and not self.dropping:
             self.push()
 
     def clear(self):
-        self.lines = []
-        self.chars = ""
+        self.lines.clear()
+        self.chunks = []
+        self.length = 0
+        self.dropping = False
+        self.discarded = False
+        self.overflowed = False
+
+
+class Scrollback:
+    # A fixed-size ring of the most recent bytes written. The buffer is
+    # allocated once up front and overwritten in place, so a connection's
+    # scrollback costs the same whether it's seen one line or a million.
+    def __init__(self, size=4096):
+        self.buffer = bytearray(size)
+        self.end = 0
+        self.full = False
+
+    def __len__(self):
+        return len(self.buffer) if self.full else self.end
+
+    def append(self, data):
+        size = len(self.buffer)
+        if not size:
+            return
+
+        if len(data) >= size:
+            self.buffer[:] = data[-size:]
+            self.end = 0
+            self.full = True
+            return
+
+        data = memoryview(data)
+        head = min(len(data), size - self.end)
+        self.buffer[self.end : self.end + head] = data[:head]
+        tail = len(data) - head
+        if tail:
+            self.buffer[:tail] = data[head:]
+
+        end = self.end + len(data)
+        self.full = self.full or end >= size
+        self.end = end % size
+
+    def getvalue(self):
+        if not self.full:
+            return bytes(self.buffer[: self.end])
+        return bytes(self.buffer[self.end :] + self.buffer[: self.end])
+
+    def clear(self):
+        self.end = 0
+        self.full = False
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import math
+
+logger = logging.getLogger(__name__)
+
+
+class TimingWheel:
+    # A hashed timing wheel: timers hash into one of a fixed number of slots
+    # by expiry tick, with a count of full revolutions to wait. Insert and
+    # cancel are O(1), and the wheel runs a single loop timer per tick, and
+    # only while it has something scheduled. Timers fire with a resolution of
+    # one tick, never before their delay is up.
+    def __init__(self, tick=0.1, slots=512, loop=None):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        self.loop = loop
+        self.cursor = 0
+        self.count = 0
+        self.next_tick = None
+        self.handle = None
+
+    def __len__(self):
+        return self.count
+
+    def get_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        return self.loop
+
+    def schedule(self, delay, callback, *args):
+        # Never early: the next tick may be less than a whole tick away, so
+        # count from there.
+        if self.handle is None:
+            first = self.tick
+        else:
+            first = max(0, self.next_tick - self.get_loop().time())
+        # (rounded, so float error in the clock can't push it a tick late)
+        ticks = max(1, 1 + math.ceil(round((delay - first) / self.tick, 9)))
+        rounds, offset = divmod(ticks - 1, len(self.slots))
+        slot = (self.cursor + offset + 1) % len(self.slots)
+
+        timer = Timer(self, slot, rounds, callback, args)
+        self.slots[slot][timer] = None
+        self.count += 1
+        self.start()
+        return timer
+
+    def cancel(self, timer):
+        slot = self.slots[timer.slot]
+        if timer in slot:
+            del slot[timer]
+            self.count -= 1
+
+    async def sleep(self, delay):
+        future = self.get_loop().create_future()
+        timer = self.schedule(delay, _resolve, future)
+        try:
+            return await future
+        finally:
+            timer.cancel()
+
+    def start(self):
+        if self.handle is None:
+            loop = self.get_loop()
+            self.next_tick = loop.time() + self.tick
+            self.handle = loop.call_at(self.next_tick, self.advance)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def advance(self):
+        # self.handle stays set until the callbacks have run, so that timers
+        # they schedule count from the next tick, and don't start the wheel
+        # ticking a second time over.
+        self.cursor = (self.cursor + 1) % len(self.slots)
+        slot = self.slots[self.cursor]
+
+        expired = []
+        for timer in slot:
+            if timer.rounds:
+                timer.rounds -= 1
+            else:
+                expired.append(timer)
+        for timer in expired:
+            del slot[timer]
+        self.count -= len(expired)
+        # Off of the ideal tick time rather than now so that callback time
+        # doesn't accumulate as drift.
+        loop = self.get_loop()
+        self.next_tick = max(self.next_tick + self.tick, loop.time())
+
+        handle = self.handle
+        for timer in expired:
+            timer.fire()
+
+        if self.handle is not handle:
+            # a callback stopped the wheel (and maybe started it again)
+            return
+        if self.count:
+            self.handle = loop.call_at(self.next_tick, self.advance)
+        else:
+            self.handle = None
+
+
+class Timer:
+    __slots__ = ["wheel", "slot", "rounds", "callback", "args"]
+
+    def __init__(self, wheel, slot, rounds, callback, args):
+        self.wheel = wheel
+        self.slot = slot
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+    def fire(self):
+        try:
+            self.callback(*self.args)
+        except Exception:
+            logger.exception("timer callback failed")
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,140 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+# Spans timing where each line of input goes, for the trace viewer. Each
+# interaction (one trip round a prompt) is sampled or not as a whole. One
+# that isn't has no Trace at all, and the places that would add spans to it
+# check for that before so much as reading the clock: with tracing off,
+# they cost an attribute lookup and a test.
+
+
+class Trace:
+    def __init__(self, tracer, tid):
+        self.tracer = tracer
+        self.tid = tid
+        self.events = []
+
+    def add(self, name, start, end=None, args=None):
+        # Returns the end, for the start of whatever comes next.
+        if end is None:
+            end = time.perf_counter()
+        self.events.append((name, start, end, self.tid, args))
+        return end
+
+    def finish(self):
+        self.tracer.record(self.events)
+
+
+class Tracer:
+    # Finished interactions' spans collect here and go to the file in
+    # batches, written on a thread of their own so the loop never waits on
+    # the disk.
+    BATCH_SIZE = 1024
+    FLUSH_INTERVAL = 1
+
+    def __init__(self):
+        self.sample_rate = 0
+        self.output = None
+        self.pending = []
+        self.executor = None
+
+    def start(self, path, sample_rate=1, format="chrome"):
+        output_type = FORMATS[format]
+        self.output = output_type(open(path, "w", encoding="utf-8"))
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="redclay-tracing"
+        )
+        self.sample_rate = sample_rate
+        logger.info("tracing", extra={"path": path, "sample_rate": sample_rate})
+
+    def stop(self):
+        if self.output is None:
+            return
+        self.sample_rate = 0
+        self.flush()
+        self.executor.shutdown(wait=True)
+        self.output.close()
+        self.output = self.executor = None
+
+    def trace(self, tid):
+        # A Trace for a new interaction, or None to leave it untraced.
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+        return Trace(self, tid)
+
+    def record(self, events):
+        self.pending.extend(events)
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            batch, self.pending = self.pending, []
+            self.executor.submit(self.output.write_batch, batch)
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            self.flush()
+
+
+def trace_event(event, pid):
+    name, start, end, tid, args = event
+    # Chrome trace "complete" events, timed in microseconds.
+    record = {
+        "name": name,
+        "ph": "X",
+        "ts": round(start * 1e6, 3),
+        "dur": round((end - start) * 1e6, 3),
+        "pid": pid,
+        "tid": tid,
+    }
+    if args:
+        record["args"] = args
+    return record
+
+
+class ChromeTraceOutput:
+    # The JSON array format. Viewers forgive a missing "]", so a trace cut
+    # short by a crash still loads.
+    def __init__(self, file):
+        self.file = file
+        self.pid = os.getpid()
+        self.file.write("[\n")
+        self.separator = ""
+
+    def write_batch(self, events):
+        for event in events:
+            self.file.write(self.separator + json.dumps(trace_event(event, self.pid)))
+            self.separator = ",\n"
+        self.file.flush()
+
+    def close(self):
+        self.file.write("\n]\n")
+        self.file.close()
+
+
+class JsonLinesOutput:
+    def __init__(self, file):
+        self.file = file
+        self.pid = os.getpid()
+
+    def write_batch(self, events):
+        for event in events:
+            self.file.write(json.dumps(trace_event(event, self.pid)) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+FORMATS = {"chrome": ChromeTraceOutput, "jsonl": JsonLinesOutput}
+
+TRACER = Tracer()
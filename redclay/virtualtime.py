@@ -0,0 +1,47 @@
+import asyncio
+import selectors
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    # An event loop whose clock only moves when there's nothing else to do:
+    # then it jumps straight to the next timer. Sleeps, timeouts and the
+    # TimingWheel all run off loop.time(), so minutes of them pass in no
+    # time at all, in the same order every run.
+    #
+    # Real I/O still works, but time doesn't wait for it: anything not
+    # ready the moment the loop looks counts as not happening before the
+    # next timer. Use in-memory transports (see benchmark.open_memory_connection)
+    # for anything that has to be deterministic.
+    def __init__(self, start=0.0):
+        self.virtual_time = start
+        super().__init__(VirtualTimeSelector(self))
+
+    def time(self):
+        return self.virtual_time
+
+    def advance(self, seconds):
+        self.virtual_time += seconds
+
+
+class VirtualTimeSelector:
+    def __init__(self, loop):
+        self.loop = loop
+        self.selector = selectors.DefaultSelector()
+
+    def select(self, timeout=None):
+        events = self.selector.select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            # No timers at all. Only I/O can wake us now.
+            return self.selector.select(None)
+        self.loop.advance(timeout)
+        return []
+
+    def __getattr__(self, name):
+        # register(), unregister(), get_map() and the rest
+        return getattr(self.selector, name)
+
+
+class VirtualTimeLoopPolicy(asyncio.DefaultEventLoopPolicy):
+    _loop_factory = VirtualTimeLoop
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from redclay.logging import TASK_CONTEXTS, logging_context
+from redclay.metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG = METRICS.gauge(
+    "redclay_loop_lag_seconds", "How late the event loop woke from its last probe"
+)
+LOOP_LAG_PROBES = METRICS.histogram(
+    "redclay_loop_lag_probe_seconds", "How late the event loop woke for each probe"
+)
+
+
+class Watchdog:
+    # A probe on the event loop wakes every interval and records how late it
+    # was. A helper thread watches for the probe going quiet: if the loop
+    # hasn't come round for threshold seconds, something is blocking it,
+    # and the helper logs the loop thread's stack while it still is.
+    INTERVAL = 0.1
+
+    def __init__(self, threshold=0.5, interval=INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self.loop = None
+        self.loop_thread = None
+        self.heartbeat = None
+        self.reported = None
+        self.stopping = threading.Event()
+        self.thread = None
+        self.probing = None
+
+    def start(self):
+        # Call from the loop thread.
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.probing = asyncio.ensure_future(self.probe())
+        if self.threshold:
+            self.thread = threading.Thread(
+                target=self.watch, name="redclay-watchdog", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        self.probing.cancel()
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+
+    async def probe(self):
+        while True:
+            start = self.loop.time()
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0, self.loop.time() - start - self.interval)
+            LOOP_LAG.set(lag)
+            LOOP_LAG_PROBES.observe(lag)
+
+    # the helper thread
+
+    def watch(self):
+        while not self.stopping.wait(self.interval):
+            heartbeat = self.heartbeat
+            blocked_for = time.monotonic() - heartbeat - self.interval
+            # Once per stall: the heartbeat moves on when the loop does.
+            if blocked_for >= self.threshold and heartbeat != self.reported:
+                self.reported = heartbeat
+                self.report(blocked_for, *self.capture())
+
+    def capture(self):
+        # The loop thread's stack, and the logging context of the task it's
+        # running, if any.
+        frame = sys._current_frames().get(self.loop_thread)
+        stack = traceback.extract_stack(frame) if frame else []
+        task = asyncio.current_task(self.loop)
+        context = TASK_CONTEXTS.get(task, {}) if task is not None else {}
+        return stack, context
+
+    def report(self, blocked_for, stack, context):
+        if not logger.isEnabledFor(logging.WARNING):
+            return
+        # Attribute the record to wherever the loop is stuck.
+        filename, lineno, func = stack[-1][:3] if stack else ("(unknown)", 0, None)
+        sinfo = "Event loop stack (most recent call last):\n" + "".join(
+            traceback.format_list(stack)
+        )
+        with logging_context(**context):
+            record = logger.makeRecord(
+                logger.name,
+                logging.WARNING,
+                filename,
+                lineno,
+                "event loop blocked",
+                (),
+                None,
+                func,
+                {"seconds": round(blocked_for, 3)},
+                sinfo,
+            )
+        logger.handle(record)
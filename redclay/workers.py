@@ -0,0 +1,166 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import time
+
+from redclay.logging import logging_context
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    # Supervise a fixed number of worker processes, restarting any that die
+    # until we're asked to stop. Each worker gets its index and a shared
+    # connection gauge that it keeps up to date and we report on.
+    POLL_INTERVAL = 1
+    REPORT_INTERVAL = 60
+    RESTART_DELAY = 1
+    MAX_RESTART_DELAY = 30
+    # a worker that dies sooner than this after starting is crashing, not
+    # just unlucky, so back off before restarting it
+    MIN_HEALTHY_UPTIME = 10
+    SHUTDOWN_TIMEOUT = 10
+
+    def __init__(self, count, target):
+        self.target = target
+        self.workers = [Worker(index) for index in range(count)]
+        self.stopping = False
+        self.next_report = None
+
+    def run(self):
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self.handle_stop_signal)
+        signal.signal(signal.SIGUSR2, self.forward_signal)
+        signal.signal(signal.SIGHUP, self.forward_signal)
+
+        self.start()
+        try:
+            while not self.stopping:
+                self.poll(self.POLL_INTERVAL)
+        finally:
+            self.shutdown()
+
+    def handle_stop_signal(self, signum, frame):
+        logger.info("stopping workers", extra={"signal": signum})
+        self.stopping = True
+
+    def forward_signal(self, signum, frame):
+        # e.g. SIGUSR2, to have every worker profile itself, or SIGHUP to
+        # have them reload
+        for worker in self.workers:
+            if worker.restart_at is None and worker.process.pid:
+                os.kill(worker.process.pid, signum)
+
+    def start(self):
+        for worker in self.workers:
+            self.start_worker(worker)
+        self.next_report = time.monotonic() + self.REPORT_INTERVAL
+
+    def start_worker(self, worker):
+        worker.connections.value = 0
+        worker.process = multiprocessing.Process(
+            target=run_worker,
+            args=(self.target, worker.index, worker.connections),
+            name=f"redclay-worker-{worker.index}",
+            daemon=True,
+        )
+        worker.process.start()
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        logger.info(
+            "started worker", extra={"worker": worker.index, "pid": worker.process.pid}
+        )
+
+    def poll(self, timeout):
+        running = {
+            worker.process.sentinel: worker
+            for worker in self.workers
+            if worker.restart_at is None
+        }
+        for sentinel in multiprocessing.connection.wait(running, timeout):
+            self.handle_exit(running[sentinel])
+
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.restart_at is not None and worker.restart_at <= now:
+                self.start_worker(worker)
+
+        if now >= self.next_report:
+            self.report()
+            self.next_report = now + self.REPORT_INTERVAL
+
+    def handle_exit(self, worker):
+        worker.process.join()
+        if self.stopping:
+            return
+
+        now = time.monotonic()
+        if now - worker.started < self.MIN_HEALTHY_UPTIME:
+            worker.restart_delay = min(
+                self.MAX_RESTART_DELAY, worker.restart_delay * 2 or self.RESTART_DELAY
+            )
+        else:
+            worker.restart_delay = self.RESTART_DELAY
+        worker.restart_at = now + worker.restart_delay
+        worker.connections.value = 0
+
+        logger.warning(
+            "worker exited",
+            extra={
+                "worker": worker.index,
+                "pid": worker.process.pid,
+                "exitcode": worker.process.exitcode,
+                "restart_delay": worker.restart_delay,
+            },
+        )
+
+    def connection_counts(self):
+        return [worker.connections.value for worker in self.workers]
+
+    def report(self):
+        counts = self.connection_counts()
+        logger.info(
+            "worker connections", extra={"connections": counts, "total": sum(counts)}
+        )
+
+    def shutdown(self):
+        self.stopping = True
+        self.report()
+
+        # Ask nicely, then insist.
+        live = [w.process for w in self.workers if w.process and w.process.is_alive()]
+        for process in live:
+            process.terminate()
+
+        deadline = time.monotonic() + self.SHUTDOWN_TIMEOUT
+        for process in live:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning("killing worker", extra={"pid": process.pid})
+                process.kill()
+                process.join()
+        logger.info("all workers stopped")
+
+
+class Worker:
+    def __init__(self, index):
+        self.index = index
+        self.connections = multiprocessing.Value("i", 0, lock=False)
+        self.process = None
+        self.started = None
+        self.restart_at = None
+        self.restart_delay = 0
+
+
+def run_worker(target, index, connections):
+    # The supervisor coordinates shutdown. It'll pass along a SIGTERM when
+    # it's time, so ignore the terminal's SIGINT.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # until the server wants them
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    with logging_context(worker=index):
+        target(index, connections)
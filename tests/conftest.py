@@ -0,0 +1,22 @@
+import asyncio
+import pytest
+
+from redclay.virtualtime import VirtualTimeLoop
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "virtual_time: run the test on a VirtualTimeLoop clock"
+    )
+
+
+@pytest.fixture
+def event_loop(request):
+    # pytest-asyncio's own fixture, but tests marked virtual_time get a loop
+    # whose sleeps and timeouts take no real time.
+    if request.node.get_closest_marker("virtual_time"):
+        loop = VirtualTimeLoop()
+    else:
+        loop = asyncio.get_event_loop_policy().new_event_loop()
+    yield loop
+    loop.close()
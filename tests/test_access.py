@@ -0,0 +1,143 @@
+import asyncio
+import ipaddress
+import logging
+import random
+
+import pytest
+
+from redclay.access import AccessList, PrefixTrie, parse_rules
+
+RULES = """\
+# a noisy range, except for one friend in it
+ban 192.0.2.0/24
+allow 192.0.2.7
+ban 198.51.100.0/22  # and this
+ban 2001:db8::/32
+allow 2001:db8:1::/48
+"""
+
+
+@pytest.fixture
+def rules_file(tmp_path):
+    path = tmp_path / "access.rules"
+    path.write_text(RULES)
+    return path
+
+
+def test_parse_rules():
+    rules = list(parse_rules(["ban 10.1.2.3/8\n", "\n", "allow ::1 # me\n"]))
+    assert [(rule.action, str(rule.network)) for rule in rules] == [
+        ("ban", "10.0.0.0/8"),
+        ("allow", "::1/128"),
+    ]
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        "ban",
+        "ban 10.0.0.0/8 now",
+        "kick 10.0.0.0/8",
+        "ban 10.0.0.256",
+        "ban 10.0.0.0/33",
+        "ban 10.0.0.0/x",
+        "ban example.com",
+    ],
+)
+def test_parse_rules_errors(line):
+    with pytest.raises(ValueError, match=r"^line 2: "):
+        list(parse_rules(["# ok\n", line + "\n"]))
+
+
+def test_most_specific_rule_wins(rules_file):
+    access_list = AccessList(str(rules_file))
+    assert len(access_list) == 5
+
+    assert access_list.banned("192.0.2.1")
+    assert not access_list.banned("192.0.2.7")
+    assert access_list.banned("198.51.103.255")
+    assert not access_list.banned("198.51.104.0")
+    assert access_list.banned("2001:db8::1")
+    assert not access_list.banned("2001:db8:1::1")
+    assert access_list.match("203.0.113.1") is None
+
+    # An IPv4 peer on an IPv6 socket.
+    assert access_list.banned("::ffff:192.0.2.1")
+    # Unparseable, e.g. with a scope: not for us to judge.
+    assert access_list.match("fe80::1%eth0") is None
+
+
+def test_counts_matches(rules_file):
+    access_list = AccessList(str(rules_file))
+    for host in ["192.0.2.1", "192.0.2.2", "192.0.2.7", "2001:db8::1"]:
+        access_list.match(host)
+
+    top = [(str(rule.network), count) for rule, count in access_list.top_matches(2)]
+    assert top[0] == ("192.0.2.0/24", 2)
+    assert top[1][1] == 1
+
+
+@pytest.mark.asyncio
+async def test_reload(rules_file):
+    access_list = AccessList(str(rules_file))
+    access_list.match("192.0.2.1")
+
+    rules_file.write_text("ban 192.0.2.0/24\nban 203.0.113.0/24\n")
+    await access_list.reload()
+    assert access_list.banned("203.0.113.1")
+    assert not access_list.banned("2001:db8::1")
+    # Counts stay with the rules that stay.
+    assert dict(
+        (str(rule.network), count) for rule, count in access_list.top_matches(2)
+    ) == {"192.0.2.0/24": 1, "203.0.113.0/24": 1}
+
+    rules_file.write_text("ban 192.0.2.0/24\nban everyone\n")
+    with pytest.raises(ValueError, match="line 2"):
+        await access_list.reload()
+    assert access_list.banned("203.0.113.1")
+
+
+@pytest.mark.asyncio
+async def test_reload_on_signal_logs_errors(rules_file, caplog):
+    access_list = AccessList(str(rules_file))
+    rules_file.unlink()
+    with caplog.at_level(logging.ERROR):
+        access_list.start_reload()
+        await asyncio.wait([access_list.reloading])
+
+    assert "could not reload access list" in caplog.text
+    assert access_list.banned("192.0.2.1")
+
+
+def random_network(rng):
+    if rng.random() < 0.5:
+        return ipaddress.IPv4Network((rng.getrandbits(32), rng.randint(0, 32)), False)
+    return ipaddress.IPv6Network((rng.getrandbits(128), rng.randint(0, 128)), False)
+
+
+def test_trie_matches_longest_prefix():
+    # Crowded around a few addresses, so that prefixes share bits past the
+    # table, and split each other's nodes.
+    rng = random.Random(1)
+    bases = [random_network(rng) for _ in range(8)]
+    networks = []
+    for _ in range(500):
+        base = rng.choice(bases)
+        bits = base.max_prefixlen
+        address = int(base.network_address) ^ rng.getrandbits(bits) >> rng.randint(
+            0, bits
+        )
+        networks.append(type(base)((address, rng.randint(0, bits)), False))
+
+    trie = PrefixTrie()
+    for network in networks:
+        prefix = (
+            int(network.network_address) >> network.max_prefixlen - network.prefixlen
+        )
+        trie.insert(network.version, prefix, network.prefixlen, network)
+
+    for _ in range(2000):
+        network = rng.choice(networks)
+        address = network[rng.randrange(min(network.num_addresses, 2 ** 32))]
+        longest = max(n.prefixlen for n in networks if address in n)
+        assert trie.match(address.version, int(address)).prefixlen == longest
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import os
+import tracemalloc
+
+from asynctest import Mock
+import pytest
+
+from redclay.access import AccessList
+from redclay.admin import AdminConsole, run_admin_command, start_admin_console
+from redclay.server import Connection, ConnectionServer, Kicked
+from redclay.terminal import Terminal
+
+pytestmark = pytest.mark.asyncio
+
+
+async def add_connection(conn_server, username=None, peer=("10.0.0.1", 4000)):
+    writer = Mock()
+    writer.transport.get_write_buffer_size.return_value = 12
+    writer.get_extra_info.return_value = peer
+    conn = Connection(Terminal(Mock(), writer))
+    conn.term.line_buffer.append("abc")
+    conn_server.connections.add(conn)
+    await conn.push(tag="cmdloop", username=username)
+    return conn
+
+
+@pytest.fixture
+def conn_server():
+    return ConnectionServer()
+
+
+@pytest.fixture
+def console(conn_server):
+    return AdminConsole(conn_server)
+
+
+async def test_connections(console, conn_server):
+    conn = await add_connection(conn_server, username="alice")
+    conn.host = "alice.example.com"
+    await add_connection(conn_server, peer=("::1", 4001))
+
+    output = await console.run_command("connections\n")
+    header, *rows, total = output.splitlines()
+    assert header.split() == [
+        "ID",
+        "PEER",
+        "HOST",
+        "USER",
+        "TAG",
+        "IN",
+        "OUT",
+        "IDLE",
+    ]
+    assert total == "2 connections"
+    row = next(row.split() for row in rows if "alice" in row)
+    assert row[:7] == [
+        str(id(conn.term)),
+        "10.0.0.1:4000",
+        "alice.example.com",
+        "alice",
+        "cmdloop",
+        "3",
+        "12",
+    ]
+    assert any("[::1]:4001" in row for row in rows)
+
+
+async def test_kick(console, conn_server):
+    conn = await add_connection(conn_server)
+    conn.interrupt = Mock()
+
+    output = await console.run_command(f"kick {id(conn.term)} Be nice.\n")
+    assert output == f"kicked {id(conn.term)}\n"
+    (kick,), _ = conn.interrupt.call_args
+    assert isinstance(kick, Kicked)
+    assert str(kick) == "Be nice."
+
+
+async def test_kick_unknown(console):
+    output = await console.run_command("kick 12345\n")
+    assert output.startswith("error: LookupError")
+
+
+async def test_message(console, conn_server):
+    conn = await add_connection(conn_server)
+    other = await add_connection(conn_server)
+
+    output = await console.run_command(f"message {id(conn.term)} 'hi there'\n")
+    assert output == "sent to 1 connections\n"
+    conn.term.writer.write.assert_called_once_with(b"\r\nhi there\r\n")
+    other.term.writer.write.assert_not_called()
+
+
+async def test_access(tmp_path, console, conn_server):
+    assert await console.run_command("access\n") == "no access list\n"
+
+    path = tmp_path / "access.rules"
+    path.write_text("ban 192.0.2.0/24\nallow 192.0.2.7\n")
+    conn_server.admission.access_list = AccessList(str(path))
+    conn_server.admission.access_list.match("192.0.2.1")
+    output = await console.run_command("access 1\n")
+    assert [line.split() for line in output.splitlines()] == [
+        ["ACTION", "NETWORK", "MATCHES"],
+        ["ban", "192.0.2.0/24", "1"],
+        ["2", "rules"],
+    ]
+
+    path.write_text("ban 192.0.2.0/24\n")
+    assert await console.run_command("access reload\n") == "loaded 1 rules\n"
+    path.write_text("ban nobody\n")
+    output = await console.run_command("access reload\n")
+    assert output.startswith("error: ValueError")
+
+
+async def test_usage(console):
+    assert await console.run_command("message\n") == "usage: message ID MESSAGE\n"
+    assert await console.run_command("message 1\n") == "usage: message ID MESSAGE\n"
+    assert await console.run_command("broadcast\n") == "usage: broadcast MESSAGE\n"
+    assert await console.run_command("bogus\n") == "unknown command: bogus\n"
+    assert await console.run_command("\n") == ""
+    assert await console.run_command("quit\n") is None
+
+
+async def test_type_errors_inside_commands_are_errors(console, caplog):
+    async def command_broken():
+        return len(None)
+
+    console.command_broken = command_broken
+    with caplog.at_level(logging.ERROR):
+        output = await console.run_command("broken\n")
+    assert output.startswith("error: TypeError")
+    assert "admin command failed" in caplog.text
+    assert await console.run_command("broken now\n") == "usage: broken\n"
+
+
+async def test_loglevel(console):
+    target = logging.getLogger("redclay.test_admin")
+    try:
+        output = await console.run_command("loglevel redclay.test_admin debug\n")
+        assert output == "redclay.test_admin: DEBUG\n"
+        assert target.level == logging.DEBUG
+        output = await console.run_command("loglevel redclay.test_admin loud\n")
+        assert output == "unknown level: loud\n"
+    finally:
+        target.setLevel(logging.NOTSET)
+
+
+async def test_tasks(console):
+    output = await console.run_command("tasks 1\n")
+    assert "Stack for <Task" in output
+    assert output.endswith(f"{len(asyncio.all_tasks())} tasks\n")
+
+
+async def test_latency(console):
+    output = await console.run_command("latency\n")
+    assert output.split()[:6] == ["METRIC", "LABELS", "COUNT", "P50", "P90", "P99"]
+
+
+async def test_console_over_socket(tmp_path, conn_server):
+    path = str(tmp_path / "admin.sock")
+    await add_connection(conn_server, username="alice")
+    server = await start_admin_console(path, conn_server)
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    async with server:
+        output = await run_admin_command(path, ["connections"])
+        assert "alice" in output
+        assert "1 connections" in output
+
+        output = await run_admin_command(path, ["metrics"])
+        assert "# TYPE redclay_accepts_total counter" in output
+
+
+async def test_memory(console, conn_server):
+    await add_connection(conn_server)
+    output = await console.run_command("memory\n")
+    assert output == "tracemalloc is not tracing; try 'memory start'\n"
+
+    assert await console.run_command("memory start 5\n") == (
+        "tracing allocations from now on\n"
+    )
+    try:
+        output = await console.run_command("memory 3\n")
+    finally:
+        await console.run_command("memory stop\n")
+    lines = output.splitlines()
+    assert lines[0].startswith("traced:")
+    assert lines[1].startswith("per connection:")
+    assert "by code:" in lines
+    assert not tracemalloc.is_tracing()
@@ -0,0 +1,88 @@
+import pytest
+
+from redclay.access import AccessList
+from redclay.admission import REFUSALS, AdmissionControl, Refusal
+
+
+def test_unlimited():
+    admission = AdmissionControl()
+    for port in range(100):
+        assert admission.admit(("10.0.0.1", port), port) is None
+    assert admission.hosts == {}
+
+
+def test_global_limit():
+    refused = REFUSALS.values[("full",)]
+    admission = AdmissionControl(max_connections=2)
+    assert admission.admit(("10.0.0.1", 1), 1) is None
+    assert admission.admit(("10.0.0.1", 2), 2) is Refusal.FULL
+    assert REFUSALS.values[("full",)] == refused + 1
+
+
+def test_per_host_limit():
+    admission = AdmissionControl(per_host=2)
+    assert admission.admit(("10.0.0.1", 1), 0) is None
+    assert admission.admit(("10.0.0.1", 2), 0) is None
+    assert admission.admit(("10.0.0.1", 3), 0) is Refusal.HOST
+    assert admission.admit(("10.0.0.2", 1), 0) is None
+
+    admission.remove(("10.0.0.1", 1))
+    assert admission.admit(("10.0.0.1", 4), 0) is None
+
+
+def test_per_subnet_limit():
+    admission = AdmissionControl(per_subnet=2)
+    assert admission.admit(("10.0.0.1", 1), 0) is None
+    assert admission.admit(("10.0.0.2", 1), 0) is None
+    assert admission.admit(("10.0.0.3", 1), 0) is Refusal.SUBNET
+    assert admission.admit(("10.0.1.1", 1), 0) is None
+
+    admission.remove(("10.0.0.1", 1))
+    admission.remove(("10.0.0.2", 1))
+    admission.remove(("10.0.1.1", 1))
+    assert admission.subnets == {}
+
+
+def test_ipv6_subnets():
+    admission = AdmissionControl(per_subnet=1)
+    assert admission.admit(("2001:db8::1", 1, 0, 0), 0) is None
+    assert admission.admit(("2001:db8::2", 1, 0, 0), 0) is Refusal.SUBNET
+    assert admission.admit(("2001:db8:0:1::1", 1, 0, 0), 0) is None
+    # IPv4-mapped addresses count as their IPv4 subnet.
+    assert admission.admit(("10.0.0.1", 1), 0) is None
+    assert admission.admit(("::ffff:10.0.0.2", 1, 0, 0), 0) is Refusal.SUBNET
+
+
+def test_accept_rate():
+    admission = AdmissionControl(accepts_per_sec=0.01, accepts_burst=2)
+    assert admission.admit(("10.0.0.1", 1), 0) is None
+    assert admission.admit(("10.0.0.2", 1), 0) is None
+    assert admission.admit(("10.0.0.3", 1), 0) is Refusal.RATE
+
+
+def test_banned_before_rate(tmp_path):
+    path = tmp_path / "access.rules"
+    path.write_text("ban 10.0.0.0/8\n")
+    admission = AdmissionControl(
+        accepts_per_sec=0.01, accepts_burst=1, access_list=AccessList(str(path))
+    )
+    refused = REFUSALS.values[("banned",)]
+    # Not spending the bucket on connections we'd refuse anyway.
+    assert admission.admit(("10.0.0.1", 1), 0) is Refusal.BANNED
+    assert admission.admit(("::ffff:10.0.0.2", 1, 0, 0), 0) is Refusal.BANNED
+    assert admission.admit(("192.0.2.1", 1), 0) is None
+    assert REFUSALS.values[("banned",)] == refused + 2
+    assert admission.admit("", 0) is Refusal.RATE
+
+
+def test_unix_peers_not_limited_per_host():
+    admission = AdmissionControl(per_host=1)
+    assert admission.admit("", 0) is None
+    assert admission.admit("", 0) is None
+    admission.remove("")
+
+
+@pytest.mark.parametrize("refusal", list(Refusal))
+def test_refusals_are_pre_encoded(refusal):
+    assert refusal.value.endswith(b"\r\n")
+    refusal.value.decode("ascii")
@@ -0,0 +1,211 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import pytest
+from asynctest import Mock
+
+import redclay.game
+import redclay.gateway
+import redclay.presence
+import redclay.shards
+from redclay.admission import AdmissionControl, Refusal
+from redclay.benchmark import find_free_port, open_memory_connection, wait_for_server
+from redclay.gateway import (
+    FRAME_HEADER,
+    Frame,
+    FrameDecoder,
+    FrameType,
+    FrameWriter,
+    Gateway,
+    RemoteSession,
+    RemoteTerminal,
+    connect_to_game,
+    start_gateway_listener,
+)
+from redclay.server import ConnectionServer, ServerConfig, async_run_server
+
+
+def frame_bytes(type, session, payload):
+    return FRAME_HEADER.pack(type, session, len(payload)) + payload
+
+
+def test_frame_decoder_reassembles_frames():
+    data = frame_bytes(FrameType.LINE, 1, b"hello\n") + frame_bytes(
+        FrameType.CLOSE, 2, b""
+    )
+    decoder = FrameDecoder()
+
+    assert decoder.feed(data[:3]) == []
+    assert decoder.feed(data[3:12]) == []
+    assert decoder.feed(data[12:]) == [
+        Frame(FrameType.LINE, 1, b"hello\n"),
+        Frame(FrameType.CLOSE, 2, b""),
+    ]
+    assert decoder.buffer == b""
+
+
+@pytest.mark.asyncio
+async def test_frame_writer_batches_per_loop_iteration():
+    writer = Mock(is_closing=Mock(return_value=False))
+    frames = FrameWriter(writer)
+
+    frames.send(FrameType.TEXT, 1, b"one")
+    frames.send(FrameType.TEXT, 2, b"two")
+    writer.write.assert_not_called()
+
+    await asyncio.sleep(0)
+    writer.write.assert_called_once_with(
+        frame_bytes(FrameType.TEXT, 1, b"one") + frame_bytes(FrameType.TEXT, 2, b"two")
+    )
+
+
+@pytest.mark.asyncio
+async def test_remote_session_lost_while_reading():
+    link = Mock()
+    session = RemoteSession(link, 7, ("10.0.0.1", 1234), ("10.0.0.2", 6666))
+    reading = asyncio.ensure_future(session.read_line("Password: ", secret=True))
+    await asyncio.sleep(0)
+
+    link.frames.send.assert_called_once_with(FrameType.INPUT, 7, b"\x01Password: ")
+    session.lost()
+    with pytest.raises(EOFError):
+        await reading
+
+
+@pytest.mark.asyncio
+async def test_gateway_relays_a_session(tmp_path):
+    path = str(tmp_path / "game.sock")
+    conn_server = ConnectionServer(terminal_class=RemoteTerminal)
+    game = await start_gateway_listener(path, conn_server, redclay.game.boot)
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    gateway = Gateway([await connect_to_game(path)])
+    relaying = asyncio.ensure_future(gateway.serve())
+    try:
+        reader, writer = open_memory_connection(("10.0.0.1", 1234))
+        output = bytearray()
+        writer.transport.write = output.extend
+        writer.transport.feed(b"alice\r\nxe\r\nwho\r\nquit\r\n")
+
+        await asyncio.wait_for(gateway.handle_connection(reader, writer), 5)
+    finally:
+        relaying.cancel()
+        await asyncio.wait([relaying])
+        # Hang up on the game, and let it see us go.
+        for link in gateway.links:
+            link.writer.close()
+        game.close()
+        await game.wait_closed()
+        others = asyncio.all_tasks() - {asyncio.current_task()}
+        if others:
+            await asyncio.wait(others, timeout=5)
+    assert asyncio.all_tasks() == {asyncio.current_task()}
+
+    text = output.decode("ascii", errors="replace")
+    assert "Welcome, alice." in text
+    assert "1 online: alice" in text
+    assert text.endswith("Goodbye!\r\n")
+    assert not conn_server.connections
+
+
+@pytest.mark.asyncio
+async def test_gateway_refuses_before_building_a_terminal(monkeypatch):
+    link = Mock()
+    gateway = Gateway([(Mock(), link)], admission=AdmissionControl(per_host=1))
+    gateway.admission.add(("10.0.0.1", 1))
+    monkeypatch.setattr(redclay.gateway, "Terminal", Mock())
+
+    reader, writer = open_memory_connection(("10.0.0.1", 1234))
+    output = bytearray()
+    writer.transport.write = output.extend
+    await gateway.handle_connection(reader, writer)
+
+    assert output == Refusal.HOST.value
+    redclay.gateway.Terminal.assert_not_called()
+    link.write.assert_not_called()
+    assert gateway.admission.hosts["10.0.0.1"] == 1
+
+
+@pytest.mark.asyncio
+async def test_game_removes_its_gateway_socket(tmp_path):
+    path = str(tmp_path / "game.sock")
+    running = asyncio.ensure_future(async_run_server(ServerConfig(gateway_socket=path)))
+    while not os.path.exists(path):
+        await asyncio.sleep(0.01)
+
+    running.cancel()
+    await asyncio.wait([running])
+    assert not os.path.exists(path)
+
+
+# a real game split over two shards, with a gateway
+
+
+@pytest.fixture
+def sharded_server(tmp_path):
+    port = find_free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "redclay",
+            "run_server",
+            "--gateways=1",
+            "--shards=2",
+            f"--bind=127.0.0.1:{port}",
+            f"--gateway-socket={tmp_path / 'game.sock'}",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    yield port
+    # The supervisor stops its workers on the way out.
+    process.terminate()
+    process.wait()
+
+
+async def log_in(port, username):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    await reader.readuntil(b"Username: ")
+    writer.write(username.encode("ascii") + b"\r\n")
+    await reader.readuntil(b"Password: ")
+    writer.write(b"pw" + username[-1:].encode("ascii") + b"\r\n")
+    await reader.readuntil(f"{username}> ".encode("ascii"))
+    return reader, writer
+
+
+@pytest.mark.asyncio
+async def test_players_move_between_shards(sharded_server):
+    shards = redclay.shards.Shards()
+    shards.configure(0, 2)
+    # one zone on each shard
+    assert shards.owner("plaza") != shards.owner("market")
+
+    await wait_for_server(sharded_server)
+    alice_reader, alice = await log_in(sharded_server, "alice")
+    bob_reader, bob = await log_in(sharded_server, "bob")
+
+    alice.write(b"go market\r\n")
+    await alice_reader.readuntil(b"alice> ")
+    alice.write(b"look\r\n")
+    response = await alice_reader.readuntil(b"alice> ")
+    assert redclay.game.ZONES["market"].encode("ascii") in response
+
+    # Shouts cross shards; says stay in the zone.
+    bob.write(b"shout anyone?\r\n")
+    await bob_reader.readuntil(b"bob> ")
+    await asyncio.wait_for(alice_reader.readuntil(b'bob shouts, "anyone?"'), 5)
+    # So does who's online, once alice's new shard has said she's there.
+    await asyncio.sleep(redclay.presence.Presence.FLUSH_INTERVAL * 2)
+    bob.write(b"who\r\n")
+    response = await bob_reader.readuntil(b"bob> ")
+    assert b"2 online: alice, bob" in response
+
+    alice.write(b"go plaza\r\nsay hi bob\r\n")
+    await asyncio.wait_for(bob_reader.readuntil(b'alice says, "hi bob"'), 5)
+
+    alice.write(b"quit\r\n")
+    await asyncio.wait_for(alice_reader.readuntil(b"Goodbye!"), 5)
+    for writer in (alice, bob):
+        writer.close()
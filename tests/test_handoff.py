@@ -0,0 +1,240 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+from asynctest import CoroutineMock, Mock
+
+import redclay.game
+from redclay.benchmark import find_free_port, wait_for_server
+from redclay.handoff import Channel, bind_unix_socket
+from redclay.server import (
+    Connection,
+    ConnectionServer,
+    IdleTimeout,
+    decode_context_value,
+    encode_context_value,
+)
+
+
+def test_channel_round_trip():
+    left, right = socket.socketpair()
+    sender, receiver = Channel(left), Channel(right)
+    r, w = os.pipe()
+    try:
+        sender.send_sync({"type": "connection", "state": {"x": [1, "two"]}}, [w])
+        message, fds = receiver.receive_sync()
+        assert message == {"type": "connection", "state": {"x": [1, "two"]}}
+        assert len(fds) == 1
+
+        # The fd we got is a new descriptor for the same pipe.
+        assert fds[0] != w
+        os.write(fds[0], b"hello")
+        assert os.read(r, 5) == b"hello"
+        os.close(fds[0])
+
+        sender.send_sync({"type": "done"})
+        assert receiver.receive_sync() == ({"type": "done"}, [])
+    finally:
+        sender.close()
+        receiver.close()
+        os.close(r)
+        os.close(w)
+
+
+def test_channel_eof():
+    left, right = socket.socketpair()
+    receiver = Channel(right)
+    left.close()
+    with pytest.raises(EOFError):
+        receiver.receive_sync()
+    receiver.close()
+
+
+def test_takeover_socket_is_private(tmp_path):
+    path = str(tmp_path / "handoff.sock")
+    listener = bind_unix_socket(path)
+    try:
+        assert os.stat(path).st_mode & 0o777 == 0o600
+        assert not listener.getblocking()
+    finally:
+        listener.close()
+
+
+def test_context_value_round_trip():
+    prompt = redclay.game.PasswordPrompt()
+    prompt.extra = 3
+    encoded = encode_context_value(prompt)
+    assert encoded == {
+        "__class__": "redclay.game.PasswordPrompt",
+        "attrs": {"extra": 3},
+    }
+
+    decoded = decode_context_value(encoded)
+    assert isinstance(decoded, redclay.game.PasswordPrompt)
+    assert decoded.extra == 3
+    assert decode_context_value("plain") == "plain"
+
+
+def test_context_containers_round_trip():
+    value = {
+        "class": "not a prompt",
+        "attrs": [1, {"prompt": redclay.game.CommandPrompt()}],
+    }
+    decoded = decode_context_value(json.loads(json.dumps(encode_context_value(value))))
+    assert decoded["class"] == "not a prompt"
+    assert decoded["attrs"][0] == 1
+    assert isinstance(decoded["attrs"][1]["prompt"], redclay.game.CommandPrompt)
+
+    with pytest.raises(ValueError):
+        encode_context_value({"__class__": "sneaky"})
+
+
+@pytest.mark.asyncio
+async def test_connection_state_round_trip():
+    term = Mock(dump_state=Mock(return_value={"echo": "ON"}))
+    conn = Connection(term)
+    await conn.push(tag="auth", tries=1, prompt=redclay.game.PasswordPrompt())
+    state = conn.dump_state()
+
+    new_term = Mock()
+    resumed = Connection(new_term)
+    await resumed.load_state(state)
+
+    assert resumed["tag"] == "auth"
+    assert resumed["tries"] == 1
+    assert isinstance(resumed["prompt"], redclay.game.PasswordPrompt)
+    assert len(resumed.context_stack) == 2
+    new_term.load_state.assert_called_once_with({"echo": "ON"})
+
+
+@pytest.mark.asyncio
+async def test_linkdead_sessions_round_trip(event_loop):
+    old = ConnectionServer(linkdead_grace=60)
+    context_stack = [{"tag": "cmdloop", "prompt": redclay.game.CommandPrompt()}]
+    old.connections.hold("alice", context_stack, b"you were here\r\n", 60)
+    state = json.loads(json.dumps(old.dump_linkdead()))
+    old.timers.stop()
+
+    new = ConnectionServer(linkdead_grace=60)
+    for session in state:
+        new.load_linkdead(session)
+    session = new.connections.linkdead["alice"]
+    assert session.context_stack[0]["tag"] == "cmdloop"
+    assert isinstance(session.context_stack[0]["prompt"], redclay.game.CommandPrompt)
+    assert session.scrollback == b"you were here\r\n"
+    assert session.expires - event_loop.time() == pytest.approx(60, abs=1)
+    assert len(new.timers) == 1
+    new.timers.stop()
+
+
+@pytest.mark.asyncio
+async def test_interrupt_while_waiting_for_input():
+    conn = Connection(Mock())
+    started = asyncio.Event()
+
+    async def wait():
+        with conn.waiting_for_input():
+            started.set()
+            await asyncio.sleep(10)
+
+    task = asyncio.ensure_future(wait())
+    await started.wait()
+    conn.interrupt(IdleTimeout())
+    with pytest.raises(IdleTimeout):
+        await task
+    assert conn.input_task is None
+
+
+@pytest.mark.asyncio
+async def test_interrupt_before_waiting_for_input():
+    conn = Connection(Mock())
+    conn.interrupt(IdleTimeout())
+    with pytest.raises(IdleTimeout):
+        with conn.waiting_for_input():
+            pass
+
+    # It only fires once.
+    with conn.waiting_for_input():
+        pass
+
+
+@pytest.mark.asyncio
+async def test_migrate_all_without_connections():
+    conn_server = ConnectionServer()
+    send = CoroutineMock()
+    assert await conn_server.migrate_all(send) == 0
+    send.assert_not_called()
+
+
+# two real server processes
+
+
+def start_server(*args):
+    return subprocess.Popen(
+        [sys.executable, "-m", "redclay", "run_server", *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def wait_for_path(path, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def processes():
+    started = []
+    yield started
+    for process in started:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+@pytest.mark.asyncio
+async def test_takeover_keeps_connections(tmp_path, processes):
+    port = find_free_port()
+    path = str(tmp_path / "handoff.sock")
+
+    old = start_server("--bind", f"127.0.0.1:{port}", "--handoff-socket", path)
+    processes.append(old)
+    await wait_for_server(port)
+    wait_for_path(path)
+
+    # One player logged in, one halfway through logging in.
+    player_reader, player_writer = await asyncio.open_connection("127.0.0.1", port)
+    await player_reader.readuntil(b"Username: ")
+    player_writer.write(b"alice\r\n")
+    await player_reader.readuntil(b"Password: ")
+    player_writer.write(b"pwe\r\n")
+    await player_reader.readuntil(b"alice> ")
+
+    login_reader, login_writer = await asyncio.open_connection("127.0.0.1", port)
+    await login_reader.readuntil(b"Username: ")
+    login_writer.write(b"bob\r\n")
+    await login_reader.readuntil(b"Password: ")
+
+    new = start_server("--takeover", path)
+    processes.append(new)
+    loop = asyncio.get_event_loop()
+    assert await loop.run_in_executor(None, old.wait, 20) == 0
+
+    # Both carry on in the new process.
+    player_writer.write(b"still here\r\n")
+    assert await player_reader.readuntil(b"alice> ") == b"still here\r\nalice> "
+    login_writer.write(b"pwb\r\n")
+    await login_reader.readuntil(b"bob> ")
+
+    # And the new process is accepting.
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    await reader.readuntil(b"Username: ")
+    for w in (player_writer, login_writer, writer):
+        w.close()
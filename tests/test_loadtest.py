@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+from asynctest import Mock
+
+from redclay.benchmark import find_free_port, wait_for_server
+from redclay.loadtest import LoadStats, TelnetClient, run_load
+from redclay.server import ServerConfig, async_run_server
+from redclay.telnet import B, OPTIONS
+
+
+def make_client(*chunks):
+    reader = asyncio.StreamReader()
+    for chunk in chunks:
+        reader.feed_data(chunk)
+    return TelnetClient(reader, Mock())
+
+
+def negotiation(command, option):
+    return B.IAC.byte + command.byte + bytes([option])
+
+
+@pytest.mark.asyncio
+async def test_read_until():
+    client = make_client(b"Welcome\r\n\r\nUser", b"name: extra")
+    assert await client.read_until("Username: ") == "Welcome\n\nUsername: "
+    assert client.text == "extra"
+
+
+@pytest.mark.asyncio
+async def test_read_until_eof():
+    client = make_client(b"The server is full.\r\n")
+    client.reader.feed_eof()
+    with pytest.raises(EOFError):
+        await client.read_until("Username: ")
+
+
+@pytest.mark.asyncio
+async def test_accepts_server_echo_once():
+    client = make_client(negotiation(B.WILL, OPTIONS.ECHO), b"Password: ")
+    await client.read_until("Password: ")
+    client.writer.write.assert_called_once_with(negotiation(B.DO, OPTIONS.ECHO))
+
+    client.writer.write.reset_mock()
+    client.reader.feed_data(
+        negotiation(B.WONT, OPTIONS.ECHO) + negotiation(B.WONT, OPTIONS.ECHO) + b"> "
+    )
+    await client.read_until("> ")
+    client.writer.write.assert_called_once_with(negotiation(B.DONT, OPTIONS.ECHO))
+
+
+@pytest.mark.asyncio
+async def test_answers_timing_mark_and_refuses_others():
+    client = make_client(
+        negotiation(B.DO, OPTIONS.TM), negotiation(B.DO, 24), negotiation(B.WILL, 3)
+    )
+    client.reader.feed_eof()
+    with pytest.raises(EOFError):
+        await client.read_until("> ")
+
+    written = [args[0] for args, _ in client.writer.write.call_args_list]
+    assert written == [
+        negotiation(B.WILL, OPTIONS.TM),
+        negotiation(B.WONT, 24),
+        negotiation(B.DONT, 3),
+    ]
+
+
+def test_send_line():
+    client = TelnetClient(None, Mock())
+    client.send_line("look")
+    client.writer.write.assert_called_once_with(b"look\r\n")
+
+
+@pytest.mark.asyncio
+async def test_run_load_against_server():
+    port = find_free_port()
+    server = asyncio.ensure_future(
+        async_run_server(ServerConfig(bind=[("127.0.0.1", port)]))
+    )
+    try:
+        await wait_for_server(port)
+        stats = await run_load(
+            "127.0.0.1", port, clients=3, ramp=0, commands=4, think_time=0, timeout=5
+        )
+    finally:
+        server.cancel()
+        await asyncio.gather(server, return_exceptions=True)
+
+    assert stats.errors == {}
+    assert stats.completed == 3
+    assert len(stats.command_times) == 12
+    assert stats.peak_concurrent == 3
@@ -1,4 +1,6 @@
-from redclay.logging import logging_context, get_logging_context
+import asyncio
+
+from redclay.logging import TASK_CONTEXTS, logging_context, get_logging_context
 
 
 def test_logging_context_initially_empty():
@@ -17,3 +19,16 @@ def test_nested_logging_context_shadows_fields():
             assert get_logging_context() == {"foo": 1, "bar": 5, "baz": 9}
         assert get_logging_context() == {"foo": 1, "bar": 2}
     assert get_logging_context() == {}
+
+
+def test_task_contexts_follow_nesting():
+    async def task():
+        me = asyncio.current_task()
+        assert me not in TASK_CONTEXTS
+        with logging_context(term=1):
+            with logging_context(user="alice"):
+                assert TASK_CONTEXTS[me] == {"term": 1, "user": "alice"}
+            assert TASK_CONTEXTS[me] == {"term": 1}
+        assert me not in TASK_CONTEXTS
+
+    asyncio.get_event_loop().run_until_complete(task())
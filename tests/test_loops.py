@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+from asynctest import Mock, patch
+
+from redclay import loops
+
+
+@pytest.fixture(autouse=True)
+def reset_policy():
+    yield
+    asyncio.set_event_loop_policy(None)
+
+
+def test_run_asyncio():
+    async def main():
+        return loops.loop_name()
+
+    assert loops.run(main(), "asyncio") == "asyncio"
+
+
+@patch("importlib.import_module")
+def test_install_uvloop(mock_import_module):
+    policy = asyncio.DefaultEventLoopPolicy()
+    mock_import_module.return_value = Mock(EventLoopPolicy=Mock(return_value=policy))
+
+    loops.install_loop_policy("uvloop")
+
+    mock_import_module.assert_called_once_with("uvloop")
+    assert asyncio.get_event_loop_policy() is policy
+
+
+@patch("importlib.import_module", side_effect=ImportError)
+def test_install_uvloop_missing(mock_import_module):
+    with pytest.raises(ImportError, match="requires the uvloop package"):
+        loops.install_loop_policy("uvloop")
+
+
+def test_run_virtual():
+    async def main():
+        await asyncio.sleep(3600)
+        return asyncio.get_event_loop().time()
+
+    assert loops.run(main(), "virtual") == pytest.approx(3600)
+
+
+def test_loop_name():
+    class FakeLoop:
+        pass
+
+    FakeLoop.__module__ = "uvloop.loop"
+    assert loops.loop_name(FakeLoop()) == "uvloop"
@@ -0,0 +1,62 @@
+import inspect
+import tracemalloc
+
+import pytest
+
+from redclay.benchmark import open_memory_connection, run_memory_benchmark
+from redclay.memory import SourceIndex, allocations_by, format_allocations
+from redclay.terminal import Terminal
+from redclay.textutil import LineBuffer
+
+
+def test_source_index_finds_innermost_owner():
+    index = SourceIndex()
+    lines, start = inspect.getsourcelines(Terminal.__init__)
+    filename = inspect.getsourcefile(Terminal)
+    assert index.owner(filename, start + 1) == "Terminal.__init__"
+    assert index.owner(filename, 1) == "terminal.py (module)"
+
+
+def test_allocations_charged_to_our_code():
+    tracemalloc.start(10)
+    try:
+        baseline = tracemalloc.take_snapshot()
+        buffers = [LineBuffer() for _ in range(1000)]
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    by_code = {
+        allocation.where: allocation
+        for allocation in allocations_by(snapshot, "code", baseline)
+    }
+    assert by_code["LineBuffer.__init__"].size > 0
+    assert len(buffers) == 1000
+
+    (line,) = format_allocations(
+        [by_code["LineBuffer.__init__"]], limit=1, per=len(buffers)
+    )
+    assert line.endswith(" B  LineBuffer.__init__")
+
+
+@pytest.mark.asyncio
+async def test_memory_connection():
+    reader, writer = open_memory_connection(("10.0.0.1", 1))
+    assert writer.get_extra_info("peername") == ("10.0.0.1", 1)
+    writer.write(b"hello")
+    assert writer.transport.written == 5
+    writer.transport.feed(b"abc\n")
+    assert await reader.readline() == b"abc\n"
+    writer.close()
+    await writer.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_memory_benchmark():
+    stages = await run_memory_benchmark(20, frames=10)
+    assert [stage.prompt for stage in stages] == ["UsernamePrompt", "CommandPrompt"]
+    for stage in stages:
+        assert stage.total > 0
+        owners = [allocation.where for allocation in stage.by_code]
+        assert "Terminal.__init__" in owners
+        assert "LineBuffer.__init__" in owners
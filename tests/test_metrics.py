@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+from redclay.metrics import MetricsRegistry, start_metrics_server
+
+
+@pytest.fixture
+def registry():
+    return MetricsRegistry()
+
+
+def test_counter(registry):
+    counter = registry.counter("things_total", "Things")
+    counter.inc()
+    counter.inc(amount=4)
+    assert registry.render() == (
+        "# HELP things_total Things\n"
+        "# TYPE things_total counter\n"
+        "things_total 5\n"
+    )
+
+
+def test_labels(registry):
+    counter = registry.counter("closes_total", "Closes", ["reason"])
+    counter.inc("peer")
+    counter.inc("idle")
+    counter.inc("peer")
+    counter.inc('we "quote"')
+    lines = registry.render().splitlines()
+    assert lines[2:] == [
+        'closes_total{reason="idle"} 1',
+        'closes_total{reason="peer"} 2',
+        'closes_total{reason="we \\"quote\\""} 1',
+    ]
+
+
+def test_gauge(registry):
+    gauge = registry.gauge("lag", "Lag")
+    gauge.set(0.5)
+    gauge.inc(amount=1)
+    gauge.dec(amount=0.25)
+    assert registry.render().splitlines()[-1] == "lag 1.25"
+
+
+def test_callback_gauge(registry):
+    gauge = registry.callback_gauge("conns", "Conns", ["tag"])
+    assert registry.render().splitlines()[2:] == []
+
+    gauge.function = lambda: {("auth",): 2, ("cmdloop",): 3}
+    assert registry.render().splitlines()[2:] == [
+        'conns{tag="auth"} 2',
+        'conns{tag="cmdloop"} 3',
+    ]
+
+
+def test_metrics_sorted_by_name(registry):
+    registry.counter("b_total", "B")
+    registry.counter("a_total", "A")
+    lines = registry.render().splitlines()
+    assert lines[0] == "# HELP a_total A"
+    assert lines[3] == "# HELP b_total B"
+
+
+async def fetch(port, request):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(request)
+    response = await reader.read()
+    writer.close()
+    return response
+
+
+@pytest.mark.asyncio
+async def test_metrics_server(registry):
+    registry.counter("things_total", "Things").inc()
+    server = await start_metrics_server("127.0.0.1", 0, registry)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        response = await fetch(port, b"GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n")
+        headers, body = response.split(b"\r\n\r\n", 1)
+        assert headers.startswith(b"HTTP/1.0 200 OK\r\n")
+        assert b"Content-Type: text/plain; version=0.0.4" in headers
+        assert body.decode("utf-8") == registry.render()
+
+        response = await fetch(port, b"GET /nope HTTP/1.1\r\n\r\n")
+        assert response.startswith(b"HTTP/1.0 404 Not Found\r\n")
+
+
+def test_histogram(registry):
+    histogram = registry.histogram("t_seconds", "T", ["prompt"], buckets=[0.1, 1])
+    histogram.observe(0.05, "A")
+    histogram.observe(0.1, "A")
+    histogram.observe(0.5, "A")
+    histogram.observe(5, "A")
+    assert registry.render().splitlines()[2:] == [
+        't_seconds_bucket{prompt="A",le="0.1"} 2',
+        't_seconds_bucket{prompt="A",le="1"} 3',
+        't_seconds_bucket{prompt="A",le="+Inf"} 4',
+        't_seconds_sum{prompt="A"} 5.65',
+        't_seconds_count{prompt="A"} 4',
+    ]
+
+
+def test_histogram_quantile(registry):
+    histogram = registry.histogram("t_seconds", "T", buckets=[0.1, 1])
+    assert histogram.quantile(0.5) is None
+    for value in [0.01] * 90 + [0.5] * 9 + [3]:
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.99) == 1
+    assert histogram.quantile(1) == float("inf")
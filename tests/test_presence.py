@@ -0,0 +1,241 @@
+import asyncio
+import os
+
+from asynctest import Mock
+import pytest
+
+import redclay.game
+from redclay.presence import (
+    PRESENCE,
+    LocalBackend,
+    Presence,
+    PresenceHub,
+    UnixSocketBackend,
+    start_presence_hub,
+)
+from redclay.registry import ConnectionRegistry
+from redclay.server import Connection
+from redclay.terminal import Terminal
+
+pytestmark = pytest.mark.asyncio
+
+
+def make_connection():
+    writer = Mock()
+    writer.transport.get_write_buffer_size.return_value = 0
+    return Connection(Terminal(Mock(), writer))
+
+
+async def log_in(registry, username):
+    conn = make_connection()
+    registry.add(conn)
+    await conn.push(tag="auth", username=username)
+    await conn.pop(username=username)
+    await conn.push(tag="cmdloop", prompt=redclay.game.CommandPrompt())
+    return conn
+
+
+async def make_node(name, backend):
+    registry = ConnectionRegistry()
+    presence = Presence()
+    presence.handlers = PRESENCE.handlers
+    await presence.configure(registry, backend, node=name)
+    return presence, registry
+
+
+async def settle():
+    # past a flush, and the deliveries it sets off
+    await asyncio.sleep(Presence.FLUSH_INTERVAL * 2)
+
+
+async def test_hub_routes_batches():
+    hub = PresenceHub()
+    delivered = {"a": [], "b": [], "c": []}
+    for node, batches in delivered.items():
+        hub.join(node, batches.append)
+
+    hub.receive(
+        "a",
+        [
+            {"kind": "presence", "user": "alice", "node": "a", "here": True},
+            {"kind": "shout", "text": "hi"},
+        ],
+    )
+    assert delivered["a"] == []
+    assert delivered["b"] == delivered["c"]
+    assert [message["kind"] for message in delivered["b"][0]] == [
+        "presence",
+        "shout",
+    ]
+    assert hub.snapshot() == {"alice": ["a"]}
+
+    hub.receive("b", [{"kind": "tell", "to": "alice", "text": "psst"}])
+    assert delivered["a"] == [[{"kind": "tell", "to": "alice", "text": "psst"}]]
+    assert len(delivered["c"]) == 1
+
+    # Leaving takes everyone there with it.
+    hub.leave("a")
+    assert hub.snapshot() == {}
+    assert delivered["b"][-1] == [
+        {"kind": "presence", "user": "alice", "node": "a", "here": False}
+    ]
+
+
+async def test_presence_across_nodes():
+    hub = PresenceHub()
+    a, a_registry = await make_node("a", LocalBackend(hub))
+    b, b_registry = await make_node("b", LocalBackend(hub))
+
+    alice = await log_in(a_registry, "alice")
+    a.arrive(alice)
+    a.arrive(alice)
+    bob = await log_in(b_registry, "bob")
+    b.arrive(bob)
+    assert a.pending == [
+        {"kind": "presence", "user": "alice", "node": "a", "here": True}
+    ]
+    # Not until a's next batch.
+    assert await b.online() == ["bob"]
+    await settle()
+    assert await b.online() == ["alice", "bob"]
+
+    # Read again from the local copy, until news arrives from elsewhere.
+    assert b.directory is not None
+    a.depart(alice)
+    await settle()
+    assert b.directory is None
+    assert await b.online() == ["bob"]
+
+    await a.close()
+    await b.close()
+
+
+async def test_linkdead_players_stay_present():
+    registry = ConnectionRegistry(Mock(), linkdead_grace=60)
+    await PRESENCE.configure(registry)
+    try:
+        alice = await log_in(registry, "alice")
+        PRESENCE.arrive(alice)
+        registry.park(alice)
+        PRESENCE.depart(alice)
+        registry.discard(alice)
+        assert await PRESENCE.online() == ["alice"]
+
+        registry.expire_linkdead("alice")
+        assert await PRESENCE.online() == []
+    finally:
+        await PRESENCE.close()
+
+
+async def test_tell_another_node():
+    hub = PresenceHub()
+    await PRESENCE.configure(ConnectionRegistry(), LocalBackend(hub), node="a")
+    try:
+        b, b_registry = await make_node("b", LocalBackend(hub))
+        alice = await log_in(PRESENCE.registry, "alice")
+        PRESENCE.arrive(alice)
+        bob = await log_in(b_registry, "bob")
+        b.arrive(bob)
+        await settle()
+
+        prompt = alice["prompt"]
+        await prompt.handle_input(alice, "tell bob meet me at the harbor")
+        await prompt.handle_input(alice, "tell carol hello?")
+        await settle()
+
+        assert bob.term.scrollback_text() == (
+            '\nalice tells you, "meet me at the harbor"\n'
+        )
+        assert alice.term.scrollback_text() == (
+            'You tell bob, "meet me at the harbor"\ncarol isn\'t online.\n'
+        )
+        await b.close()
+    finally:
+        await PRESENCE.close()
+
+
+async def test_unix_socket_backend(tmp_path):
+    path = str(tmp_path / "presence.sock")
+    hub_server = await start_presence_hub(path)
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    a, a_registry = await make_node("a", UnixSocketBackend(path))
+    b, b_registry = await make_node("b", UnixSocketBackend(path))
+
+    alice = await log_in(a_registry, "alice")
+    a.arrive(alice)
+    bob = await log_in(b_registry, "bob")
+    b.arrive(bob)
+    await settle()
+    assert await a.online() == ["alice", "bob"]
+    assert await b.online() == ["alice", "bob"]
+
+    # b loses the hub, which forgets bob, until b rejoins and says again
+    # who's there.
+    b.backend.RECONNECT_INTERVAL = 0.01
+    b.backend.writer.transport.abort()
+    await settle()
+    assert await a.online() == ["alice", "bob"]
+    assert await b.online() == ["alice", "bob"]
+
+    await a.close()
+    await b.close()
+    await settle()
+    hub_server.close()
+    await hub_server.wait_closed()
+
+
+async def test_who_without_the_hub(tmp_path):
+    path = str(tmp_path / "presence.sock")
+    hub_server = await start_presence_hub(path)
+    backend = UnixSocketBackend(path)
+    backend.RECONNECT_INTERVAL = 60
+    await PRESENCE.configure(ConnectionRegistry(), backend, node="a")
+    try:
+        alice = await log_in(PRESENCE.registry, "alice")
+        PRESENCE.arrive(alice)
+        await settle()
+
+        hub_server.close()
+        await hub_server.wait_closed()
+        backend.writer.transport.abort()
+        await settle()
+
+        await alice["prompt"].handle_input(alice, "who")
+        assert alice.term.scrollback_text() == "1 online: alice\n"
+    finally:
+        await PRESENCE.close()
+
+
+async def test_directory_past_the_default_line_limit(tmp_path):
+    path = str(tmp_path / "presence.sock")
+    hub_server = await start_presence_hub(path)
+    a, a_registry = await make_node("a", UnixSocketBackend(path))
+    b = Presence()
+    # a batch and a directory well past StreamReader's 64 KiB default
+    b.here = {f"player-with-a-long-name-{i:05}" for i in range(5000)}
+    await b.configure(ConnectionRegistry(), UnixSocketBackend(path), node="b")
+    await settle()
+
+    assert len(await a.online()) == 5000
+
+    await a.close()
+    await b.close()
+    await settle()
+    hub_server.close()
+    await hub_server.wait_closed()
+
+
+async def test_directory_reads_time_out(tmp_path):
+    path = str(tmp_path / "presence.sock")
+    # a hub that never answers
+    server = await asyncio.start_unix_server(lambda reader, writer: None, path)
+    backend = UnixSocketBackend(path)
+    backend.DIRECTORY_TIMEOUT = 0.01
+    presence, registry = await make_node("a", backend)
+    presence.here.add("alice")
+
+    assert await presence.online() == ["alice"]
+
+    await presence.close()
+    server.close()
+    await server.wait_closed()
@@ -0,0 +1,71 @@
+import asyncio
+import os
+import pstats
+import time
+
+import pytest
+
+from redclay.logging import logging_context
+from redclay.profiling import DeterministicProfiler, Profiling, SamplingProfiler
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+@pytest.mark.asyncio
+async def test_sampling_profiler_tags_connections(tmp_path):
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    with logging_context(term=5):
+        busy(0.1)
+    profiler.stop()
+
+    path = tmp_path / "profile.folded"
+    profiler.write(str(path))
+    lines = path.read_text().splitlines()
+    busy_lines = [line for line in lines if "test_profiling:busy" in line]
+    assert busy_lines
+    for line in busy_lines:
+        stack, count = line.rsplit(" ", 1)
+        assert stack.startswith("conn-5;")
+        assert int(count) > 0
+
+
+def test_deterministic_profiler(tmp_path):
+    profiler = DeterministicProfiler()
+    profiler.start()
+    busy(0.01)
+    profiler.stop()
+
+    path = str(tmp_path / "profile.pstats")
+    profiler.write(path)
+    stats = pstats.Stats(path)
+    assert any(func[2] == "busy" for func in stats.stats)
+
+
+@pytest.mark.asyncio
+async def test_profiling_window(tmp_path):
+    profiling = Profiling("cprofile", str(tmp_path), window=0.05)
+    profiling.start(profiling.window)
+    assert profiling.running is not None
+    profiling.start(profiling.window)  # already running: ignored
+
+    await asyncio.sleep(0.1)
+    assert profiling.running is None
+    await profiling.close()
+    (filename,) = os.listdir(tmp_path)
+    assert filename.startswith(f"redclay-{os.getpid()}-")
+    assert filename.endswith(".pstats")
+
+
+@pytest.mark.asyncio
+async def test_profiling_until_closed(tmp_path):
+    profiling = Profiling("sampling", str(tmp_path))
+    profiling.start()
+    await asyncio.sleep(0.02)
+    await profiling.close()
+    (filename,) = os.listdir(tmp_path)
+    assert filename.endswith(".folded")
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from redclay.ratelimit import InputLimits, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_bucket_starts_full(clock):
+    bucket = TokenBucket(10, 100, clock=clock)
+    assert bucket.consume(100) == 0
+
+
+def test_bucket_debt_returns_delay(clock):
+    bucket = TokenBucket(10, 100, clock=clock)
+    assert bucket.consume(120) == pytest.approx(2)
+
+
+def test_bucket_try_consume_never_goes_into_debt(clock):
+    bucket = TokenBucket(1, 2, clock=clock)
+    assert bucket.try_consume()
+    assert bucket.try_consume()
+    assert not bucket.try_consume()
+    assert bucket.tokens == 0
+
+    clock.now = 1
+    assert bucket.try_consume()
+
+
+def test_bucket_refills_over_time(clock):
+    bucket = TokenBucket(10, 100, clock=clock)
+    bucket.consume(100)
+    clock.now = 5
+    assert bucket.consume(50) == 0
+    assert bucket.consume(10) == pytest.approx(1)
+
+
+def test_bucket_refill_capped_at_burst(clock):
+    bucket = TokenBucket(10, 100, clock=clock)
+    clock.now = 1000
+    assert bucket.consume(100) == 0
+    assert bucket.consume(1) > 0
+
+
+def test_limits_disabled():
+    limits = InputLimits(bytes_per_sec=0, lines_per_sec=0)
+    assert limits.byte_bucket() is None
+    assert limits.line_bucket() is None
+
+
+def test_bucket_keeps_time_with_its_own_loop():
+    previous = asyncio.get_event_loop()
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        bucket = TokenBucket(10, 100)
+    finally:
+        asyncio.set_event_loop(previous)
+        loop.close()
+    assert bucket.clock == loop.time
@@ -0,0 +1,154 @@
+from asynctest import Mock
+import pytest
+
+from redclay.registry import SKIPPED_BROADCASTS, ConnectionRegistry
+from redclay.server import Connection
+from redclay.terminal import Terminal
+
+pytestmark = pytest.mark.asyncio
+
+
+def make_connection(backlog=0):
+    writer = Mock()
+    writer.transport.get_write_buffer_size.return_value = backlog
+    return Connection(Terminal(Mock(), writer))
+
+
+@pytest.fixture
+def registry():
+    return ConnectionRegistry()
+
+
+async def test_add_and_discard(registry):
+    conn = make_connection()
+    registry.add(conn)
+    assert conn in registry
+    assert len(registry) == 1
+    assert conn.registry is registry
+
+    registry.discard(conn)
+    assert conn not in registry
+    assert conn.registry is None
+    registry.discard(conn)
+
+
+async def test_indexes_follow_context(registry):
+    conn = make_connection()
+    registry.add(conn)
+    await conn.push(tag="auth")
+    assert registry.by_tag("auth") == {conn}
+
+    await conn.set_context(username="alice")
+    assert registry.by_username("alice") == {conn}
+
+    await conn.pop(username="alice")
+    await conn.push(tag="cmdloop", zone="plaza")
+    assert registry.by_tag("auth") == set()
+    assert registry.by_tag("cmdloop") == {conn}
+    assert registry.by_zone("plaza") == {conn}
+    assert registry.usernames() == ["alice"]
+
+    await conn.set_context(zone="market")
+    assert registry.by_zone("plaza") == set()
+    assert registry.by_zone("market") == {conn}
+
+    registry.discard(conn)
+    assert registry.by_username("alice") == set()
+    assert registry.indexes == {"username": {}, "tag": {}, "zone": {}}
+
+
+async def test_broadcast_encodes_once(registry):
+    conns = [make_connection() for _ in range(3)]
+    for conn in conns:
+        registry.add(conn)
+
+    sent = registry.broadcast("hi\n", exclude=conns[0])
+    assert sent == 2
+
+    conns[0].term.writer.write.assert_not_called()
+    data = [conn.term.writer.write.call_args[0][0] for conn in conns[1:]]
+    assert data == [b"hi\r\n", b"hi\r\n"]
+    assert data[0] is data[1]
+    assert conns[1].term.scrollback_text() == "hi\n"
+
+
+async def test_broadcast_skips_backlogged(registry):
+    slow = make_connection(backlog=ConnectionRegistry.BROADCAST_WATERMARK + 1)
+    fast = make_connection()
+    registry.add(slow)
+    registry.add(fast)
+    skipped = SKIPPED_BROADCASTS.values[()]
+
+    assert registry.broadcast("hi\n") == 1
+    slow.term.writer.write.assert_not_called()
+    fast.term.writer.write.assert_called_once_with(b"hi\r\n")
+    assert SKIPPED_BROADCASTS.values[()] == skipped + 1
+
+
+async def test_broadcast_to_recipients(registry):
+    conns = [make_connection() for _ in range(2)]
+    for conn in conns:
+        registry.add(conn)
+
+    assert registry.broadcast("hi\n", recipients=conns[:1]) == 1
+    conns[1].term.writer.write.assert_not_called()
+
+
+async def test_park_and_reattach():
+    timers = Mock()
+    registry = ConnectionRegistry(timers=timers, linkdead_grace=60)
+    old = make_connection()
+    registry.add(old)
+    await old.push(tag="auth")
+    await old.pop(username="alice")
+    await old.push(tag="cmdloop", prompt="somewhere")
+    await old.send_message("you were here\n")
+
+    assert registry.park(old)
+    registry.discard(old)
+    timers.schedule.assert_called_once_with(60, registry.expire_linkdead, "alice")
+    assert "alice" in registry.linkdead
+
+    new = make_connection()
+    registry.add(new)
+    await new.push(tag="auth")
+    await new.send_message("Username: ")
+    await new.pop(username="alice")
+    assert await new.reattach()
+
+    assert new["prompt"] == "somewhere"
+    assert registry.by_tag("cmdloop") == {new}
+    assert new.scrollback() == "you were here\n"
+    assert registry.linkdead == {}
+    timers.schedule.return_value.cancel.assert_called_once_with()
+
+    # Nothing left to reattach to.
+    assert not await new.reattach()
+
+
+async def test_park_requires_login():
+    registry = ConnectionRegistry(timers=Mock(), linkdead_grace=60)
+    conn = make_connection()
+    registry.add(conn)
+    assert not registry.park(conn)
+    assert registry.linkdead == {}
+
+
+async def test_park_disabled():
+    registry = ConnectionRegistry(timers=Mock(), linkdead_grace=0)
+    conn = make_connection()
+    registry.add(conn)
+    await conn.set_context(username="alice")
+    assert not registry.park(conn)
+
+
+async def test_linkdead_expires():
+    registry = ConnectionRegistry(timers=Mock(), linkdead_grace=60)
+    conn = make_connection()
+    registry.add(conn)
+    await conn.set_context(username="alice")
+    registry.park(conn)
+
+    registry.expire_linkdead("alice")
+    assert registry.linkdead == {}
+    assert registry.unpark("alice") is None
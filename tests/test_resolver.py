@@ -0,0 +1,122 @@
+import asyncio
+import threading
+
+import pytest
+
+from redclay.resolver import Resolver
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class Lookup:
+    # A stand-in for getnameinfo(), on the resolver's threads.
+    def __init__(self, hostnames, release=None):
+        self.hostnames = hostnames
+        self.release = release
+        self.addresses = []
+
+    def __call__(self, address):
+        self.addresses.append(address)
+        if self.release is not None:
+            self.release.wait(5)
+        return self.hostnames.get(address)
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.mark.asyncio
+async def test_caches_hostnames(clock):
+    lookup = Lookup({"10.0.0.1": "one.example.com"})
+    resolver = Resolver(clock=clock, lookup=lookup)
+
+    assert await resolver.resolve("10.0.0.1") == "one.example.com"
+    assert await resolver.resolve("10.0.0.1") == "one.example.com"
+    assert lookup.addresses == ["10.0.0.1"]
+
+    clock.now = Resolver.TTL + 1
+    assert await resolver.resolve("10.0.0.1") == "one.example.com"
+    assert lookup.addresses == ["10.0.0.1", "10.0.0.1"]
+    resolver.close()
+
+
+@pytest.mark.asyncio
+async def test_caches_missing_hostnames(clock):
+    lookup = Lookup({})
+    resolver = Resolver(clock=clock, lookup=lookup)
+
+    assert await resolver.resolve("10.0.0.2") is None
+    assert await resolver.resolve("10.0.0.2") is None
+    assert len(lookup.addresses) == 1
+
+    # For less time than an answer.
+    clock.now = Resolver.NEGATIVE_TTL + 1
+    assert await resolver.resolve("10.0.0.2") is None
+    assert len(lookup.addresses) == 2
+    resolver.close()
+
+
+@pytest.mark.asyncio
+async def test_evicts_least_recently_used(clock):
+    lookup = Lookup({})
+    resolver = Resolver(cache_size=2, clock=clock, lookup=lookup)
+
+    for address in ["10.0.0.1", "10.0.0.2", "10.0.0.1", "10.0.0.3"]:
+        await resolver.resolve(address)
+    assert list(resolver.cache) == ["10.0.0.1", "10.0.0.3"]
+    resolver.close()
+
+
+@pytest.mark.asyncio
+async def test_shares_lookups(clock):
+    release = threading.Event()
+    lookup = Lookup({"10.0.0.1": "one.example.com"}, release)
+    resolver = Resolver(clock=clock, lookup=lookup)
+
+    lookups = [asyncio.ensure_future(resolver.resolve("10.0.0.1")) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    release.set()
+    assert await asyncio.gather(*lookups) == ["one.example.com"] * 3
+    assert lookup.addresses == ["10.0.0.1"]
+    resolver.close()
+
+
+@pytest.mark.asyncio
+async def test_gives_up_at_deadline(clock):
+    release = threading.Event()
+    lookup = Lookup({"10.0.0.1": "slow.example.com"}, release)
+    resolver = Resolver(timeout=0.01, clock=clock, lookup=lookup)
+
+    assert await resolver.resolve("10.0.0.1") is None
+    assert "10.0.0.1" not in resolver.cache
+
+    # The answer still comes in, for next time.
+    release.set()
+    await asyncio.wait_for(asyncio.shield(resolver.pending["10.0.0.1"]), 5)
+    assert await resolver.resolve("10.0.0.1") == "slow.example.com"
+    assert lookup.addresses == ["10.0.0.1"]
+    resolver.close()
+
+
+@pytest.mark.asyncio
+async def test_sheds_lookups_when_overloaded(clock):
+    release = threading.Event()
+    lookup = Lookup({}, release)
+    resolver = Resolver(threads=1, timeout=0.01, clock=clock, lookup=lookup)
+    resolver.MAX_PENDING = 2
+
+    for address in ["10.0.0.1", "10.0.0.2", "10.0.0.3"]:
+        assert await resolver.resolve(address) is None
+    assert sorted(resolver.pending) == ["10.0.0.1", "10.0.0.2"]
+
+    release.set()
+    await asyncio.wait_for(asyncio.gather(*resolver.pending.values()), 5)
+    resolver.close()
@@ -1,11 +1,22 @@
 import asyncio
+import logging
 
 import pytest
 from asynctest import CoroutineMock, Mock, patch
 
 import redclay.game
 import redclay.server
-from redclay.server import ConnectionServer, Connection, async_run_server
+from redclay.admission import AdmissionControl, Refusal
+from redclay.logging import get_logging_context
+from redclay.server import (
+    ConnectionServer,
+    Connection,
+    ServerConfig,
+    async_run_server,
+    run_server,
+)
+from redclay.textutil import LineBuffer
+from redclay.timers import TimingWheel
 
 pytestmark = pytest.mark.asyncio
 
@@ -30,6 +41,7 @@ def mock_Terminal():
     mock_terminal.sleep = CoroutineMock()
     mock_terminal.input = CoroutineMock(return_value="\n")
     mock_terminal.input_secret = CoroutineMock(return_value="\n")
+    mock_terminal.flush_response = CoroutineMock(return_value=None)
     return MockTerminal
 
 
@@ -69,6 +81,95 @@ async def test_run_server_callback(mock_start_server, MockConnectionServer):
     )
 
 
+@patch("redclay.server.ConnectionServer")
+@patch("asyncio.start_server", new_callable=CoroutineMock)
+async def test_run_server_binds_each_address(mock_start_server, MockConnectionServer):
+    mock_start_server.return_value = Mock(
+        serve_forever=CoroutineMock(),
+        __aenter__=CoroutineMock(),
+        __aexit__=CoroutineMock(),
+    )
+
+    config = ServerConfig(bind=[("127.0.0.1", 4000), ("::1", 4001)], backlog=5)
+    await async_run_server(config)
+
+    assert [args[1:] for args, kwargs in mock_start_server.call_args_list] == [
+        ("127.0.0.1", 4000),
+        ("::1", 4001),
+    ]
+    for args, kwargs in mock_start_server.call_args_list:
+        assert kwargs["backlog"] == 5
+
+
+@patch("redclay.server.loops.run")
+@patch("redclay.server.async_run_server", new=Mock())
+async def test_run_server_builds_config(mock_run):
+    run_server.redclay_subcommand.run(
+        workers=1, loop="uvloop", backlog=7, max_connections=None, tcp_nodelay=False
+    )
+
+    expected = ServerConfig(backlog=7, tcp_nodelay=False)
+    redclay.server.async_run_server.assert_called_once_with(expected)
+    mock_run.assert_called_once_with(
+        redclay.server.async_run_server.return_value, "uvloop"
+    )
+
+
+async def test_server_config_defaults():
+    config = ServerConfig()
+    assert config.bind == [("0.0.0.0", 6666)]
+    assert config.listener_options() == []
+    options = config.terminal_options()
+    assert options["read_size"] == 4096
+    assert options["input_limits"].bytes_per_sec == 16384
+    assert options["input_limits"].lines_burst == 100
+
+    assert options["line_overflow"] == LineBuffer.Overflow.TRUNCATE
+    config = ServerConfig(line_overflow="split")
+    assert config.terminal_options()["line_overflow"] == LineBuffer.Overflow.SPLIT
+
+    config = ServerConfig(input_bytes_burst=1024, input_lines_burst=5)
+    limits = config.terminal_options()["input_limits"]
+    assert (limits.bytes_burst, limits.lines_burst) == (1024, 5)
+
+
+async def test_server_config_socket_options():
+    import socket
+
+    config = ServerConfig(tcp_nodelay=False, keepalive=True, receive_buffer=65536)
+    assert (socket.IPPROTO_TCP, socket.TCP_NODELAY, 0) in config.socket_options()
+    assert (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in config.socket_options()
+    assert config.listener_options() == [(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)]
+
+
+@patch("redclay.server.Terminal", new_callable=mock_Terminal)
+async def test_handle_connection_sets_socket_options(MockTerminal):
+    async def boot(conn):
+        await conn.stop()
+
+    writer = Mock()
+    conn_server = ConnectionServer(socket_options=[(1, 2, 3)])
+    await conn_server.handle_connection(boot, Mock(), writer)
+
+    writer.get_extra_info("socket").setsockopt.assert_called_once_with(1, 2, 3)
+
+
+@patch("redclay.server.Terminal", new_callable=mock_Terminal)
+async def test_handle_connection_refuses_over_max(MockTerminal):
+    async def boot(conn):
+        assert False  # should never get this far
+
+    writer = Mock()
+    conn_server = ConnectionServer(admission=AdmissionControl(max_connections=2))
+    conn_server.live_connections.value = 2
+    await conn_server.handle_connection(boot, Mock(), writer)
+
+    MockTerminal.assert_not_called()
+    writer.write.assert_called_once_with(Refusal.FULL.value)
+    writer.close.assert_called_once_with()
+    assert conn_server.live_connections.value == 2
+
+
 @patch("redclay.server.Terminal", new_callable=mock_Terminal)
 @patch("redclay.server.logging_context", wraps=redclay.logging.logging_context)
 @patch("redclay.server.Connection")
@@ -88,7 +189,7 @@ async def test_handle_connection_fast_path(
 
     MockTerminal.assert_called_once_with(reader, writer)
     mock_logging_context.assert_called_once_with(term=id(mock_terminal))
-    MockConnection.assert_called_once_with(mock_terminal)
+    MockConnection.assert_called_once_with(mock_terminal, timers=conn_server.timers)
 
 
 @patch("redclay.server.Terminal", new_callable=mock_Terminal)
@@ -198,6 +299,118 @@ async def test_handle_connection_loops():
     assert prompt.inputs_handled == 3
 
 
+@pytest.mark.virtual_time
+@patch("redclay.server.Terminal", new_callable=mock_Terminal)
+async def test_handle_connection_idle_timeout(MockTerminal, event_loop):
+    class NeverAnswers:
+        prompt = "> "
+
+        async def handle_input(self, conn, line):
+            assert False  # should time out before any input
+
+    async def boot(conn):
+        await conn.push(prompt=NeverAnswers())
+
+    async def hang(prompt):
+        await asyncio.sleep(86400)
+
+    mock_terminal = MockTerminal.return_value
+    mock_terminal.input.side_effect = hang
+
+    conn_server = ConnectionServer(pre_login_idle=300)
+    start = event_loop.time()
+    await asyncio.wait_for(conn_server.handle_connection(boot, Mock(), Mock()), 600)
+
+    assert event_loop.time() - start == pytest.approx(300, abs=1)
+    mock_terminal.write.assert_called_once_with(ConnectionServer.IDLE_MESSAGE)
+    assert len(conn_server.timers) == 0
+
+
+@pytest.mark.virtual_time
+@patch("redclay.server.Terminal", new_callable=mock_Terminal)
+async def test_handle_connection_idle_limit_after_login(MockTerminal):
+    class Login:
+        prompt = "> "
+
+        async def handle_input(self, conn, line):
+            await conn.pop(username=line)
+            await conn.push(prompt=self)
+
+    async def boot(conn):
+        await conn.push(prompt=Login())
+
+    inputs = iter(["alice\n"])
+
+    async def login_then_hang(prompt):
+        for line in inputs:
+            return line
+        await asyncio.sleep(86400)
+
+    mock_terminal = MockTerminal.return_value
+    mock_terminal.input.side_effect = login_then_hang
+
+    conn_server = ConnectionServer(pre_login_idle=300, post_login_idle=None)
+    task = asyncio.ensure_future(conn_server.handle_connection(boot, Mock(), Mock()))
+    await asyncio.sleep(3600)
+
+    # logged in with no post-login limit, so still waiting
+    assert not task.done()
+    task.cancel()
+
+
+@patch("redclay.server.Terminal", new_callable=mock_Terminal)
+async def test_handle_connection_tracks_live_connections(MockTerminal):
+    gauge = Mock(value=0)
+    conn_server = ConnectionServer(connection_gauge=gauge)
+    seen = []
+
+    async def boot(conn):
+        seen.append(gauge.value)
+        await conn.stop()
+
+    await conn_server.handle_connection(boot, Mock(), Mock())
+
+    assert seen == [1]
+    assert gauge.value == 0
+
+
+async def test_connection_logged_in(connection):
+    assert not connection.logged_in
+    await connection.push(tag="auth", username="alice")
+    assert not connection.logged_in
+    await connection.pop(username="alice")
+    assert connection.logged_in
+
+
+async def test_connection_sleep_uses_timers():
+    terminal = Mock(sleep=CoroutineMock())
+    timers = TimingWheel()
+    connection = Connection(terminal, timers=timers)
+
+    await connection.sleep(1)
+    terminal.sleep.assert_called_once_with(1, timers=timers)
+
+
+async def test_connection_replay_scrollback_to_self():
+    terminal = Mock(write=CoroutineMock())
+    terminal.scrollback_text.return_value = "hello\n"
+    connection = Connection(terminal)
+
+    await connection.replay_scrollback()
+    terminal.write.assert_called_once_with("hello\n", drain=True, record=False)
+
+
+async def test_connection_replay_scrollback_to_other():
+    terminal = Mock(write=CoroutineMock())
+    terminal.scrollback_text.return_value = "hello\n"
+    connection = Connection(terminal)
+    other = Connection(Mock(write=CoroutineMock()))
+
+    await connection.replay_scrollback(other)
+    terminal.write.assert_not_called()
+    other.term.write.assert_called_once_with("hello\n", drain=True, record=False)
+
+
 async def test_connection_set_context(connection):
     await connection.set_context(a=1, b=2)
     assert connection.context() == {"a": 1, "b": 2}
@@ -226,3 +439,182 @@ async def test_connection_getitem(connection):
     await connection.set_context(a=1, b=2)
     assert connection["a"] == 1
     assert connection["d"] is None
+
+
+@patch("redclay.server.Terminal", new_callable=mock_Terminal)
+async def test_handle_connection_parks_dropped_player(MockTerminal):
+    conn_server = ConnectionServer()
+    conn_server.connections.park = Mock()
+
+    async def boot(conn):
+        await conn.set_context(username="alice")
+        raise ConnectionResetError()
+
+    await conn_server.handle_connection(boot, Mock(), Mock())
+
+    (conn,), _ = conn_server.connections.park.call_args
+    assert conn["username"] == "alice"
+    assert len(conn_server.connections) == 0
+
+
+@patch("redclay.server.Terminal", new_callable=mock_Terminal)
+async def test_handle_connection_releases_admission(MockTerminal):
+    async def boot(conn):
+        await conn.stop()
+
+    writer = Mock()
+    writer.get_extra_info.side_effect = lambda name: {"peername": ("10.0.0.1", 1)}.get(
+        name, Mock()
+    )
+    conn_server = ConnectionServer(admission=AdmissionControl(per_host=1))
+    await conn_server.handle_connection(boot, Mock(), writer)
+    assert conn_server.admission.hosts == {}
+
+
+@patch("redclay.server.Terminal", new_callable=mock_Terminal)
+async def test_handle_connection_looks_up_host(MockTerminal):
+    answer = asyncio.get_event_loop().create_future()
+    seen = {}
+
+    class Resolver:
+        async def resolve(self, address):
+            seen["address"] = address
+            return await answer
+
+    class ResolveAndStop:
+        prompt = "> "
+
+        async def handle_input(self, conn, line):
+            if not answer.done():
+                seen["host"] = conn.host
+                answer.set_result("alice.example.com")
+                for _ in range(10):
+                    await asyncio.sleep(0)
+                seen["resolved"] = conn.host
+                return
+            # from the next prompt on
+            seen["context"] = get_logging_context()
+            await conn.stop()
+
+    async def boot(conn):
+        # Well before the lookup's done.
+        await conn.send_message("banner")
+        await conn.push(prompt=ResolveAndStop())
+
+    writer = Mock()
+    writer.get_extra_info.side_effect = lambda name: {"peername": ("10.0.0.1", 1)}.get(
+        name, Mock()
+    )
+    conn_server = ConnectionServer(resolver=Resolver())
+    await asyncio.wait_for(conn_server.handle_connection(boot, Mock(), writer), 5)
+    assert seen["address"] == "10.0.0.1"
+    assert seen["host"] is None
+    assert seen["resolved"] == "alice.example.com"
+    assert seen["context"]["host"] == "alice.example.com"
+
+
+@patch("redclay.server.Terminal", new_callable=mock_Terminal)
+async def test_handle_connection_survives_failed_lookups(MockTerminal, caplog):
+    class Resolver:
+        async def resolve(self, address):
+            raise OSError("no nameserver")
+
+    async def boot(conn):
+        await asyncio.sleep(0)
+        await conn.stop()
+
+    writer = Mock()
+    writer.get_extra_info.side_effect = lambda name: {"peername": ("10.0.0.1", 1)}.get(
+        name, Mock()
+    )
+    conn_server = ConnectionServer(resolver=Resolver())
+    with caplog.at_level(logging.WARNING):
+        await asyncio.wait_for(conn_server.handle_connection(boot, Mock(), writer), 5)
+        await asyncio.sleep(0)
+
+    assert "could not resolve peer" in caplog.text
+    assert "Exception in callback" not in caplog.text
+
+
+async def test_run_prompt_once_records_latency():
+    conn_server = ConnectionServer(pre_login_idle=0)
+    conn = Connection(mock_Terminal().return_value)
+    conn.term.flush_response.return_value = 0.002
+
+    class CommandPrompt:
+        prompt = "> "
+
+        def command_name(self, line):
+            return "look"
+
+        async def handle_input(self, conn, line):
+            pass
+
+    await conn.set_context(prompt=CommandPrompt())
+    handled = redclay.server.HANDLE_TIME.values.get(("CommandPrompt", "look"))
+    before = handled.count() if handled else 0
+
+    await conn_server.run_prompt_once(conn)
+
+    handled = redclay.server.HANDLE_TIME.values[("CommandPrompt", "look")]
+    assert handled.count() == before + 1
+    assert redclay.server.RESPONSE_TIME.values[("CommandPrompt", "look")].count() >= 1
+
+
+@patch("redclay.server.Terminal", new_callable=mock_Terminal)
+async def test_handle_connection_kicked(MockTerminal):
+    class Waits:
+        prompt = "> "
+
+        async def handle_input(self, conn, line):
+            assert False  # kicked before any input
+
+    async def boot(conn):
+        await conn.push(prompt=Waits())
+
+    async def hang(prompt):
+        await asyncio.sleep(10)
+
+    mock_terminal = MockTerminal.return_value
+    mock_terminal.input.side_effect = hang
+
+    conn_server = ConnectionServer()
+    handling = asyncio.ensure_future(
+        conn_server.handle_connection(boot, Mock(), Mock())
+    )
+    await asyncio.sleep(0.01)
+    (conn,) = conn_server.connections
+    conn.interrupt(redclay.server.Kicked("Be nice."))
+    await asyncio.wait_for(handling, 1)
+
+    mock_terminal.write.assert_called_with(
+        [ConnectionServer.KICK_MESSAGE, "Be nice.\n"]
+    )
+    assert len(conn_server.connections) == 0
+
+
+@patch("redclay.server.TRACER")
+async def test_run_prompt_once_traced(MockTracer):
+    conn_server = ConnectionServer(pre_login_idle=0)
+    conn = Connection(mock_Terminal().return_value)
+    trace = MockTracer.trace.return_value
+
+    class CommandPrompt:
+        prompt = "> "
+
+        def command_name(self, line):
+            return "look"
+
+        async def handle_input(self, conn, line):
+            assert conn.term.trace is trace
+
+    await conn.set_context(prompt=CommandPrompt())
+    await conn_server.run_prompt_once(conn)
+
+    MockTracer.trace.assert_called_once_with(id(conn.term))
+    names = [args[0] for args, kwargs in trace.add.call_args_list]
+    assert names == ["input", "handle_input"]
+    _, kwargs = trace.add.call_args
+    assert kwargs["args"] == {"prompt": "CommandPrompt", "command": "look"}
+    trace.finish.assert_called_once_with()
+    assert conn.term.trace is None
@@ -1,4 +1,15 @@
-from redclay.shell_command import subcommand, run_from_argv
+import argparse
+
+import pytest
+
+from redclay.shell_command import (
+    BooleanFlag,
+    address,
+    argument,
+    size,
+    subcommand,
+    run_from_argv,
+)
 
 
 def test_run_right_command():
@@ -16,3 +27,82 @@ def test_run_right_command():
     run_from_argv(subcommands, ["subcommand_two"])
 
     assert test_value["command"] == "subcommand_two"
+
+
+def test_run_with_arguments():
+    test_value = {}
+
+    @subcommand(
+        argument("--count", type=int, default=1),
+        argument("--dry-run", action="store_true"),
+        argument("name"),
+    )
+    def subcommand_args(count, dry_run, name):
+        test_value.update(count=count, dry_run=dry_run, name=name)
+
+    run_from_argv([subcommand_args], ["subcommand_args", "--count", "3", "foo"])
+
+    assert test_value == {"count": 3, "dry_run": False, "name": "foo"}
+
+
+def test_run_argument_defaults():
+    test_value = {}
+
+    @subcommand(argument("--count", type=int, default=1))
+    def subcommand_default(count):
+        test_value["count"] = count
+
+    run_from_argv([subcommand_default], ["subcommand_default"])
+
+    assert test_value["count"] == 1
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [("4096", 4096), ("4k", 4096), ("4K", 4096), ("2m", 2 ** 21), ("1gb", 2 ** 30)],
+)
+def test_size(text, expected):
+    assert size(text) == expected
+
+
+@pytest.mark.parametrize("text", ["", "k", "-1", "1.5k", "4q"])
+def test_size_invalid(text):
+    with pytest.raises(argparse.ArgumentTypeError):
+        size(text)
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        ("127.0.0.1:6666", ("127.0.0.1", 6666)),
+        (":6666", ("0.0.0.0", 6666)),
+        ("6666", ("0.0.0.0", 6666)),
+        ("[::1]:6666", ("::1", 6666)),
+        ("localhost:0", ("localhost", 0)),
+    ],
+)
+def test_address(text, expected):
+    assert address(text) == expected
+
+
+@pytest.mark.parametrize(
+    "text", ["localhost", "host:port", "host:70000", "::1:6666", "[::1]", "[::1]6666"]
+)
+def test_address_invalid(text):
+    with pytest.raises(argparse.ArgumentTypeError):
+        address(text)
+
+
+def test_boolean_flag():
+    test_value = {}
+
+    @subcommand(argument("--shiny", action=BooleanFlag, default=True))
+    def subcommand_flag(shiny):
+        test_value["shiny"] = shiny
+
+    run_from_argv([subcommand_flag], ["subcommand_flag"])
+    assert test_value["shiny"] is True
+    run_from_argv([subcommand_flag], ["subcommand_flag", "--no-shiny"])
+    assert test_value["shiny"] is False
+    run_from_argv([subcommand_flag], ["subcommand_flag", "--no-shiny", "--shiny"])
+    assert test_value["shiny"] is True
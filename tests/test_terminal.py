@@ -1,9 +1,11 @@
-from asynctest import Mock, CoroutineMock, patch
+from asynctest import Mock, CoroutineMock
 from unittest.mock import call
 import pytest
 
+from redclay.ratelimit import InputLimits
 from redclay.telnet import B, OPTIONS
-from redclay.terminal import Terminal
+from redclay.terminal import THROTTLE_DELAY, THROTTLED_CONNECTIONS, Terminal
+from redclay.tracing import Trace
 
 
 pytestmark = pytest.mark.asyncio
@@ -41,14 +43,15 @@ async def test_context_manager_drains_and_closes(reader, writer):
     writer.wait_closed.assert_called()
 
 
-@patch("asyncio.sleep")
-async def test_sleep(mock_sleep, terminal):
+@pytest.mark.virtual_time
+async def test_sleep(terminal, event_loop):
+    start = event_loop.time()
     await terminal.sleep(120)
-    mock_sleep.assert_called_with(120)
+    assert event_loop.time() - start == pytest.approx(120)
 
 
-@patch("asyncio.sleep")
-async def test_sleep_drains_writer(mock_sleep, terminal):
+@pytest.mark.virtual_time
+async def test_sleep_drains_writer(terminal):
     await terminal.sleep(120)
     terminal.writer.drain.assert_called()
 
@@ -345,3 +348,185 @@ async def test_input_refuses_local_echo_request(terminal):
     terminal.writer.write.assert_any_call(B.IAC.byte + B.WONT.byte + OPTIONS.ECHO.byte)
     terminal.writer.drain.assert_called()
     assert line == "abc\n"
+
+
+@pytest.mark.virtual_time
+async def test_input_throttles_bytes(reader, writer, event_loop):
+    chunks = [b"abcdefgh", b"\r\n"]
+    reads = []
+
+    async def read(size):
+        reads.append(event_loop.time())
+        return chunks.pop(0)
+
+    reader.read.side_effect = read
+    transport = writer.transport
+    reading = []
+    transport.is_reading.return_value = True
+    transport.pause_reading.side_effect = lambda: reading.append(
+        (False, event_loop.time())
+    )
+    transport.resume_reading.side_effect = lambda: reading.append(
+        (True, event_loop.time())
+    )
+    limits = InputLimits(bytes_per_sec=5, bytes_burst=5)
+    terminal = Terminal(reader, writer, input_limits=limits)
+
+    start = event_loop.time()
+    line = await terminal.input("> ")
+
+    assert line == "abcdefgh\n"
+    # Nothing more read, even from the socket, until the first read's debt
+    # is paid off.
+    assert reads[1] - start == pytest.approx(0.6)
+    assert reading == [
+        (False, start),
+        (True, pytest.approx(start + 0.6)),
+        (False, pytest.approx(start + 0.6)),
+        (True, pytest.approx(start + 1)),
+    ]
+    assert event_loop.time() - start == pytest.approx(1)
+
+
+@pytest.mark.virtual_time
+async def test_throttling_leaves_the_readers_pause_alone(reader, writer, event_loop):
+    # Paused already, because the StreamReader is full: it'll resume
+    # reading once it's been read from.
+    reader.read.return_value = b"abcdefgh\r\n"
+    writer.transport.is_reading.return_value = False
+    limits = InputLimits(bytes_per_sec=5, bytes_burst=5)
+    terminal = Terminal(reader, writer, input_limits=limits)
+
+    await terminal.input("> ")
+    writer.transport.pause_reading.assert_not_called()
+    writer.transport.resume_reading.assert_not_called()
+
+
+@pytest.mark.virtual_time
+async def test_input_throttles_lines(reader, writer, event_loop):
+    reader.read.return_value = b"abc\r\ndef\r\nghi\r\n"
+    limits = InputLimits(lines_per_sec=2, lines_burst=1)
+    terminal = Terminal(reader, writer, input_limits=limits)
+    connections = THROTTLED_CONNECTIONS.values[()]
+    series = THROTTLE_DELAY.values.get(("lines",))
+    throttles = series.count() if series else 0
+
+    start = event_loop.time()
+    assert await terminal.input("> ") == "abc\n"
+    assert event_loop.time() == start
+
+    assert await terminal.input("> ") == "def\n"
+    assert event_loop.time() - start == pytest.approx(0.5)
+    assert await terminal.input("> ") == "ghi\n"
+
+    # Counted once per connection, and each time it's held back.
+    assert THROTTLED_CONNECTIONS.values[()] == connections + 1
+    assert THROTTLE_DELAY.values[("lines",)].count() == throttles + 2
+
+
+async def test_write_records_scrollback(terminal):
+    await terminal.write(["abc\n", "d\re\n"])
+    assert terminal.scrollback_text() == "abc\nd\re\n"
+
+
+async def test_write_skips_negotiations_in_scrollback(terminal):
+    terminal.reader.read.return_value = b"abc\r\n"
+    await terminal.input_secret("> ")
+    assert terminal.scrollback_text() == "> \n"
+
+
+async def test_write_without_record(terminal):
+    await terminal.write("abc\n", record=False)
+    terminal.writer.write.assert_called_with(b"abc\r\n")
+    assert terminal.scrollback_text() == ""
+
+
+async def test_scrollback_drops_partial_oldest_line(reader, writer):
+    terminal = Terminal(reader, writer, scrollback_size=10)
+    await terminal.write(["first\n", "second\n", "3rd\n"])
+    assert terminal.scrollback_text() == "3rd\n"
+
+
+async def test_input_truncates_long_lines(reader, writer):
+    reader.read.side_effect = [b"abcdef", b"ghijkl", b"\r\n"]
+    terminal = Terminal(reader, writer, max_line_length=4)
+
+    line = await terminal.input("> ")
+    assert line == "abcd\n"
+
+
+async def test_read_size(reader, writer):
+    reader.read.return_value = b"abc\r\n"
+    terminal = Terminal(reader, writer, read_size=17)
+
+    await terminal.input("> ")
+    reader.read.assert_called_with(17)
+
+
+async def test_detached_drops_writes(terminal):
+    terminal.detach()
+    terminal.writer.transport.pause_reading.assert_called_once_with()
+    await terminal.write("abc\n")
+    terminal.writer.write.assert_not_called()
+
+
+async def test_flush_restores_write_buffer_limits(terminal):
+    transport = terminal.writer.transport
+    transport.get_write_buffer_limits.return_value = (16384, 65536)
+    await terminal.flush()
+    terminal.writer.drain.assert_called_once_with()
+    assert transport.set_write_buffer_limits.call_args_list == [
+        call(high=0),
+        call(high=65536, low=16384),
+    ]
+
+
+async def test_state_round_trip(reader, writer):
+    reader.read.return_value = b"first\r\nsecond\r\nthi"
+    terminal = Terminal(reader, writer)
+    assert await terminal.input("> ") == "first\n"
+    await terminal.write("seen\n")
+    terminal.detach()
+    # what the StreamReader still had
+    reader.read.return_value = b"rd\r\n"
+    await terminal.take_unread()
+    reader.feed_eof.assert_called_once_with()
+    state = terminal.dump_state()
+
+    resumed = Terminal(mock_reader(), mock_writer())
+    resumed.load_state(state)
+    assert resumed.scrollback_text() == "> seen\n"
+    assert await resumed.input("> ") == "second\n"
+    assert await resumed.input("> ") == "third\n"
+    resumed.reader.read.assert_not_called()
+
+
+async def test_flush_response_times_last_line(reader, writer):
+    reader.read.return_value = b"abc\r\n"
+    terminal = Terminal(reader, writer)
+    assert await terminal.flush_response() is None
+
+    await terminal.input("> ")
+    latency = await terminal.flush_response()
+    assert 0 <= latency < 1
+    writer.drain.assert_called()
+    # Only the first response to a line counts.
+    assert await terminal.flush_response() is None
+
+
+async def test_input_traced(reader, writer):
+    reader.read.return_value = b"abc\r\n"
+    terminal = Terminal(reader, writer)
+    terminal.trace = Trace(Mock(), 1)
+
+    await terminal.input("> ")
+    await terminal.flush_response()
+
+    names = [name for name, *_ in terminal.trace.events]
+    assert names[:2] == ["write", "read"]
+    assert names[2:4] == ["tokenize", "parse"]
+    assert "assemble" in names
+    assert names[-1] == "drain"
+    for _, start, end, tid, _ in terminal.trace.events:
+        assert start <= end
+        assert tid == 1
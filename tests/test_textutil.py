@@ -1,6 +1,6 @@
 import pytest
 
-from redclay.textutil import LineBuffer
+from redclay.textutil import LINE_OVERFLOWS, LineBuffer, Scrollback
 
 
 @pytest.fixture
@@ -94,3 +94,151 @@ def test_buffer_complex(line_buffer):
     assert line_buffer.pop() == ([annotation], "def\n")
     assert line_buffer.pop() == ([], "\n")
     assert not line_buffer.has_line()
+
+
+def test_buffer_clear_keeps_pending_annotations(line_buffer):
+    annotation = object()
+    line_buffer.append("abc\nde")
+    line_buffer.annotate(annotation)
+    line_buffer.clear()
+    assert not line_buffer.has_line()
+    line_buffer.append("f\n")
+    assert line_buffer.pop() == ([annotation], "f\n")
+
+
+def test_buffer_long_paste_is_chunked(line_buffer):
+    for _ in range(1000):
+        line_buffer.append("abc")
+    assert len(line_buffer.chunks) == 1000
+    line_buffer.append("\n")
+    assert line_buffer.pop() == ([], "abc" * 1000 + "\n")
+    assert line_buffer.chunks == []
+
+
+def test_buffer_truncate_overflow():
+    overflows = LINE_OVERFLOWS.values[("truncate",)]
+    line_buffer = LineBuffer(max_length=4)
+    line_buffer.append("abc")
+    line_buffer.append("def")
+    line_buffer.append("ghi\njk\n")
+    assert line_buffer.pop() == ([], "abcd\n")
+    assert line_buffer.pop() == ([], "jk\n")
+    assert LINE_OVERFLOWS.values[("truncate",)] == overflows + 1
+
+
+def test_buffer_truncate_exact_length():
+    overflows = LINE_OVERFLOWS.values[("truncate",)]
+    line_buffer = LineBuffer(max_length=4)
+    line_buffer.append("abcd\n")
+    assert line_buffer.pop() == ([], "abcd\n")
+    assert LINE_OVERFLOWS.values[("truncate",)] == overflows
+
+
+def test_buffer_split_overflow():
+    overflows = LINE_OVERFLOWS.values[("split",)]
+    line_buffer = LineBuffer(max_length=4, overflow=LineBuffer.Overflow.SPLIT)
+    line_buffer.append("abc")
+    line_buffer.append("defghij")
+    assert line_buffer.pop() == ([], "abcd")
+    assert line_buffer.pop() == ([], "efgh")
+    assert not line_buffer.has_line()
+    line_buffer.append("klmno")
+    assert line_buffer.pop() == ([], "ijkl")
+    line_buffer.append("p\nqrstuv\n")
+    assert line_buffer.pop() == ([], "mnop\n")
+    assert line_buffer.pop() == ([], "qrst")
+    assert line_buffer.pop() == ([], "uv\n")
+    # once for each long line, not each read of it
+    assert LINE_OVERFLOWS.values[("split",)] == overflows + 2
+
+
+def test_buffer_discard_overflow():
+    overflows = LINE_OVERFLOWS.values[("discard",)]
+    line_buffer = LineBuffer(max_length=4, overflow=LineBuffer.Overflow.DISCARD)
+    line_buffer.append("abcdef")
+    line_buffer.append("ghi\nxyz\n")
+    assert line_buffer.pop() == ([], "")
+    assert line_buffer.pop() == ([], "xyz\n")
+    assert LINE_OVERFLOWS.values[("discard",)] == overflows + 1
+
+
+def test_buffer_overflow_keeps_annotations():
+    annotation = object()
+    line_buffer = LineBuffer(max_length=4, overflow=LineBuffer.Overflow.DISCARD)
+    line_buffer.append("abcdef")
+    line_buffer.annotate(annotation)
+    assert not line_buffer.has_line()
+    line_buffer.append("\n")
+    assert line_buffer.pop() == ([annotation], "")
+
+
+#
+# Scrollback
+#
+
+
+def test_scrollback_initially_empty():
+    scrollback = Scrollback(8)
+    assert len(scrollback) == 0
+    assert scrollback.getvalue() == b""
+
+
+def test_scrollback_partial():
+    scrollback = Scrollback(8)
+    scrollback.append(b"abc")
+    scrollback.append(b"de")
+    assert len(scrollback) == 5
+    assert scrollback.getvalue() == b"abcde"
+    assert not scrollback.full
+
+
+def test_scrollback_exactly_full():
+    scrollback = Scrollback(8)
+    scrollback.append(b"abcdefgh")
+    assert scrollback.full
+    assert scrollback.getvalue() == b"abcdefgh"
+
+
+def test_scrollback_wraps():
+    scrollback = Scrollback(8)
+    scrollback.append(b"abcdef")
+    scrollback.append(b"ghij")
+    assert len(scrollback) == 8
+    assert scrollback.getvalue() == b"cdefghij"
+
+    scrollback.append(b"klmnopq")
+    assert scrollback.getvalue() == b"jklmnopq"
+
+
+def test_scrollback_oversized_append():
+    scrollback = Scrollback(4)
+    scrollback.append(b"ab")
+    scrollback.append(b"cdefghij")
+    assert scrollback.getvalue() == b"ghij"
+
+    scrollback.append(b"k")
+    assert scrollback.getvalue() == b"hijk"
+
+
+def test_scrollback_buffer_is_fixed():
+    scrollback = Scrollback(8)
+    buffer = scrollback.buffer
+    for _ in range(10):
+        scrollback.append(b"abc")
+    assert scrollback.buffer is buffer
+    assert len(buffer) == 8
+
+
+def test_scrollback_disabled():
+    scrollback = Scrollback(0)
+    scrollback.append(b"abc")
+    assert scrollback.getvalue() == b""
+
+
+def test_scrollback_clear():
+    scrollback = Scrollback(4)
+    scrollback.append(b"abcdef")
+    scrollback.clear()
+    assert scrollback.getvalue() == b""
+    scrollback.append(b"x")
+    assert scrollback.getvalue() == b"x"
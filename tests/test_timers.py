@@ -0,0 +1,166 @@
+import asyncio
+
+import pytest
+from asynctest import Mock
+
+from redclay.timers import TimingWheel
+
+
+@pytest.fixture
+def loop():
+    return Mock(time=Mock(return_value=0))
+
+
+@pytest.fixture
+def wheel(loop):
+    return TimingWheel(tick=1, slots=4, loop=loop)
+
+
+def advance(wheel, ticks):
+    for _ in range(ticks):
+        wheel.loop.time.return_value = wheel.next_tick
+        wheel.advance()
+
+
+def test_timer_fires_on_its_tick(wheel):
+    callback = Mock()
+    wheel.schedule(3, callback, "arg")
+
+    advance(wheel, 2)
+    callback.assert_not_called()
+    advance(wheel, 1)
+    callback.assert_called_once_with("arg")
+    assert len(wheel) == 0
+
+
+def test_timer_rounds_up_partial_ticks(wheel):
+    callback = Mock()
+    wheel.schedule(1.5, callback)
+
+    advance(wheel, 1)
+    callback.assert_not_called()
+    advance(wheel, 1)
+    callback.assert_called_once_with()
+
+
+@pytest.mark.parametrize("now", [0, 0.25, 0.5, 0.999])
+@pytest.mark.parametrize("delay", [0.5, 1, 1.5, 2, 5])
+def test_timer_scheduled_mid_tick_never_fires_early(wheel, loop, now, delay):
+    fired = []
+    wheel.schedule(100, Mock())
+    loop.time.return_value = now
+    wheel.schedule(delay, lambda: fired.append(loop.time()))
+
+    while not fired:
+        advance(wheel, 1)
+    assert now + delay <= fired[0] < now + delay + wheel.tick
+
+
+@pytest.mark.parametrize("delay", [4, 5, 8, 9, 13])
+def test_timer_waits_full_revolutions(wheel, delay):
+    callback = Mock()
+    wheel.schedule(delay, callback)
+
+    advance(wheel, delay - 1)
+    callback.assert_not_called()
+    advance(wheel, 1)
+    callback.assert_called_once_with()
+
+
+def test_cancel(wheel):
+    callback = Mock()
+    timer = wheel.schedule(2, callback)
+    assert len(wheel) == 1
+
+    timer.cancel()
+    assert len(wheel) == 0
+    advance(wheel, 8)
+    callback.assert_not_called()
+
+    # cancelling twice is harmless
+    timer.cancel()
+    assert len(wheel) == 0
+
+
+def test_callbacks_fire_in_insertion_order(wheel):
+    fired = []
+    wheel.schedule(2, fired.append, "a")
+    wheel.schedule(2, fired.append, "b")
+    wheel.schedule(1, fired.append, "c")
+
+    advance(wheel, 2)
+    assert fired == ["c", "a", "b"]
+
+
+def test_failing_callback_does_not_stop_others(wheel):
+    callback = Mock()
+    wheel.schedule(1, Mock(side_effect=RuntimeError))
+    wheel.schedule(1, callback)
+
+    advance(wheel, 1)
+    callback.assert_called_once_with()
+
+
+def test_wheel_only_ticks_while_busy(wheel, loop):
+    loop.call_at.assert_not_called()
+
+    wheel.schedule(1, Mock())
+    loop.call_at.assert_called_once_with(1, wheel.advance)
+
+    advance(wheel, 1)
+    # nothing left to do, so no new tick
+    loop.call_at.assert_called_once()
+
+
+def test_timer_rescheduling_itself_keeps_one_tick(wheel, loop):
+    fired = []
+
+    def again():
+        fired.append(loop.time())
+        wheel.schedule(1, again)
+
+    wheel.schedule(1, again)
+    advance(wheel, 5)
+    assert fired == [1, 2, 3, 4, 5]
+    # the first tick, then one more per tick
+    assert loop.call_at.call_count == 6
+
+
+@pytest.mark.asyncio
+async def test_rescheduled_timers_never_fire_early():
+    wheel = TimingWheel(tick=0.01)
+    loop = asyncio.get_event_loop()
+    fired = []
+    done = loop.create_future()
+
+    def again():
+        fired.append(loop.time())
+        if len(fired) == 6:
+            done.set_result(None)
+        else:
+            wheel.schedule(0.05, again)
+
+    wheel.schedule(0.05, again)
+    await asyncio.wait_for(done, 5)
+    gaps = [later - earlier for earlier, later in zip(fired, fired[1:])]
+    assert min(gaps) >= 0.05 - 1e-9
+
+
+@pytest.mark.asyncio
+async def test_sleep():
+    wheel = TimingWheel(tick=0.01)
+    await asyncio.wait_for(wheel.sleep(0.03), 1)
+    assert len(wheel) == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_sleep_cancels_timer():
+    wheel = TimingWheel(tick=0.01)
+    task = asyncio.ensure_future(wheel.sleep(10))
+    await asyncio.sleep(0)
+    assert len(wheel) == 1
+
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert len(wheel) == 0
@@ -0,0 +1,78 @@
+import json
+
+from asynctest import Mock, patch
+
+from redclay.tracing import Trace, Tracer
+
+
+def test_untraced_when_off():
+    tracer = Tracer()
+    assert tracer.trace(1) is None
+
+
+@patch("redclay.tracing.random.random")
+def test_sampling(mock_random, tmp_path):
+    tracer = Tracer()
+    tracer.start(str(tmp_path / "trace.json"), sample_rate=0.25)
+    try:
+        mock_random.return_value = 0.5
+        assert tracer.trace(1) is None
+        mock_random.return_value = 0.1
+        assert isinstance(tracer.trace(1), Trace)
+    finally:
+        tracer.stop()
+
+
+def test_trace_add_chains():
+    trace = Trace(Mock(), 7)
+    end = trace.add("tokenize", 1.0, end=1.5)
+    trace.add("parse", end, end=2.0, args={"x": 1})
+    assert trace.events == [
+        ("tokenize", 1.0, 1.5, 7, None),
+        ("parse", 1.5, 2.0, 7, {"x": 1}),
+    ]
+    trace.finish()
+    trace.tracer.record.assert_called_once_with(trace.events)
+
+
+def record_interactions(tracer):
+    for tid in (1, 2):
+        trace = tracer.trace(tid)
+        trace.add("read", 1.0, end=1.25)
+        trace.add("handle_input", 1.25, end=1.5, args={"command": "who"})
+        trace.finish()
+
+
+def test_chrome_trace_output(tmp_path):
+    path = tmp_path / "trace.json"
+    tracer = Tracer()
+    tracer.start(str(path))
+    record_interactions(tracer)
+    tracer.stop()
+
+    events = json.loads(path.read_text())
+    assert len(events) == 4
+    assert events[0]["name"] == "read"
+    assert events[0]["ph"] == "X"
+    assert events[0]["ts"] == 1000000
+    assert events[0]["dur"] == 250000
+    assert events[1]["args"] == {"command": "who"}
+    assert [event["tid"] for event in events] == [1, 1, 2, 2]
+
+
+def test_jsonl_output_in_batches(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    tracer = Tracer()
+    tracer.BATCH_SIZE = 2
+    tracer.start(str(path), format="jsonl")
+    record_interactions(tracer)
+    assert tracer.pending == []
+    tracer.stop()
+
+    lines = path.read_text().splitlines()
+    assert [json.loads(line)["name"] for line in lines] == [
+        "read",
+        "handle_input",
+        "read",
+        "handle_input",
+    ]
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+from redclay.simulation import run_login_failures
+from redclay.timers import TimingWheel
+from redclay.virtualtime import VirtualTimeLoop
+
+
+pytestmark = [pytest.mark.asyncio, pytest.mark.virtual_time]
+
+
+async def test_sleep_advances_clock(event_loop):
+    assert isinstance(event_loop, VirtualTimeLoop)
+    start = event_loop.time()
+    await asyncio.sleep(3600)
+    assert event_loop.time() - start == pytest.approx(3600)
+
+
+async def test_timers_fire_in_order(event_loop):
+    fired = []
+
+    async def sleeper(secs):
+        await asyncio.sleep(secs)
+        fired.append((secs, event_loop.time()))
+
+    await asyncio.gather(*(sleeper(secs) for secs in [30, 10, 20]))
+    assert fired == [(10, 10), (20, 20), (30, 30)]
+
+
+async def test_timing_wheel_sleep(event_loop):
+    timers = TimingWheel(tick=1)
+    start = event_loop.time()
+    await timers.sleep(60)
+    assert event_loop.time() - start == pytest.approx(60, abs=1)
+
+
+async def test_wait_for_times_out(event_loop):
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(asyncio.sleep(100), 5)
+    assert event_loop.time() == pytest.approx(5)
+
+
+async def test_login_failures_are_deterministic():
+    first = await run_login_failures(50, rate=10)
+    second = await run_login_failures(50, rate=10)
+
+    assert first.failures == 150
+    assert first.transcript == second.transcript
+    assert first.virtual_elapsed == pytest.approx(second.virtual_elapsed)
@@ -0,0 +1,61 @@
+import asyncio
+import time
+import traceback
+
+from asynctest import Mock
+import pytest
+
+from redclay.logging import logging_context
+from redclay.watchdog import LOOP_LAG_PROBES, Watchdog
+
+
+def block_the_loop(seconds):
+    time.sleep(seconds)
+
+
+@pytest.mark.asyncio
+async def test_watchdog_reports_blocked_loop():
+    watchdog = Watchdog(threshold=0.05, interval=0.01)
+    watchdog.report = Mock()
+    watchdog.start()
+    try:
+        await asyncio.sleep(0.03)
+        with logging_context(term=42):
+            block_the_loop(0.2)
+        await asyncio.sleep(0.03)
+    finally:
+        watchdog.stop()
+
+    watchdog.report.assert_called_once()
+    (blocked_for, stack, context), _ = watchdog.report.call_args
+    assert blocked_for >= 0.05
+    assert "block_the_loop" in [frame.name for frame in stack]
+    assert context == {"term": 42}
+
+
+@pytest.mark.asyncio
+async def test_watchdog_quiet_when_loop_is_not_blocked():
+    watchdog = Watchdog(threshold=0.05, interval=0.01)
+    watchdog.report = Mock()
+    before = LOOP_LAG_PROBES.values.get((), None)
+    before = before.count() if before else 0
+    watchdog.start()
+    try:
+        await asyncio.sleep(0.1)
+    finally:
+        watchdog.stop()
+
+    watchdog.report.assert_not_called()
+    assert LOOP_LAG_PROBES.values[()].count() > before
+
+
+def test_watchdog_report_logs_stack(caplog):
+    watchdog = Watchdog()
+    stack = traceback.extract_stack()
+    watchdog.report(0.8, stack, {"term": 42})
+
+    (record,) = caplog.records
+    assert record.getMessage() == "event loop blocked"
+    assert record.seconds == 0.8
+    assert record.lineno == stack[-1].lineno
+    assert "test_watchdog_report_logs_stack" in record.stack_info
@@ -0,0 +1,113 @@
+import os
+import signal
+import time
+
+import pytest
+
+from redclay.workers import WorkerPool
+
+
+def sleep_forever(index, connections):
+    connections.value = index + 10
+    while True:
+        time.sleep(1)
+
+
+def count_signals(index, connections):
+    def handle(signum, frame):
+        connections.value += 1
+
+    signal.signal(signal.SIGUSR2, handle)
+    connections.value = 0
+    while True:
+        time.sleep(1)
+
+
+def exit_immediately(index, connections):
+    os._exit(1)
+
+
+@pytest.fixture
+def make_pool():
+    pools = []
+
+    def make(count, target):
+        pool = WorkerPool(count, target)
+        pool.SHUTDOWN_TIMEOUT = 5
+        pools.append(pool)
+        return pool
+
+    yield make
+
+    for pool in pools:
+        pool.shutdown()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_pool_starts_workers(make_pool):
+    pool = make_pool(2, sleep_forever)
+    pool.start()
+
+    assert all(worker.process.is_alive() for worker in pool.workers)
+    wait_for(lambda: pool.connection_counts() == [10, 11])
+
+
+def test_pool_shutdown_stops_workers(make_pool):
+    pool = make_pool(2, sleep_forever)
+    pool.start()
+    pool.shutdown()
+
+    assert not any(worker.process.is_alive() for worker in pool.workers)
+
+
+def test_pool_restarts_crashed_worker(make_pool):
+    pool = make_pool(1, exit_immediately)
+    pool.RESTART_DELAY = 0
+    pool.start()
+    first_pid = pool.workers[0].process.pid
+
+    # with no restart delay the same poll notices the exit and restarts
+    pool.poll(5)
+    worker = pool.workers[0]
+    assert worker.restart_at is None
+    assert worker.process.pid != first_pid
+
+
+def test_pool_backs_off_crash_loops(make_pool):
+    pool = make_pool(1, exit_immediately)
+    pool.RESTART_DELAY = 0.01
+    pool.start()
+    worker = pool.workers[0]
+
+    delays = []
+    for _ in range(3):
+        pool.poll(5)
+        delays.append(worker.restart_delay)
+        wait_for(lambda: worker.restart_at is None or pool.poll(0.01))
+
+    assert delays == [0.01, 0.02, 0.04]
+
+
+def test_pool_does_not_restart_while_stopping(make_pool):
+    pool = make_pool(1, exit_immediately)
+    pool.start()
+    pool.stopping = True
+
+    pool.poll(5)
+    assert pool.workers[0].restart_at is None
+
+
+def test_pool_forwards_signals(make_pool):
+    pool = make_pool(2, count_signals)
+    pool.start()
+    wait_for(lambda: all(w.process.pid for w in pool.workers))
+    time.sleep(0.2)  # for the workers to install their handlers
+
+    pool.forward_signal(signal.SIGUSR2, None)
+    wait_for(lambda: all(w.connections.value == 1 for w in pool.workers))